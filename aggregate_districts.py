@@ -0,0 +1,165 @@
+import os
+import csv
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from geometry_cache import load_geometries
+from district_labels import cached_point_districts
+from columnar_store import list_tables, read_table
+from merge_to_single_csv import parse_file_date
+from partitioned_dataset import MERGED_FOLDER, existing_partitions, partition_file
+from build_manifest import BuildManifest
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Default paths (same as build_db.sql)
+input_folder = MERGED_FOLDER
+geojson_path = './geodata/epsg25832/statistische_bezirke_2020.geojson'
+output_file = './aggregated/avg_temp_bezirke.csv'
+
+# Building classes that are not part of the statistics (see build_db.sql)
+EXCLUDED_NTZG = (20, 21, 30, 32)
+
+# PET is just a random value for testing (same as build_db.sql)
+PET_OFFSET = 5
+
+COLUMNS = ['x', 'y', 'temperatur', 'ntzg']
+OUTPUT_HEADER = ['gid', 'name', 'date', 'avg_temp', 'min_temp', 'max_temp', 'avg_pet', 'min_pet', 'max_pet']
+
+def list_hours(input_folder):
+    """(date, path) of every hour, sorted by date.
+
+    input_folder is either the day/hour partitioned dataset or a folder of per-hour
+    EPSG:25832 files / stores (the date is then taken from the file name).
+    """
+    partitions = sorted(existing_partitions(input_folder))
+    if partitions:
+        return [(date_string_iso, partition_file(input_folder, date_string_iso)) for date_string_iso in partitions]
+    return sorted((parse_file_date(filename), os.path.join(input_folder, filename))
+                  for filename in list_tables(input_folder))
+
+def read_hour(path):
+    """Columns needed for the statistics of one hour."""
+    if path.endswith('.parquet'):
+        table = pq.read_table(path, columns=COLUMNS)
+        return {name: table.column(name).to_numpy() for name in COLUMNS}
+    df = read_table(path, columns=COLUMNS)
+    return {name: df[name].to_numpy() for name in COLUMNS}
+
+class DistrictGrouping:
+    """Points sorted by district, so every district is one contiguous segment.
+
+    pairs are the (points, districts) of point_districts: like the ST_Contains join of
+    build_db.sql, a point inside overlapping districts counts for each of them.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.order, districts = pairs
+        self.starts = np.flatnonzero(np.diff(districts, prepend=-1))
+        self.groups = districts[self.starts]
+
+    def reduce(self, temperatur, valid):
+        """Count, sum and min/max of the valid values per district (only districts with values)."""
+        if not len(self.order):
+            empty = np.zeros(0)
+            return self.groups, empty, empty, empty, empty
+
+        values = temperatur[self.order]
+        mask = valid[self.order]
+        counts = np.add.reduceat(mask.astype(np.int64), self.starts)
+        sums = np.add.reduceat(np.where(mask, values.astype(np.float64), 0.0), self.starts)
+        mins = np.minimum.reduceat(np.where(mask, values, np.inf).astype(values.dtype), self.starts)
+        maxs = np.maximum.reduceat(np.where(mask, values, -np.inf).astype(values.dtype), self.starts)
+        return self.groups, counts, sums, mins, maxs
+
+def aggregate_hour(columns, grouping):
+    """Statistics of one hour, as dict label -> (avg_temp, min_temp, max_temp, avg_pet, min_pet, max_pet)."""
+    # Same column type as the temperature table (FLOAT)
+    temperatur = np.asarray(columns['temperatur'], dtype=np.float32)
+    valid = ~np.isin(columns['ntzg'], EXCLUDED_NTZG) & ~np.isnan(temperatur)
+    pet = temperatur + np.float32(PET_OFFSET)
+
+    groups, counts, temp_sums, temp_mins, temp_maxs = grouping.reduce(temperatur, valid)
+    _, _, pet_sums, pet_mins, pet_maxs = grouping.reduce(pet, valid)
+
+    stats = {}
+    for i in np.flatnonzero(counts):
+        stats[int(groups[i])] = (temp_sums[i] / counts[i], temp_mins[i], temp_maxs[i],
+                                 pet_sums[i] / counts[i], pet_mins[i], pet_maxs[i])
+    return stats
+
+def format_value(value):
+    # Shortest representation of the value in its own precision (like DuckDB's CSV export)
+    return repr(float(value)) if isinstance(value, (float, np.float64)) else str(value)
+
+def aggregate_districts(input_folder, geojson_path, output_file, cache_dir=None, force=False):
+    hours = list_hours(input_folder)
+
+    # The row set only has to be recomputed when an hour, the districts or the settings changed
+    manifest = BuildManifest(os.path.dirname(output_file) or '.', force)
+    fingerprint = manifest.fingerprint([path for _, path in hours] + [geojson_path],
+                                       {'excluded_ntzg': EXCLUDED_NTZG, 'pet_offset': PET_OFFSET,
+                                        'overlapping_districts': 'all'})
+    if manifest.is_current(output_file, fingerprint):
+        manifest.save()
+        logging.info(f"{output_file} is up to date")
+        return
+
+    geometry_set = load_geometries(geojson_path, cache_dir)
+    geometries = geometry_set.geometries
+    gids = geometry_set.column('gid')
+    names = geometry_set.column('name')
+
+    rows = []
+    grouping = None
+    for date_string_iso, path in hours:
+        start_time = time.time()
+        columns = read_hour(path)
+
+        # The districts of the points (and the grouping derived from them) are computed once per point set
+        pairs = cached_point_districts(columns['x'], columns['y'], geometries, cache_dir)
+        if grouping is None or grouping.pairs is not pairs:
+            grouping = DistrictGrouping(pairs)
+
+        date = pd.Timestamp(date_string_iso)
+        for index, values in aggregate_hour(columns, grouping).items():
+            rows.append((gids[index], names[index], date, values))
+        logging.info(f"Aggregated {date_string_iso} in {time.time() - start_time:.2f} seconds")
+
+    # Same order as the SQL query (ORDER BY gid, date)
+    rows.sort(key=lambda row: (row[0], row[2]))
+
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    tmp_file = f"{output_file}.tmp-{os.getpid()}"
+    with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(OUTPUT_HEADER)
+        for gid, name, date, values in rows:
+            writer.writerow([gid, name, f"{date:%Y-%m-%d %H:%M:%S}"] + [format_value(v) for v in values])
+    os.replace(tmp_file, output_file)
+    manifest.record(output_file, fingerprint)
+    manifest.save()
+    logging.info(f"Wrote {len(rows)} rows to {output_file}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Aggregate temperature and PET per district and hour (same output as build_db.sql)")
+    parser.add_argument("--input_folder", default=input_folder,
+                        help="Partitioned merged dataset or folder with per-hour EPSG:25832 files")
+    parser.add_argument("--geojson", default=geojson_path, help="District GeoJSON (EPSG:25832)")
+    parser.add_argument("--output_file", default=output_file, help="Output CSV file")
+    parser.add_argument("--cache_dir", default=None, help="Folder to cache the point labels and parsed geometries on disk")
+    parser.add_argument("--force", action="store_true", help="Aggregate even if the output is up to date")
+    args = parser.parse_args()
+
+    logging.info("Script started with the following arguments:")
+    for name, value in vars(args).items():
+        logging.info(f"{name}: {value}")
+
+    aggregate_districts(args.input_folder, args.geojson, args.output_file, args.cache_dir, args.force)
+
+    logging.info("Script execution completed")
@@ -0,0 +1 @@
+"""Synthetic data and stage benchmarks for the pipeline (run as python -m benchmarks.<module> from the repository root)."""
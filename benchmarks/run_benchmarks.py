@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy
+import matplotlib
+from transform_to_csv import convert_all
+from transform_csv_to_epsg3857 import transform_file
+from merge_to_single_csv import merge_partitioned
+from aggregate_districts import aggregate_districts
+from ingest import ingest_all
+from columnar_store import list_tables, read_table
+from district_labels import label_points
+from geometry_cache import image_size, load_geometries, rasterize_mask
+from interpolation_plan import InterpolationPlan
+import png_renderer
+from png_renderer import canvas_indices, canvas_lut, get_pixel_map, save_indexed_png
+import heatmap_generator_unified as heatmaps
+from benchmarks.synthetic_data import parse_grid, write_districts, write_raw_files
+
+# Version of the result file layout
+RESULT_VERSION = 1
+
+# Fields that identify a measurement when two result files are compared
+RESULT_KEY = ('stage', 'phase', 'points', 'hours', 'resolution', 'workers')
+
+def run_quietly(function, *args, **kwargs):
+    """Call function without its progress output (print, tqdm and log messages below WARNING)."""
+    logging.disable(logging.INFO)
+    try:
+        with contextlib.redirect_stdout(StringIO()), contextlib.redirect_stderr(StringIO()):
+            return function(*args, **kwargs)
+    finally:
+        logging.disable(logging.NOTSET)
+
+def timed(function, *args, repeat=1, **kwargs):
+    """Wall times of repeat calls of function."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_quietly(function, *args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return times
+
+def transform_files(input_folder, output_folder, workers):
+    """transform_csv_to_epsg3857 for all files of input_folder with workers processes."""
+    os.makedirs(output_folder, exist_ok=True)
+    filenames = list_tables(input_folder)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(transform_file, filenames, [input_folder] * len(filenames),
+                          [output_folder] * len(filenames)))
+
+def heatmap_phases(df, geometry, resolution, cmap='RdBu_r', vmin=10, vmax=36, output_png='phase.png'):
+    """Wall time of every phase of create_heatmap for one geometry, without any caches.
+
+    Returns a dict phase -> seconds; 'matplotlib' is the figure based renderer that the
+    direct renderer (pixel_map + colour + encode) replaces.
+    """
+    clock = time.perf_counter
+    phases = {}
+
+    start = clock()
+    x_all = np.asarray(df['x'], dtype=np.float64)
+    y_all = np.asarray(df['y'], dtype=np.float64)
+    point_mask = label_points(x_all, y_all, [geometry]) == 0
+    x_coords, y_coords = x_all[point_mask], y_all[point_mask]
+    temps = np.asarray(df['temperatur'])[point_mask]
+    building_mask = np.isin(np.asarray(df['ntzg'])[point_mask], [20, 21, 30, 32])
+    phases['point_filter'] = clock() - start
+
+    bounds = geometry.bounds
+    width, height = image_size(bounds, resolution)
+    start = clock()
+    geometry_mask = rasterize_mask(geometry, width, height, bounds)
+    phases['geometry_mask'] = clock() - start
+
+    start = clock()
+    plan = InterpolationPlan.build(x_coords, y_coords, building_mask, bounds, width, height, pixel_mask=geometry_mask)
+    phases['plan_build'] = clock() - start
+
+    start = clock()
+    temp_grid = plan.linear(temps)
+    temp_grid[~geometry_mask] = np.nan
+    temp_grid[plan.nearest_neighbour(building_mask, fill_value=False) & geometry_mask] = vmin - 1
+    phases['plan_apply'] = clock() - start
+
+    extent = (bounds[0], bounds[2], bounds[1], bounds[3])
+    custom_cmap = heatmaps.heatmap_colormap(cmap)
+    png_renderer._pixel_map_cache.clear()
+    start = clock()
+    get_pixel_map(width, height, extent)
+    phases['pixel_map'] = clock() - start
+
+    start = clock()
+    indices = canvas_indices(temp_grid, extent, custom_cmap.N, vmin - 1, vmax)
+    phases['colour'] = clock() - start
+
+    lut = canvas_lut(custom_cmap)
+    for png_format in ('rgba', 'palette'):
+        start = clock()
+        save_indexed_png(indices, lut, output_png, png_format)
+        phases[f"encode_{png_format}"] = clock() - start
+
+    start = clock()
+    heatmaps.save_matplotlib_png(temp_grid, extent, custom_cmap, vmin, vmax, width, height, output_png)
+    phases['matplotlib'] = clock() - start
+    return phases
+
+def environment():
+    """Machine and library versions, so that results of different machines are not mixed up."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'matplotlib': matplotlib.__version__,
+        'commit': commit or None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def run_benchmarks(work_dir, sizes, hours, resolutions, workers, districts, repeat=1, stages=None, seed=0):
+    """Generate data for every size and time the stages; returns the list of result records."""
+    results = []
+
+    def record(stage, times, points, phase=None, resolution=None, worker_count=None):
+        results.append({'stage': stage, 'phase': phase, 'points': points, 'hours': hours,
+                        'resolution': resolution, 'workers': worker_count,
+                        'seconds': min(times), 'runs': [round(t, 6) for t in times]})
+        details = ', '.join(f"{name}={value}" for name, value in
+                            (('phase', phase), ('resolution', resolution), ('workers', worker_count)) if value)
+        logging.info(f"{stage} ({points} points{', ' + details if details else ''}): {min(times):.3f} s")
+
+    def enabled(stage):
+        return stages is None or stage in stages
+
+    for points in sizes:
+        root = os.path.join(work_dir, f"points_{points}")
+        raw = os.path.join(root, 'rawdata')
+        csv_25832 = os.path.join(root, 'epsg25832')
+        csv_3857 = os.path.join(root, 'epsg3857')
+        merged = os.path.join(root, 'merged')
+
+        start = time.perf_counter()
+        _, bounds = write_raw_files(raw, points, hours, seed=seed)
+        paths = write_districts(os.path.join(root, 'geodata'), bounds, *districts, seed=seed)
+        record('generate', [time.perf_counter() - start], points)
+
+        # The later stages need the outputs of the earlier ones, so those always run once
+        times = timed(convert_all, raw, csv_25832, force=True, repeat=repeat)
+        if enabled('transform_to_csv'):
+            record('transform_to_csv', times, points)
+        for worker_count in workers:
+            times = timed(transform_files, csv_25832, csv_3857, worker_count, repeat=repeat)
+            if enabled('projection'):
+                record('projection', times, points, worker_count=worker_count)
+
+        times = timed(merge_partitioned, raw, merged, force=True, repeat=repeat)
+        if enabled('merge'):
+            record('merge', times, points)
+        if enabled('aggregation'):
+            record('aggregation', timed(aggregate_districts, merged, paths['epsg25832'],
+                                        os.path.join(root, 'avg_temp_bezirke.csv'), force=True, repeat=repeat),
+                   points)
+        if enabled('ingest'):
+            for worker_count in workers:
+                record('ingest', timed(ingest_all, raw, os.path.join(root, 'ingest_25832'),
+                                       os.path.join(root, 'ingest_3857'), os.path.join(root, 'ingest_merged'),
+                                       max_workers=worker_count, force=True, repeat=repeat),
+                       points, worker_count=worker_count)
+
+        if enabled('create_heatmap'):
+            # Phases summed over all districts of the first hour
+            df = read_table(os.path.join(csv_3857, list_tables(csv_3857)[0]), heatmaps.HOUR_COLUMNS)
+            geometries = load_geometries(paths['epsg3857']).geometries
+            for resolution in resolutions:
+                runs = []
+                for _ in range(repeat):
+                    totals = {}
+                    for geometry in geometries:
+                        phases = run_quietly(heatmap_phases, df, geometry, resolution,
+                                             output_png=os.path.join(root, 'phase.png'))
+                        for phase, seconds in phases.items():
+                            totals[phase] = totals.get(phase, 0) + seconds
+                    runs.append(totals)
+                for phase in runs[0]:
+                    record('create_heatmap', [run[phase] for run in runs], points, phase=phase,
+                           resolution=resolution)
+
+        if enabled('heatmaps'):
+            for resolution in resolutions:
+                for worker_count in workers:
+                    record('heatmaps', timed(heatmaps.process_all_files, csv_3857, os.path.join(root, 'heatmaps'),
+                                             paths['epsg3857'], resolution, 'RdBu_r', 10, 36, worker_count,
+                                             renderer='direct', force=True, repeat=repeat),
+                           points, resolution=resolution, worker_count=worker_count)
+    return results
+
+def compare(results, baseline, threshold):
+    """Log the change of every measurement against a baseline result file; returns the number of regressions."""
+    previous = {tuple(result[field] for field in RESULT_KEY): result['seconds'] for result in baseline['results']}
+    regressions = 0
+    for result in results:
+        old = previous.get(tuple(result[field] for field in RESULT_KEY))
+        if not old:
+            continue
+        ratio = result['seconds'] / old
+        name = ' '.join(str(result[field]) for field in RESULT_KEY if result[field] is not None)
+        if ratio > 1 + threshold:
+            regressions += 1
+            logging.warning(f"Slower: {name}: {old:.3f} s -> {result['seconds']:.3f} s ({ratio:.2f}x)")
+        else:
+            logging.info(f"{name}: {old:.3f} s -> {result['seconds']:.3f} s ({ratio:.2f}x)")
+    return regressions
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on synthetic data and write the results as JSON")
+    parser.add_argument("--output", default='bench_results.json', help="Result file (JSON)")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10_000, 100_000], help="Points per hour")
+    parser.add_argument("--hours", type=int, default=3, help="Number of hourly files")
+    parser.add_argument("--resolutions", type=int, nargs='+', default=[500, 1000],
+                        help="Resolutions for create_heatmap and the heatmap run")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2],
+                        help="Worker counts for the parallel stages")
+    parser.add_argument("--districts", default='3x3', help="Synthetic districts as columns x rows")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per measurement (the fastest one counts)")
+    parser.add_argument("--stages", nargs='+', default=None,
+                        choices=['transform_to_csv', 'projection', 'merge', 'aggregation', 'ingest',
+                                 'create_heatmap', 'heatmaps'],
+                        help="Only record these stages (default: all)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data")
+    parser.add_argument("--work_dir", default=None, help="Keep the generated data and outputs in this folder (default: a temporary folder "
+                             "that is deleted afterwards)")
+    parser.add_argument("--baseline", default=None, help="Earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Report measurements more than this fraction slower than the baseline "
+                             "(exit code 1 if there are any)")
+    args = parser.parse_args()
+    try:
+        districts = parse_grid(args.districts)
+    except ValueError as e:
+        parser.error(str(e))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='heatmap_bench_')
+    try:
+        results = run_benchmarks(work_dir, args.sizes, args.hours, args.resolutions, args.workers, districts,
+                                 args.repeat, args.stages, args.seed)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'version': RESULT_VERSION, 'environment': environment(), 'config': vars(args), 'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} measurements to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
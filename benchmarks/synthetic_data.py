@@ -0,0 +1,189 @@
+import os
+import math
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import Polygon
+from merge_to_single_csv import FILE_PREFIX
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Lower left corner of the synthetic area in EPSG:25832 (Ruhr area) and point spacing in metres
+ORIGIN = (385000, 5705000)
+SPACING = 10
+
+# ntzg classes with their share of the points: the building classes the pipeline masks
+# (20, 21, 30, 32) plus sealed, open, green and water areas
+NTZG_CLASSES = {1: 0.25, 2: 0.15, 10: 0.15, 20: 0.1, 21: 0.1, 30: 0.08, 32: 0.07, 40: 0.05, 50: 0.05}
+
+# Temperature offset of the classes against open land (heat island, cooling by green and water)
+NTZG_OFFSET = {1: 1.5, 2: 0.0, 10: -1.0, 20: 2.0, 21: 2.0, 30: 2.5, 32: 2.5, 40: -2.0, 50: -1.5}
+
+# Size in metres of the blocks that share one ntzg class (before per point variation)
+BLOCK_SIZE = 50
+
+def raw_filename(timestamp):
+    """Name of the raw file of an hour, e.g. Tagesgang_..._Testdaten_2023_08_20_22uhr_N305.txt."""
+    return f"{FILE_PREFIX}{timestamp:%Y_%m_%d_%H}uhr_N305.txt"
+
+def point_grid(points, origin=ORIGIN, spacing=SPACING):
+    """x, y of a square grid of about points points, plus its bounds (x_min, y_min, x_max, y_max)."""
+    side = max(int(round(math.sqrt(points))), 2)
+    xs = origin[0] + spacing * np.arange(side)
+    ys = origin[1] + spacing * np.arange(side)
+    x, y = np.meshgrid(xs, ys)
+    return x.ravel(), y.ravel(), (xs[0], ys[0], xs[-1], ys[-1])
+
+def land_use(x, y, seed=0):
+    """ntzg class of every point: blocks of one class with some points of other classes."""
+    rng = np.random.default_rng([seed, 0])
+    classes = np.array(list(NTZG_CLASSES))
+    shares = np.array(list(NTZG_CLASSES.values()))
+    block_x = ((x - x.min()) // BLOCK_SIZE).astype(np.int64)
+    block_y = ((y - y.min()) // BLOCK_SIZE).astype(np.int64)
+    blocks = rng.choice(classes, size=(block_y.max() + 1, block_x.max() + 1), p=shares)
+    ntzg = blocks[block_y, block_x]
+    mixed = rng.random(len(x)) < 0.2
+    ntzg[mixed] = rng.choice(classes, size=mixed.sum(), p=shares)
+    return ntzg
+
+def hour_values(x, y, ntzg, timestamp, seed=0):
+    """temperatur, messung and genauigkeit of every point for one hour.
+
+    A daily cycle (warmest at 15 h) plus a smooth spatial field that is the same for
+    all hours, the offset of the land use class (stronger at night) and noise.
+    """
+    field_rng = np.random.default_rng([seed, 1])
+    field = np.zeros(len(x))
+    for _ in range(4):
+        wavelength = field_rng.uniform(300, 3000)
+        angle, phase = field_rng.uniform(0, 2 * np.pi, 2)
+        field += np.sin((x * np.cos(angle) + y * np.sin(angle)) / wavelength * 2 * np.pi + phase)
+    field *= 1.5
+
+    rng = np.random.default_rng([seed, 2, int(timestamp.timestamp())])
+    hour = timestamp.hour
+    daily = 22 + 7 * math.cos(2 * math.pi * (hour - 15) / 24)
+    heat_island = 1 + 0.5 * math.cos(2 * math.pi * hour / 24)
+    lookup = np.zeros(max(NTZG_OFFSET) + 1)
+    lookup[list(NTZG_OFFSET)] = list(NTZG_OFFSET.values())
+    offsets = lookup[ntzg]
+    temperatur = daily + field + heat_island * offsets + rng.normal(0, 0.3, len(x))
+    messung = temperatur + rng.normal(0, 0.2, len(x))
+    genauigkeit = rng.random(len(x))
+    return temperatur.round(3), messung.round(2), genauigkeit.round(3)
+
+def write_raw_files(output_folder, points, hours, start='2023-08-20 00:00', seed=0):
+    """Write hours raw Tagesgang files (tab separated, no header, EPSG:25832) with the same points.
+
+    Returns the paths of the files and the bounds of the points.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    x, y, bounds = point_grid(points)
+    ntzg = land_use(x, y, seed)
+    paths = []
+    for timestamp in pd.date_range(start, periods=hours, freq='h'):
+        temperatur, messung, genauigkeit = hour_values(x, y, ntzg, timestamp, seed)
+        path = os.path.join(output_folder, raw_filename(timestamp))
+        pd.DataFrame({'x': x, 'y': y, 'temperatur': temperatur, 'messung': messung,
+                      'genauigkeit': genauigkeit, 'ntzg': ntzg}).to_csv(path, sep='\t', header=False, index=False)
+        paths.append(path)
+    logging.info(f"Wrote {len(paths)} raw files with {len(x)} points to {output_folder}")
+    return paths, bounds
+
+def edge_points(a, b, key, segments, seed, amplitude):
+    """Points between the vertices a and b (excluded), offset perpendicular to the edge.
+
+    The offsets only depend on key (the sorted vertex ids), so both neighbours of an
+    edge get exactly the same boundary.
+    """
+    rng = np.random.default_rng([seed, 3, *key])
+    t = np.arange(1, segments) / segments
+    offsets = rng.uniform(-amplitude, amplitude, segments - 1) * np.sin(np.pi * t)
+    (ax, ay), (bx, by) = a, b
+    length = math.hypot(bx - ax, by - ay) or 1
+    normal = (-(by - ay) / length, (bx - ax) / length)
+    return [(ax + (bx - ax) * s + normal[0] * o, ay + (by - ay) * s + normal[1] * o) for s, o in zip(t, offsets)]
+
+def district_polygons(bounds, columns, rows, seed=0, segments=8):
+    """Polygons of a jittered columns x rows tessellation of bounds with irregular shared borders."""
+    rng = np.random.default_rng([seed, 4])
+    x_min, y_min, x_max, y_max = bounds
+    cell_x = (x_max - x_min) / columns
+    cell_y = (y_max - y_min) / rows
+    vx = x_min + cell_x * np.arange(columns + 1)[None, :] + np.zeros((rows + 1, 1))
+    vy = y_min + cell_y * np.arange(rows + 1)[:, None] + np.zeros((1, columns + 1))
+    # Interior vertices move freely, the outer ring stays on the bounds
+    vx[1:-1, 1:-1] += rng.uniform(-0.25, 0.25, (rows - 1, columns - 1)) * cell_x
+    vy[1:-1, 1:-1] += rng.uniform(-0.25, 0.25, (rows - 1, columns - 1)) * cell_y
+
+    def vertex(row, col):
+        return row * (columns + 1) + col, (vx[row, col], vy[row, col])
+
+    amplitude = 0.1 * min(cell_x, cell_y)
+    polygons = []
+    for row in range(rows):
+        for col in range(columns):
+            corners = [vertex(row, col), vertex(row, col + 1), vertex(row + 1, col + 1), vertex(row + 1, col)]
+            ring = []
+            for (id_a, a), (id_b, b) in zip(corners, corners[1:] + corners[:1]):
+                # Borders on the outline stay straight, so the districts cover the bounds
+                outer = (a[0] == b[0] and a[0] in (x_min, x_max)) or (a[1] == b[1] and a[1] in (y_min, y_max))
+                ring.append(a)
+                if outer:
+                    continue
+                if id_a < id_b:
+                    ring += edge_points(a, b, (id_a, id_b), segments, seed, amplitude)
+                else:
+                    ring += edge_points(b, a, (id_b, id_a), segments, seed, amplitude)[::-1]
+            polygons.append(shapely.make_valid(Polygon(ring)))
+    return polygons
+
+def write_districts(geodata_folder, bounds, columns, rows, seed=0):
+    """Write synthetic districts (gid, name) and their outline like the real geodata folder.
+
+    Creates epsg25832/statistische_bezirke_2020.geojson, epsg3857/statistische_bezirke_2020.geojson
+    and epsg3857/Gemarkungsgrenzen.geojson; returns the paths of the district files.
+    """
+    polygons = district_polygons(bounds, columns, rows, seed)
+    districts = gpd.GeoDataFrame({'gid': np.arange(1, len(polygons) + 1),
+                                  'name': [f"Bezirk {i}" for i in range(1, len(polygons) + 1)]},
+                                 geometry=polygons, crs='EPSG:25832')
+    outline = gpd.GeoDataFrame({'gid': [1], 'name': ['Gesamt']}, geometry=[shapely.union_all(polygons)],
+                               crs='EPSG:25832')
+
+    paths = {}
+    for crs, folder in (('EPSG:25832', 'epsg25832'), ('EPSG:3857', 'epsg3857')):
+        os.makedirs(os.path.join(geodata_folder, folder), exist_ok=True)
+        paths[folder] = os.path.join(geodata_folder, folder, 'statistische_bezirke_2020.geojson')
+        districts.to_crs(crs).to_file(paths[folder], driver='GeoJSON')
+    outline.to_crs('EPSG:3857').to_file(os.path.join(geodata_folder, 'epsg3857', 'Gemarkungsgrenzen.geojson'),
+                                        driver='GeoJSON')
+    logging.info(f"Wrote {len(polygons)} districts to {geodata_folder}")
+    return paths
+
+def parse_grid(value):
+    """(columns, rows) from 'CxR'."""
+    columns, rows = (int(part) for part in value.lower().split('x'))
+    if columns < 1 or rows < 1:
+        raise ValueError(f"District grid must be given as CxR with positive numbers, not {value!r}")
+    return columns, rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write synthetic raw Tagesgang files and district GeoJSONs (folder layout of the repository)")
+    parser.add_argument("--output_root", default='./synthetic',
+                        help="Folder that gets rawdata/Tagesgang/Full and geodata/ (use '.' to fill the repository)")
+    parser.add_argument("--points", type=int, default=100_000, help="Number of points per hour (square 10 m grid)")
+    parser.add_argument("--hours", type=int, default=24, help="Number of hourly files")
+    parser.add_argument("--start", default='2023-08-20 00:00', help="Time of the first hour")
+    parser.add_argument("--districts", default='4x3', help="Districts as columns x rows")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (same seed, same data)")
+    args = parser.parse_args()
+
+    _, bounds = write_raw_files(os.path.join(args.output_root, 'rawdata', 'Tagesgang', 'Full'), args.points,
+                                args.hours, args.start, args.seed)
+    write_districts(os.path.join(args.output_root, 'geodata'), bounds, *parse_grid(args.districts), seed=args.seed)
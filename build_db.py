@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import argparse
+import logging
+import duckdb
+import numpy as np
+import pandas as pd
+from geometry_cache import load_geometries
+from district_labels import cached_point_districts, cached_point_labels
+from columnar_store import read_table
+from partitioned_dataset import MERGED_FOLDER, to_table
+from build_manifest import content_hash, path_stat
+from aggregate_districts import EXCLUDED_NTZG, PET_OFFSET, list_hours
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Default paths (same inputs and CSV output as build_db.sql)
+input_folder = MERGED_FOLDER
+geojson_path = './geodata/epsg25832/statistische_bezirke_2020.geojson'
+database_file = './csvdata/temperature.duckdb'
+output_file = './aggregated/avg_temp_bezirke.csv'
+
+# Bump whenever the tables or the way the statistics are computed change (forces a full rebuild)
+SCHEMA_VERSION = 2
+
+RAW_COLUMNS = ['x', 'y', 'temperatur', 'messung', 'genauigkeit', 'ntzg']
+
+# Same tables as build_db.sql, plus the bookkeeping of the loaded hours and the statistics.
+# point_district has one row per point and district containing it (like the ST_Contains join, a point
+# in overlapping districts has several) and a row with gid NULL for points outside all districts.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS build_info (key VARCHAR PRIMARY KEY, value VARCHAR);
+CREATE TABLE IF NOT EXISTS temperature (
+    x INTEGER,
+    y INTEGER,
+    temperatur FLOAT,
+    messung FLOAT,
+    genauigkeit FLOAT,
+    ntzg SMALLINT,
+    date TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS hours (
+    date TIMESTAMP PRIMARY KEY,
+    source VARCHAR,
+    size BIGINT,
+    mtime_ns BIGINT,
+    hash VARCHAR,
+    rows BIGINT,
+    aggregated BOOLEAN
+);
+CREATE TABLE IF NOT EXISTS stadtbezirke (gid INTEGER PRIMARY KEY, name VARCHAR);
+CREATE TABLE IF NOT EXISTS point_district (x INTEGER, y INTEGER, gid INTEGER);
+CREATE TABLE IF NOT EXISTS district_stats (
+    gid INTEGER,
+    date TIMESTAMP,
+    avg_temp DOUBLE,
+    min_temp FLOAT,
+    max_temp FLOAT,
+    avg_pet DOUBLE,
+    min_pet FLOAT,
+    max_pet FLOAT,
+    PRIMARY KEY (gid, date)
+);
+CREATE OR REPLACE VIEW avg_temp_bezirke AS
+SELECT s.gid, s.name, d.date, d.avg_temp, d.min_temp, d.max_temp, d.avg_pet, d.min_pet, d.max_pet
+FROM district_stats d
+JOIN stadtbezirke s ON s.gid = d.gid;
+"""
+
+def get_info(con, key):
+    row = con.execute("SELECT value FROM build_info WHERE key = ?", [key]).fetchone()
+    return row[0] if row else None
+
+def set_info(con, key, value):
+    con.execute("INSERT OR REPLACE INTO build_info VALUES (?, ?)", [key, value])
+
+def open_database(path, memory_limit=None, force=False):
+    """Open (or create) the database; drops all tables when force is set or the schema version changed."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    con = duckdb.connect(path)
+    if memory_limit:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    tables = {row[0] for row in con.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+    if 'build_info' in tables and (force or get_info(con, 'schema_version') != str(SCHEMA_VERSION)):
+        logging.info(f"Rebuilding {path} from scratch")
+        con.execute("DROP VIEW IF EXISTS avg_temp_bezirke")
+        for table in ('build_info', 'temperature', 'hours', 'stadtbezirke', 'point_district', 'district_stats'):
+            con.execute(f"DROP TABLE IF EXISTS {table}")
+    con.execute(SCHEMA)
+    set_info(con, 'schema_version', str(SCHEMA_VERSION))
+    return con
+
+def update_districts(con, geojson_path, geometry_set):
+    """Replace the districts when the GeoJSON or the statistics settings changed.
+
+    All hours then have to be labelled and aggregated again. Returns True if they changed.
+    """
+    fingerprint = json.dumps({'geojson': content_hash(geojson_path), 'excluded_ntzg': EXCLUDED_NTZG,
+                              'pet_offset': PET_OFFSET})
+    if get_info(con, 'districts') == fingerprint:
+        return False
+
+    con.execute("BEGIN TRANSACTION")
+    con.execute("DELETE FROM stadtbezirke")
+    con.execute("DELETE FROM point_district")
+    con.execute("DELETE FROM district_stats")
+    con.execute("UPDATE hours SET aggregated = false")
+    con.executemany("INSERT INTO stadtbezirke VALUES (?, ?)",
+                    list(zip((int(gid) for gid in geometry_set.column('gid')), geometry_set.column('name'))))
+    set_info(con, 'districts', fingerprint)
+    con.execute("COMMIT")
+    logging.info(f"Loaded {len(geometry_set)} districts from {geojson_path}")
+    return True
+
+def load_hour(con, date_string_iso, path, stat, digest):
+    """Replace the rows of one hour with the content of path (one transaction)."""
+    date = pd.Timestamp(date_string_iso).to_pydatetime()
+    con.execute("BEGIN TRANSACTION")
+    con.execute("DELETE FROM temperature WHERE date = ?", [date])
+    if path.endswith('.parquet'):
+        # Partitions already have the schema of the table, DuckDB reads them directly
+        con.execute(f"INSERT INTO temperature SELECT {', '.join(RAW_COLUMNS)}, date FROM read_parquet(?)", [path])
+    else:
+        hour_table = to_table(read_table(path, RAW_COLUMNS), date_string_iso)
+        con.register('hour_table', hour_table)
+        con.execute(f"INSERT INTO temperature SELECT {', '.join(RAW_COLUMNS)}, date FROM hour_table")
+        con.unregister('hour_table')
+    rows = con.execute("SELECT count(*) FROM temperature WHERE date = ?", [date]).fetchone()[0]
+    con.execute("INSERT OR REPLACE INTO hours VALUES (?, ?, ?, ?, ?, ?, false)", [date, path, *stat, digest, rows])
+    con.execute("COMMIT")
+    return rows
+
+def load_hours(con, hours):
+    """Load the hours that are new or whose file changed. Returns the number of loaded hours."""
+    loaded = {row[0]: row[1:] for row in con.execute("SELECT date, size, mtime_ns, hash FROM hours").fetchall()}
+    count = 0
+    for date_string_iso, path in hours:
+        date = pd.Timestamp(date_string_iso).to_pydatetime()
+        stat = path_stat(path)
+        known = loaded.get(date)
+        if known and list(known[:2]) == stat:
+            continue
+
+        # Content hashes are only computed when the size or modification time changed
+        digest = content_hash(path)
+        if known and known[2] == digest:
+            con.execute("UPDATE hours SET source = ?, size = ?, mtime_ns = ? WHERE date = ?", [path, *stat, date])
+            continue
+
+        start_time = time.time()
+        rows = load_hour(con, date_string_iso, path, stat, digest)
+        count += 1
+        logging.info(f"Loaded {date_string_iso} ({rows} rows) in {time.time() - start_time:.2f} seconds")
+
+    missing = len(set(loaded) - {pd.Timestamp(date_string_iso).to_pydatetime() for date_string_iso, _ in hours})
+    if missing:
+        logging.info(f"{missing} hours in the database have no input file any more (kept)")
+    return count
+
+def date_filter(dates):
+    """WHERE condition of t.date for the given hours: a range (prunes row groups by their min/max) and the list."""
+    placeholders = ', '.join('?' for _ in dates)
+    return f"t.date BETWEEN ? AND ? AND t.date IN ({placeholders})", [min(dates), max(dates)] + list(dates)
+
+def label_new_points(con, dates, geometry_set, cache_dir=None):
+    """Add the district of every point of the hours that is not in point_district yet."""
+    condition, params = date_filter(dates)
+    points = con.execute(f"""
+        SELECT DISTINCT t.x, t.y
+        FROM temperature t
+        ANTI JOIN point_district p ON t.x = p.x AND t.y = p.y
+        WHERE {condition}
+        ORDER BY t.x, t.y""", params).fetchnumpy()
+    if not len(points['x']):
+        return
+
+    # The measurement points are the same for every hour, so this normally only runs for the first hour
+    labels = cached_point_labels(points['x'], points['y'], geometry_set.geometries, cache_dir)
+    members, districts = cached_point_districts(points['x'], points['y'], geometry_set.geometries, cache_dir)
+    outside = np.flatnonzero(labels < 0)
+    gids = np.array([int(gid) for gid in geometry_set.column('gid')], dtype=np.int64)
+    rows = np.concatenate([members, outside])
+    gid = pd.array(np.concatenate([gids[districts], np.zeros(len(outside), dtype=np.int64)]), dtype='Int64')
+    gid[len(members):] = pd.NA
+    con.register('new_points', pd.DataFrame({'x': points['x'][rows], 'y': points['y'][rows], 'gid': gid}))
+    con.execute("INSERT INTO point_district SELECT x, y, gid FROM new_points")
+    con.unregister('new_points')
+    logging.info(f"Labelled {len(labels)} new points ({len(labels) - len(outside)} inside a district, "
+                 f"{len(members)} point/district pairs)")
+
+def aggregate_hours(con, dates):
+    """Recompute the statistics of the hours and upsert them into district_stats (one transaction)."""
+    condition, params = date_filter(dates)
+    excluded = ', '.join(str(ntzg) for ntzg in EXCLUDED_NTZG)
+    con.execute("BEGIN TRANSACTION")
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE fresh_stats AS
+        SELECT
+            p.gid,
+            t.date,
+            AVG(t.temperatur) AS avg_temp,
+            MIN(t.temperatur) AS min_temp,
+            MAX(t.temperatur) AS max_temp,
+            AVG(t.temperatur+{PET_OFFSET}) AS avg_pet,
+            MIN(t.temperatur+{PET_OFFSET}) AS min_pet,
+            MAX(t.temperatur+{PET_OFFSET}) AS max_pet
+        FROM temperature t
+        JOIN point_district p
+            ON t.x = p.x AND t.y = p.y -- Precomputed spatial filter
+        WHERE {condition} AND p.gid IS NOT NULL AND t.ntzg NOT IN ({excluded})
+        GROUP BY p.gid, t.date""", params)
+    con.execute("INSERT OR REPLACE INTO district_stats SELECT * FROM fresh_stats")
+
+    # Districts without valid values in a reloaded hour lose their old row
+    condition, params = date_filter(dates)
+    con.execute(f"""
+        DELETE FROM district_stats AS t
+        WHERE {condition}
+        AND NOT EXISTS (SELECT 1 FROM fresh_stats f WHERE f.gid = t.gid AND f.date = t.date)""", params)
+    con.execute(f"UPDATE hours SET aggregated = true WHERE date IN ({', '.join('?' for _ in dates)})", list(dates))
+    con.execute("DROP TABLE fresh_stats")
+    con.execute("COMMIT")
+
+def export_csv(con, output_file):
+    """Write the statistics like build_db.sql (ORDER BY gid, date)."""
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    tmp_file = f"{output_file}.tmp-{os.getpid()}"
+    con.execute(f"COPY (SELECT * FROM avg_temp_bezirke ORDER BY gid, date) "
+                f"TO '{tmp_file}' (HEADER, DELIMITER ',')")
+    os.replace(tmp_file, output_file)
+
+def build_db(input_folder, geojson_path, database_file, output_file=None, cache_dir=None, memory_limit=None,
+             force=False):
+    """Bring the database up to date with the hours of input_folder.
+
+    Only new or changed hours are loaded, labelled and aggregated; output_file is
+    rewritten when the statistics changed (or is missing).
+    """
+    con = open_database(database_file, memory_limit, force)
+    try:
+        geometry_set = load_geometries(geojson_path, cache_dir)
+        changed = update_districts(con, geojson_path, geometry_set)
+        changed |= load_hours(con, list_hours(input_folder)) > 0
+
+        dates = [row[0] for row in con.execute("SELECT date FROM hours WHERE NOT aggregated ORDER BY date").fetchall()]
+        if dates:
+            start_time = time.time()
+            label_new_points(con, dates, geometry_set, cache_dir)
+            aggregate_hours(con, dates)
+            changed = True
+            logging.info(f"Aggregated {len(dates)} hours in {time.time() - start_time:.2f} seconds")
+        else:
+            logging.info(f"{database_file} is up to date")
+
+        if output_file and (changed or not os.path.exists(output_file)):
+            export_csv(con, output_file)
+            rows = con.execute("SELECT count(*) FROM district_stats").fetchone()[0]
+            logging.info(f"Wrote {rows} rows to {output_file}")
+        con.execute("CHECKPOINT")
+    finally:
+        con.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Keep a DuckDB database with the temperatures and the district statistics up to date "
+                    "(incremental version of build_db.sql)")
+    parser.add_argument("--input_folder", default=input_folder,
+                        help="Partitioned merged dataset or folder with per-hour EPSG:25832 files")
+    parser.add_argument("--geojson", default=geojson_path, help="District GeoJSON (EPSG:25832)")
+    parser.add_argument("--database", default=database_file, help="DuckDB database file (created if missing)")
+    parser.add_argument("--output_file", default=output_file,
+                        help="CSV export of the statistics ('' to only update the database)")
+    parser.add_argument("--cache_dir", default=None, help="Folder to cache the point labels and parsed geometries on disk")
+    parser.add_argument("--memory_limit", default='8GB', help="DuckDB memory limit (check the machine memory)")
+    parser.add_argument("--force", action="store_true", help="Rebuild the database from scratch")
+    args = parser.parse_args()
+
+    logging.info("Script started with the following arguments:")
+    for name, value in vars(args).items():
+        logging.info(f"{name}: {value}")
+
+    build_db(args.input_folder, args.geojson, args.database, args.output_file, args.cache_dir, args.memory_limit,
+             args.force)
+
+    logging.info("Script execution completed")
@@ -1,4 +1,5 @@
 -- Description: This script is used to build the database and load the data into the database
+-- build_db.py keeps a persistent database with the same tables up to date and only loads new hours
 
 -- Turn on the timer to measure the time taken to execute the queries
 .timer on
@@ -7,31 +8,46 @@
 INSTALL spatial;
 LOAD spatial;
 
---Set the memory limit to 48GB to speed up queries when using disk db
+--Set the memory limit (the aggregation below is a plain hash join, it no longer needs 48GB)
 --!!Check machine memory before setting memory limit!!
-SET memory_limit='48GB';
+SET memory_limit='8GB';
 
 --x,y,temperatur,messung,genauigkeit,ntzg,date
 
---Create the temp table
+--Scan the day/hour partitioned dataset written by merge_to_single_csv.py / ingest.py directly.
+--Filters on day/hour (e.g. WHERE day = '2023-08-20') only read the matching partitions.
+CREATE VIEW temperature AS
+SELECT x, y, temperatur, messung, genauigkeit, ntzg, date, day, hour
+FROM read_parquet('./csvdata/merged/*/*/*.parquet', hive_partitioning = true);
+
+--Old single CSV file (merge_to_single_csv.py --format csv)
 --pet,temp,latitude,longitude,ntzg,hour
-CREATE TABLE temperature (
-    x INTEGER,
-    y INTEGER,
-    temperatur FLOAT,
-    messung FLOAT,
-    genauigkeit FLOAT,
-    ntzg SMALLINT,
-    date DATETIME, 
-);
-COPY temperature FROM './csvdata/merged_data.csv';
+-- CREATE TABLE temperature (
+--     x INTEGER,
+--     y INTEGER,
+--     temperatur FLOAT,
+--     messung FLOAT,
+--     genauigkeit FLOAT,
+--     ntzg SMALLINT,
+--     date DATETIME, 
+-- );
+-- COPY temperature FROM './csvdata/merged_data.csv';
 
 
 CREATE TABLE stadtbezirke AS SELECT * FROM ST_Read('./geodata/epsg25832/statistische_bezirke_2020.geojson');
 
+--The measurement points are the same for every hour, so the point in polygon test is done
+--once for the unique coordinates. Points outside all districts are not part of the table.
+CREATE TABLE point_district AS
+SELECT p.x, p.y, s.gid
+FROM (SELECT DISTINCT x, y FROM temperature) p
+JOIN stadtbezirke s
+    ON ST_Contains(s.geom, ST_Point(p.x, p.y));
+
 --Show table schema after creation
 DESCRIBE temperature;
 DESCRIBE stadtbezirke;
+DESCRIBE point_district;
 
 -- Select the Avg() temperature for each hour in each stadtteil and save it to a CSV file
 -- Check Coordinate Reference System (CRS) mismatch!!
@@ -46,10 +62,12 @@ COPY(SELECT
     AVG(t.temperatur+5) AS avg_pet,
     MIN(t.temperatur+5) AS min_pet,
     MAX(t.temperatur+5) AS max_pet
-FROM stadtbezirke s
-JOIN temperature t 
-    ON ST_Contains(s.geom, ST_Point(t.x, t.y)) -- Spatial filter
-    AND t.ntzg NOT IN (20,21,30,32)
+FROM temperature t
+JOIN point_district p
+    ON t.x = p.x AND t.y = p.y -- Precomputed spatial filter
+JOIN stadtbezirke s
+    ON s.gid = p.gid
+WHERE t.ntzg NOT IN (20,21,30,32)
 GROUP BY s.gid, s.name, t.date 
 ORDER BY s.gid, t.date) TO './aggregated/avg_temp_bezirke.csv' (HEADER, DELIMITER ',');
 
@@ -61,10 +79,12 @@ ORDER BY s.gid, t.date) TO './aggregated/avg_temp_bezirke.csv' (HEADER, DELIMITE
 --     AVG(t.temperatur) AS avg_temp,
 --     MIN(t.temperatur) AS min_temp,
 --     MAX(t.temperatur) AS max_temp,
--- FROM stadtbezirke s
--- JOIN temperature t 
---     ON ST_Contains(s.geom, ST_Point(t.x, t.y)) -- Spatial filter
---     AND t.ntzg NOT IN (20,21,30,32)
+-- FROM temperature t
+-- JOIN point_district p
+--     ON t.x = p.x AND t.y = p.y -- Precomputed spatial filter
+-- JOIN stadtbezirke s
+--     ON s.gid = p.gid
+-- WHERE t.ntzg NOT IN (20,21,30,32)
 -- GROUP BY s.gid, s.name, t.date 
 -- ORDER BY s.gid, t.date) TO './testdata/aggregated/avg_temp_bezirke.csv' (HEADER, DELIMITER ',');
 
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+
+# One manifest per output folder
+MANIFEST_NAME = '.build_manifest.json'
+
+# Bump whenever the recorded fingerprints change meaning (forces a full rebuild)
+MANIFEST_VERSION = 1
+
+# Write the manifest at most this often while outputs are recorded (and always on save())
+SAVE_INTERVAL = 5.0
+
+# A manifest lock older than this (seconds) was left behind by a crashed run
+LOCK_TIMEOUT = 60.0
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock file (O_EXCL, so it also works between machines on a shared folder)."""
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(path).st_mtime > LOCK_TIMEOUT:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.05)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        os.remove(path)
+
+def iter_files(path):
+    """All files of a file or directory (columnar store, partition), sorted, without partial outputs."""
+    if not os.path.isdir(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if '.tmp-' not in name:
+                yield os.path.join(root, name)
+
+def path_stat(path):
+    """(size, mtime_ns) of a file, summed / maximised over the files of a directory."""
+    size = 0
+    mtime_ns = 0
+    for file_path in iter_files(path):
+        stat = os.stat(file_path)
+        size += stat.st_size
+        mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return [size, mtime_ns]
+
+def content_hash(path):
+    """sha1 over the content of a file or of all files of a directory."""
+    h = hashlib.sha1()
+    for file_path in iter_files(path):
+        if file_path != path:
+            h.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(1 << 24)
+                if not block:
+                    break
+                h.update(block)
+    return h.hexdigest()
+
+class BuildManifest:
+    """Remember which inputs and parameters every output of a folder was built from.
+
+    An output is current when it exists and was recorded with the same input content
+    hashes and parameters. Content hashes are only recomputed when the size or
+    modification time of an input changes. With force=True nothing is current.
+    Several runs can share a folder: save() merges with what the others recorded.
+    """
+
+    def __init__(self, folder, force=False):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.force = force
+        self.outputs, self.hashes = self.read()
+        self.recorded = {}
+        self.dirty = False
+        self.last_save = time.time()
+
+    def read(self):
+        """(outputs, hashes) stored on disk."""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    return manifest.get('outputs', {}), manifest.get('hashes', {})
+            except Exception as e:
+                logging.warning(f"Could not read build manifest {self.path}: {str(e)}")
+        return {}, {}
+
+    def key(self, path):
+        return os.path.relpath(path, self.folder).replace(os.sep, '/')
+
+    def input_hash(self, path):
+        key = self.key(path)
+        stat = path_stat(path)
+        cached = self.hashes.get(key)
+        if cached and cached[:2] == stat:
+            return cached[2]
+        digest = content_hash(path)
+        self.hashes[key] = stat + [digest]
+        self.dirty = True
+        return digest
+
+    def fingerprint(self, inputs, params=None):
+        """Content hashes of the input files / folders plus the parameters of an output."""
+        return {
+            'inputs': {self.key(path): self.input_hash(path) for path in inputs},
+            'params': json.loads(json.dumps(params or {})),
+        }
+
+    def is_current(self, output, fingerprint):
+        if self.force or not os.path.exists(output):
+            return False
+        return self.outputs.get(self.key(output)) == fingerprint
+
+    def record(self, output, fingerprint):
+        """Mark output as built from fingerprint (use the fingerprint taken before building)."""
+        self.outputs[self.key(output)] = fingerprint
+        self.recorded[self.key(output)] = fingerprint
+        self.dirty = True
+        if time.time() - self.last_save > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        with file_lock(f"{self.path}.lock"):
+            # Keep what other runs sharing the folder recorded in the meantime
+            outputs, hashes = self.read()
+            outputs.update(self.recorded)
+            hashes.update(self.hashes)
+            self.outputs, self.hashes = outputs, hashes
+            tmp_path = f"{self.path}.tmp-{os.getpid()}"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'outputs': self.outputs, 'hashes': self.hashes}, f)
+            os.replace(tmp_path, self.path)
+        self.dirty = False
+        self.last_save = time.time()
@@ -1,41 +1,25 @@
 import os
 import json
-import pandas as pd
-import geopandas as gpd
 import logging
-from pyproj import Transformer
 import argparse
+from geometry_cache import load_geometries
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def calculate_district_bounds(geojson_file, output_file):
+def calculate_district_bounds(geojson_file, output_file, cache_dir=None):
     try:
-        # Read the GeoJSON file with UTF-8 encoding
-        gdf = gpd.read_file(geojson_file, encoding='utf-8')
-        
-        # Ensure the GeoDataFrame is in Web Mercator (EPSG:3857)
-        if gdf.crs is None:
-            logging.warning("No CRS found in GeoJSON, assuming EPSG:3857")
-            gdf.set_crs(epsg=3857, inplace=True)
-        elif gdf.crs.to_string() != 'EPSG:3857':
-            gdf = gdf.to_crs(epsg=3857)
-
-        # Create transformer from EPSG:3857 to EPSG:4326 (for Leaflet)
-        transformer = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+        # Read the GeoJSON file (or its cached geometry set) in Web Mercator (EPSG:3857)
+        geometry_set = load_geometries(geojson_file, cache_dir, crs='EPSG:3857')
         
         # List to store results
         districts = []
         
-        # Calculate bounds for each district
-        for idx, district in gdf.iterrows():
-            bounds = district.geometry.bounds  # Returns (minx, miny, maxx, maxy)
-            
-            # Transform bounds to lat/lng
-            sw_lng, sw_lat = transformer.transform(bounds[0], bounds[1])
-            ne_lng, ne_lat = transformer.transform(bounds[2], bounds[3])
+        # Bounds of all districts transformed to lat/lng (for Leaflet) at once
+        for properties, bbox in zip(geometry_set.properties, geometry_set.leaflet_bounds()):
+            (sw_lat, sw_lng), (ne_lat, ne_lng) = bbox
             
-            district_name = str(district['name'])
-            district_gid = str(district['gid']) if 'gid' in district else None
+            district_name = str(properties['name'])
+            district_gid = str(properties['gid']) if 'gid' in properties else None
             
             if district_gid is None:
                 logging.warning(f"No GID found for district {district_name}")
@@ -61,6 +45,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate bounding boxes for districts")
     parser.add_argument("geojson_file", help="Path to GeoJSON file with district boundaries")
     parser.add_argument("output_file", help="Path to output JSON file")
+    parser.add_argument("--cache_dir", default=None, help="Folder to cache the parsed geometries on disk")
     
     args = parser.parse_args()
     
@@ -68,6 +53,6 @@ if __name__ == "__main__":
     logging.info(f"GeoJSON file: {args.geojson_file}")
     logging.info(f"Output file: {args.output_file}")
     
-    calculate_district_bounds(args.geojson_file, args.output_file)
+    calculate_district_bounds(args.geojson_file, args.output_file, args.cache_dir)
     
     logging.info("Script execution completed")
\ No newline at end of file
@@ -1,36 +1,30 @@
-import pandas as pd
 import logging
-from shapely.geometry import Point
-import geopandas as gpd
+from geometry_cache import load_geometries
+from district_labels import cached_point_labels
+from columnar_store import read_table
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def filter_points_with_geojson(df, geojson_path):
+def filter_points_with_geojson(df, geojson_path, cache_dir=None):
     try:
-        # Load the GeoJSON file as a GeoDataFrame
-        gdf = gpd.read_file(geojson_path)
+        # Load the GeoJSON file once (prepared geometries, optionally cached on disk)
+        geometry_set = load_geometries(geojson_path, cache_dir)
 
-        # Create a GeoDataFrame from the CSV data
-        points = [Point(xy) for xy in zip(df['x'], df['y'])]
-        df_geo = gpd.GeoDataFrame(df, geometry=points, crs=gdf.crs)
+        # Test against the union of all geometries (vectorized, no Point objects), so points on a
+        # border shared by two geometries are kept as well
+        labels = cached_point_labels(df['x'].to_numpy(), df['y'].to_numpy(), [geometry_set.area], cache_dir)
 
-        # Ensure CRS matches
-        if df_geo.crs != gdf.crs:
-            df_geo = df_geo.to_crs(gdf.crs)
-
-        # Perform spatial join to filter points that are within the GeoJSON boundaries
-        filtered_df = df_geo[df_geo.within(gdf.unary_union)]
-
-        # Drop geometry column and return the filtered DataFrame
-        return pd.DataFrame(filtered_df.drop(columns='geometry'))
+        # Keep the points that are within the GeoJSON boundaries
+        return df[labels == 0]
     except Exception as e:
         logging.error(f"Error filtering points with GeoJSON: {str(e)}")
         raise
 
 def calculate_bounds_from_file(csv_file, geojson_path):
     try:
-        df = pd.read_csv(csv_file)
+        # CSV file or columnar store
+        df = read_table(csv_file)
 
         # Filter points using the GeoJSON file
         df_filtered = filter_points_with_geojson(df, geojson_path)
@@ -0,0 +1,176 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+# A store is a directory <name>.npcols with one .npy file per column and a manifest.json
+STORE_SUFFIX = '.npcols'
+MANIFEST = 'manifest.json'
+
+# Compact dtypes for the Tagesgang columns
+COLUMN_DTYPES = {
+    'x': np.int32,
+    'y': np.int32,
+    'temperatur': np.float32,
+    'messung': np.float32,
+    'genauigkeit': np.float32,
+    'ntzg': np.int16,
+}
+
+def is_store(path):
+    return path.endswith(STORE_SUFFIX) and os.path.isfile(os.path.join(path, MANIFEST))
+
+def table_base(name):
+    """File or store name without its .csv / .npcols suffix."""
+    for suffix in ('.csv', STORE_SUFFIX):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+def list_tables(folder):
+    """All CSV files and stores in a folder (sorted)."""
+    return sorted(f for f in os.listdir(folder)
+                  if f.endswith('.csv') or is_store(os.path.join(folder, f)))
+
+def compact_columns(df):
+    """Convert columns to COLUMN_DTYPES.
+
+    Coordinates are only stored as int32 when they are whole numbers (EPSG:25832 raster);
+    projected coordinates are kept as float64.
+    """
+    columns = {}
+    for name in df.columns:
+        values = np.asarray(df[name])
+        dtype = COLUMN_DTYPES.get(name)
+        if name in ('x', 'y') and not np.array_equal(values, np.round(values)):
+            dtype = np.float64
+        columns[name] = values.astype(dtype) if dtype is not None else values
+    return columns
+
+def write_store(path, df, attrs=None):
+    """Write a DataFrame (or dict of arrays) as a store, replacing an existing one."""
+    columns = compact_columns(pd.DataFrame(df) if isinstance(df, dict) else df)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+
+    manifest = {
+        'rows': int(len(next(iter(columns.values())))) if columns else 0,
+        'columns': {name: str(values.dtype) for name, values in columns.items()},
+        'attrs': attrs or {},
+    }
+    with open(os.path.join(tmp_path, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST), encoding='utf-8') as f:
+        return json.load(f)
+
+def read_store(path, columns=None, mmap=True):
+    """Return a dict of column arrays, memory-mapped by default."""
+    manifest = read_manifest(path)
+    names = columns if columns is not None else list(manifest['columns'])
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None)
+            for name in names}
+
+def read_table(path, columns=None):
+    """Read a CSV file or a store as DataFrame."""
+    if is_store(path):
+        return pd.DataFrame(read_store(path, columns, mmap=False))
+    return pd.read_csv(path, usecols=columns)
+
+def write_table(path_base, df, output_format='csv', attrs=None):
+    """Write df as <path_base>.csv or <path_base>.npcols, returns the written path."""
+    if output_format == 'npy':
+        path = path_base + STORE_SUFFIX
+        write_store(path, df, attrs)
+    else:
+        path = path_base + '.csv'
+        df.to_csv(path, index=False)
+    return path
+
+class TableWriter:
+    """Write a CSV file or a store chunk by chunk with bounded memory.
+
+    For stores the total number of rows must be known up front; the columns are
+    memory-mapped .npy files filled chunk by chunk. Column dtypes are chosen from the
+    first chunk (see compact_columns). Output only appears under its final name on close().
+    """
+
+    def __init__(self, path_base, output_format='csv', rows=None, attrs=None):
+        self.output_format = output_format
+        self.path = path_base + (STORE_SUFFIX if output_format == 'npy' else '.csv')
+        self.tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        self.rows = rows
+        self.attrs = attrs or {}
+        self.offset = 0
+        self.columns = None
+        if output_format == 'npy' and rows is None:
+            raise ValueError("Row count is required to write a store")
+
+    def write(self, df):
+        if self.output_format != 'npy':
+            df.to_csv(self.tmp_path, mode='a' if self.offset else 'w', index=False, header=self.offset == 0)
+            self.offset += len(df)
+            return
+
+        chunk = compact_columns(df)
+        if self.columns is None:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            os.makedirs(self.tmp_path)
+            self.columns = {
+                name: np.lib.format.open_memmap(os.path.join(self.tmp_path, f"{name}.npy"), mode='w+',
+                                                dtype=values.dtype, shape=(self.rows,))
+                for name, values in chunk.items()
+            }
+
+        n = len(df)
+        for name, column in self.columns.items():
+            values = np.asarray(df[name])
+            converted = values.astype(column.dtype)
+            if column.dtype.kind in 'iu' and not np.array_equal(converted, values):
+                raise ValueError(f"Column {name} does not fit into {column.dtype}")
+            column[self.offset:self.offset + n] = converted
+        self.offset += n
+
+    def close(self):
+        """Finish the output and move it to its final name, returns the path."""
+        if self.rows is not None and self.offset != self.rows:
+            raise ValueError(f"Expected {self.rows} rows for {self.path}, got {self.offset}")
+
+        if self.output_format == 'npy':
+            manifest = {
+                'rows': self.offset,
+                'columns': {name: str(column.dtype) for name, column in (self.columns or {}).items()},
+                'attrs': self.attrs,
+            }
+            for column in (self.columns or {}).values():
+                column.flush()
+            self.columns = None
+            os.makedirs(self.tmp_path, exist_ok=True)
+            with open(os.path.join(self.tmp_path, MANIFEST), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
+            os.rename(self.tmp_path, self.path)
+        else:
+            if self.offset == 0:
+                open(self.tmp_path, 'w').close()
+            os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Remove partial output."""
+        self.columns = None
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
@@ -0,0 +1,131 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import shapely
+from lru_cache import LRUCache
+
+# Bump whenever the way labels are computed changes
+LABEL_VERSION = 1
+
+# Memory budget of the label arrays each process keeps (one or two per coordinate set)
+LABEL_CACHE_MB = 256
+
+_label_cache = LRUCache(LABEL_CACHE_MB << 20, lambda array: array.nbytes)
+
+def label_points(x_coords, y_coords, geometries):
+    """Return the index of the geometry containing each point, -1 for points outside all geometries.
+
+    Uses prepared geometries and vectorized contains_xy tests on the points inside each
+    geometry's bounding box, so no Shapely Point objects are created. Points inside several
+    (overlapping) geometries get the lowest index; point_districts has all of them.
+    """
+    x_coords = np.asarray(x_coords, dtype=np.float64)
+    y_coords = np.asarray(y_coords, dtype=np.float64)
+    labels = np.full(len(x_coords), -1, dtype=np.int32)
+
+    # Sort once by x so every bounding box only touches its own slice of points
+    order = np.argsort(x_coords, kind='stable')
+    x_sorted = x_coords[order]
+
+    for index, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        shapely.prepare(geometry)
+        x_min, y_min, x_max, y_max = geometry.bounds
+        lo = np.searchsorted(x_sorted, x_min, side='left')
+        hi = np.searchsorted(x_sorted, x_max, side='right')
+        candidates = order[lo:hi]
+        candidates = candidates[(labels[candidates] < 0)
+                                & (y_coords[candidates] >= y_min) & (y_coords[candidates] <= y_max)]
+        inside = shapely.contains_xy(geometry, x_coords[candidates], y_coords[candidates])
+        labels[candidates[inside]] = index
+
+    return labels
+
+def labels_key(x_coords, y_coords, geometries):
+    """Hash the coordinate set and the geometries."""
+    h = hashlib.sha1(str(LABEL_VERSION).encode())
+    h.update(np.ascontiguousarray(x_coords, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(y_coords, dtype=np.float64).tobytes())
+    for geometry in geometries:
+        h.update(shapely.to_wkb(geometry) if geometry is not None else b'')
+    return h.hexdigest()
+
+def overlapping_pairs(geometries):
+    """(i, j) with i < j of all geometries whose interiors intersect (not just touch)."""
+    geometries = np.asarray(geometries, dtype=object)
+    left, right = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+    keep = left < right
+    left, right = left[keep], right[keep]
+    interior = shapely.relate_pattern(geometries[left], geometries[right], 'T********')
+    return [(int(i), int(j)) for i, j in zip(left[interior], right[interior])]
+
+def point_districts(x_coords, y_coords, geometries, labels=None):
+    """Every (point, geometry) pair of a point and a geometry containing it, like an ST_Contains join.
+
+    Returns (points, districts) index arrays sorted by district, then point. A point inside
+    several overlapping geometries appears once per geometry. Only the points labelled with
+    the lower index of an overlapping pair are tested again, so without overlaps this costs
+    no more than label_points (labels can be passed if they are already known).
+    """
+    x_coords = np.asarray(x_coords, dtype=np.float64)
+    y_coords = np.asarray(y_coords, dtype=np.float64)
+    if labels is None:
+        labels = label_points(x_coords, y_coords, geometries)
+
+    points = [np.flatnonzero(labels >= 0)]
+    districts = [labels[points[0]]]
+    for i, j in overlapping_pairs(geometries):
+        x_min, y_min, x_max, y_max = geometries[j].bounds
+        candidates = np.flatnonzero(labels == i)
+        candidates = candidates[(x_coords[candidates] >= x_min) & (x_coords[candidates] <= x_max)
+                                & (y_coords[candidates] >= y_min) & (y_coords[candidates] <= y_max)]
+        inside = candidates[shapely.contains_xy(geometries[j], x_coords[candidates], y_coords[candidates])]
+        points.append(inside)
+        districts.append(np.full(len(inside), j, dtype=np.int32))
+
+    points = np.concatenate(points).astype(np.int64)
+    districts = np.concatenate(districts).astype(np.int32)
+    order = np.lexsort((points, districts))
+    return points[order], districts[order]
+
+def district_members(pairs, index):
+    """Indices of the points inside geometry index, from the (points, districts) of point_districts."""
+    points, districts = pairs
+    return points[np.searchsorted(districts, index, side='left'):np.searchsorted(districts, index, side='right')]
+
+def cached_array(name, key, compute, cache_dir=None):
+    """compute(), computed only once per key (in memory up to LABEL_CACHE_MB and optionally on disk as name_key.npy)."""
+    def load_or_compute():
+        path = os.path.join(cache_dir, f"{name}_{key}.npy") if cache_dir else None
+        if path and os.path.exists(path):
+            try:
+                return np.load(path)
+            except Exception as e:
+                logging.warning(f"Could not load point {name} {path}: {str(e)}")
+
+        array = compute()
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.tmp-{os.getpid()}.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+        return array
+
+    return _label_cache.get((name, key), load_or_compute)
+
+def cached_point_labels(x_coords, y_coords, geometries, cache_dir=None):
+    """label_points, computed only once per coordinate set (in memory and optionally on disk)."""
+    key = labels_key(x_coords, y_coords, geometries)
+    return cached_array('labels', key, lambda: label_points(x_coords, y_coords, geometries), cache_dir)
+
+def cached_point_districts(x_coords, y_coords, geometries, cache_dir=None):
+    """point_districts as one (2, pairs) array (points, districts), computed only once per coordinate set."""
+    key = labels_key(x_coords, y_coords, geometries)
+
+    def compute():
+        labels = cached_point_labels(x_coords, y_coords, geometries, cache_dir)
+        return np.stack(point_districts(x_coords, y_coords, geometries, labels))
+
+    return cached_array('districts', key, compute, cache_dir)
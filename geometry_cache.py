@@ -0,0 +1,212 @@
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
+import geopandas as gpd
+import shapely
+from rasterio import features
+from affine import Affine
+from pyproj import Transformer
+from build_manifest import content_hash, path_stat
+
+# Bump whenever the stored geometry sets or masks change meaning
+GEOMETRY_VERSION = 1
+
+# Number of raster masks each process keeps in memory (bit-packed)
+MASK_CACHE_SIZE = 32
+
+_geometry_cache = {}
+_mask_cache = OrderedDict()
+
+def image_size(bounds, resolution):
+    """(width, height) of an image of bounds at resolution (longer side, aspect ratio kept)."""
+    x_min, y_min, x_max, y_max = bounds
+    data_aspect_ratio = (y_max - y_min) / (x_max - x_min)
+    if data_aspect_ratio > 9/16:
+        height = resolution
+        width = int(height / data_aspect_ratio)
+    else:
+        width = resolution
+        height = int(width * data_aspect_ratio)
+    return width, height
+
+def geometry_hash(geometry):
+    return hashlib.sha1(shapely.to_wkb(geometry)).hexdigest()
+
+def rasterize_mask(geometry, width, height, bounds):
+    """Pixels of a width x height grid over bounds touched by geometry (row 0 = y_min)."""
+    x_min, y_min, x_max, y_max = bounds
+    transform = Affine.translation(x_min, y_min) * Affine.scale(
+        (x_max - x_min) / width,
+        (y_max - y_min) / height
+    )
+    mask = features.rasterize(
+        [(geometry, 1)],
+        out_shape=(height, width),
+        transform=transform,
+        fill=0,
+        all_touched=True,
+        dtype=np.uint8
+    )
+    return mask.view(bool)
+
+def mask_rows(packed, width, row0, row1):
+    """Rows row0..row1 of a mask packed with np.packbits (see packed_raster_mask)."""
+    start, end = row0 * width, row1 * width
+    bits = np.unpackbits(packed[start // 8:(end + 7) // 8])
+    return bits[start % 8:start % 8 + end - start].reshape(row1 - row0, width).view(bool)
+
+def packed_raster_mask(geometry, width, height, bounds, cache_dir=None):
+    """rasterize_mask packed into bits, computed only once per geometry and grid (in memory and optionally on disk)."""
+    h = hashlib.sha1(repr((GEOMETRY_VERSION, int(width), int(height), tuple(float(b) for b in bounds))).encode())
+    h.update(shapely.to_wkb(geometry))
+    key = h.hexdigest()
+
+    packed = _mask_cache.get(key)
+    if packed is not None:
+        _mask_cache.move_to_end(key)
+        return packed
+
+    mask_path = os.path.join(cache_dir, f"mask_{key}.npy") if cache_dir else None
+    if mask_path and os.path.exists(mask_path):
+        try:
+            packed = np.load(mask_path)
+        except Exception as e:
+            logging.warning(f"Could not load raster mask {mask_path}: {str(e)}")
+
+    if packed is None:
+        packed = np.packbits(rasterize_mask(geometry, width, height, bounds))
+        if mask_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{mask_path}.tmp-{os.getpid()}.npy"
+            np.save(tmp_path, packed)
+            os.replace(tmp_path, mask_path)
+
+    _mask_cache[key] = packed
+    while len(_mask_cache) > MASK_CACHE_SIZE:
+        _mask_cache.popitem(last=False)
+    return packed
+
+def raster_mask(geometry, width, height, bounds, cache_dir=None):
+    """rasterize_mask, computed only once per geometry and grid (see packed_raster_mask)."""
+    return mask_rows(packed_raster_mask(geometry, width, height, bounds, cache_dir), width, 0, height)
+
+class GeometrySet:
+    """The features of a GeoJSON file with everything derived from their geometries.
+
+    geometries are prepared Shapely geometries, bounds an (n, 4) array and properties
+    one dict per feature. The union of all geometries is computed on first use.
+    """
+
+    def __init__(self, key, crs, geometries, properties, cache_dir=None):
+        self.key = key
+        self.crs = crs
+        self.geometries = geometries
+        self.properties = properties
+        self.bounds = shapely.bounds(geometries)
+        self.cache_dir = cache_dir
+        self._area = None
+        shapely.prepare(geometries)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def column(self, name):
+        """Values of a property for all features (None where it is missing)."""
+        return [properties.get(name) for properties in self.properties]
+
+    @property
+    def area(self):
+        """Union of all geometries (stored next to the geometry set in cache_dir)."""
+        if self._area is None:
+            area_path = os.path.join(self.cache_dir, f"geometry_{self.key}_area.wkb") if self.cache_dir else None
+            if area_path and os.path.exists(area_path):
+                with open(area_path, 'rb') as f:
+                    self._area = shapely.from_wkb(f.read())
+            else:
+                self._area = shapely.union_all(self.geometries)
+                if area_path:
+                    write_file(area_path, shapely.to_wkb(self._area))
+            shapely.prepare(self._area)
+        return self._area
+
+    def image_sizes(self, resolution):
+        """(width, height) of every feature's image at resolution (see image_size)."""
+        return [image_size(bounds, resolution) for bounds in self.bounds]
+
+    def leaflet_bounds(self):
+        """[[south, west], [north, east]] of every feature in EPSG:4326 for Leaflet."""
+        transformer = Transformer.from_crs(self.crs or "EPSG:3857", "EPSG:4326", always_xy=True)
+        west, south = transformer.transform(self.bounds[:, 0], self.bounds[:, 1])
+        east, north = transformer.transform(self.bounds[:, 2], self.bounds[:, 3])
+        return [[[float(s), float(w)], [float(n), float(e)]] for s, w, n, e in zip(south, west, north, east)]
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def json_value(value):
+    # NumPy scalars and other values GeoJSON properties can be read as
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def read_geojson(geojson_path, crs=None):
+    """(crs, geometries, properties) read with geopandas, reprojected to crs if given.
+
+    A file without CRS is assumed to be in crs.
+    """
+    gdf = gpd.read_file(geojson_path, encoding='utf-8')
+    if crs is not None:
+        if gdf.crs is None:
+            logging.warning(f"No CRS found in {geojson_path}, assuming {crs}")
+            gdf = gdf.set_crs(crs)
+        elif gdf.crs != crs:
+            gdf = gdf.to_crs(crs)
+    properties = json.loads(json.dumps(gdf.drop(columns=gdf.geometry.name).to_dict('records'), default=json_value))
+    return (gdf.crs.to_string() if gdf.crs is not None else None), gdf.geometry.values.to_numpy(), properties
+
+def load_geometries(geojson_path, cache_dir=None, crs=None):
+    """Load a GeoJSON file as GeometrySet, at most once per process and file content.
+
+    With cache_dir the geometries (WKB) and properties are stored there, keyed by the
+    hash of the file, so later runs and other scripts skip parsing the GeoJSON.
+    """
+    memory_key = (os.path.abspath(geojson_path), tuple(path_stat(geojson_path)), crs, cache_dir)
+    if memory_key in _geometry_cache:
+        return _geometry_cache[memory_key]
+
+    h = hashlib.sha1(repr((GEOMETRY_VERSION, crs)).encode())
+    h.update(content_hash(geojson_path).encode())
+    key = h.hexdigest()
+
+    geometry_set = None
+    set_path = os.path.join(cache_dir, f"geometry_{key}.npz") if cache_dir else None
+    if set_path and os.path.exists(set_path):
+        try:
+            with np.load(set_path) as stored:
+                wkb = stored['wkb'].tobytes()
+                offsets = stored['offsets']
+                info = json.loads(str(stored['info']))
+            geometries = shapely.from_wkb([wkb[start:end] or None for start, end in zip(offsets[:-1], offsets[1:])])
+            geometry_set = GeometrySet(key, info['crs'], geometries, info['properties'], cache_dir)
+        except Exception as e:
+            logging.warning(f"Could not load geometry set {set_path}: {str(e)}")
+
+    if geometry_set is None:
+        file_crs, geometries, properties = read_geojson(geojson_path, crs)
+        geometry_set = GeometrySet(key, file_crs, geometries, properties, cache_dir)
+        if set_path:
+            blobs = [shapely.to_wkb(geometry) or b'' for geometry in geometries]
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{set_path}.tmp-{os.getpid()}.npz"
+            np.savez(tmp_path, wkb=np.frombuffer(b''.join(blobs), dtype=np.uint8),
+                     offsets=np.cumsum([0] + [len(blob) for blob in blobs]),
+                     info=np.array(json.dumps({'crs': file_crs, 'properties': properties})))
+            os.replace(tmp_path, set_path)
+
+    _geometry_cache[memory_key] = geometry_set
+    return geometry_set
@@ -0,0 +1,227 @@
+import os
+import hashlib
+import logging
+from io import BytesIO
+import numpy as np
+from lru_cache import LRUCache
+from columnar_store import list_tables, read_table, table_base
+from merge_to_single_csv import parse_file_date
+from geometry_cache import geometry_hash, image_size, load_geometries, raster_mask
+from district_labels import cached_point_districts, district_members
+from interpolation_plan import InterpolationPlan, PointTriangulation
+from png_renderer import canvas_indices, canvas_lut, colormap_indices, colormap_lut, save_indexed_png
+from heatmap_generator_unified import DERIVED_VARIABLES, VALUE_COLUMNS, heatmap_colormap, variable_values
+
+# Default memory budgets of the caches in MB
+HOUR_CACHE_MB = 512
+TRIANGULATION_CACHE_MB = 1024
+PLAN_CACHE_MB = 256
+
+def hour_nbytes(hour):
+    return sum(column.nbytes for column in hour['columns'].values())
+
+def plan_nbytes(entry):
+    """Bytes of a plan or of a (district points, pixel mask, plan) entry."""
+    if isinstance(entry, tuple):
+        return sum(part.nbytes for part in entry)
+    return entry.nbytes
+
+def check_variable(variable):
+    if variable not in VALUE_COLUMNS and variable not in DERIVED_VARIABLES:
+        raise ValueError(f"Unknown variable {variable!r} "
+                         f"(available: {', '.join(VALUE_COLUMNS + list(DERIVED_VARIABLES))})")
+
+def encode(indices, lut, png_format, compress_level):
+    png = BytesIO()
+    save_indexed_png(indices, lut, png, png_format, compress_level)
+    return png.getvalue()
+
+class HeatmapRenderer:
+    """Render heatmaps of any view (hour, bounds, resolution) on demand, without writing files.
+
+    input_folder holds the EPSG:3857 hour files (CSV or .npcols). Parsed hours, the
+    triangulations of their points and the interpolation plans of the views are kept in
+    LRU caches bounded in MB. Hours with the same points share triangulations and plans,
+    so a known view of another hour, variable or colormap only applies the weights and
+    encodes; a new view of known points only looks up its pixels in the triangulation.
+    With geojson_path the views are clipped to the union of its geometries, and its
+    districts can be rendered exactly like the heatmap generator does (render_district).
+    """
+
+    def __init__(self, input_folder, geojson_path=None, cache_dir=None, hour_cache_mb=HOUR_CACHE_MB,
+                 triangulation_cache_mb=TRIANGULATION_CACHE_MB, plan_cache_mb=PLAN_CACHE_MB):
+        self.input_folder = input_folder
+        self.cache_dir = cache_dir
+        self.geometry_set = load_geometries(geojson_path, cache_dir) if geojson_path else None
+        self.area = self.geometry_set.area if self.geometry_set is not None else None
+        self.area_key = geometry_hash(self.area) if self.area is not None else None
+
+        # Hours are named by their time (e.g. 2023-08-20T22:00:00) or, without one, by the file name
+        self.files = {}
+        for filename in list_tables(input_folder):
+            try:
+                self.files[parse_file_date(filename)] = filename
+            except Exception:
+                self.files[table_base(filename)] = filename
+        logging.info(f"Found {len(self.files)} hours in {input_folder}")
+
+        self.hour_cache = LRUCache(hour_cache_mb << 20, hour_nbytes)
+        self.triangulation_cache = LRUCache(triangulation_cache_mb << 20, lambda triangulation: triangulation.nbytes)
+        self.plan_cache = LRUCache(plan_cache_mb << 20, plan_nbytes)
+
+    def hours(self):
+        """Names of the available hours, sorted."""
+        return sorted(self.files)
+
+    def filename(self, hour):
+        """File of an hour given by its name (see hours()), its index in hours(), file name or file name
+        without extension."""
+        if isinstance(hour, (int, np.integer)):
+            names = self.hours()
+            if not 0 <= hour < len(names):
+                raise ValueError(f"Hour index {hour} out of range (0 to {len(names) - 1})")
+            return self.files[names[hour]]
+        if hour in self.files:
+            return self.files[hour]
+        for filename in self.files.values():
+            if hour in (filename, table_base(filename)):
+                return filename
+        raise ValueError(f"Unknown hour {hour!r}")
+
+    def hour(self, hour):
+        """Columns of an hour and the key of its points (coordinates and building mask), parsed once."""
+        filename = self.filename(hour)
+
+        def read():
+            df = read_table(os.path.join(self.input_folder, filename), ['x', 'y', 'ntzg'] + VALUE_COLUMNS)
+            columns = {name: np.asarray(df[name]) for name in df.columns}
+            columns['x'] = columns['x'].astype(np.float64)
+            columns['y'] = columns['y'].astype(np.float64)
+            building_mask = np.isin(columns['ntzg'], [20, 21, 30, 32])
+            h = hashlib.sha1()
+            for array in (columns['x'], columns['y'], np.packbits(building_mask)):
+                h.update(np.ascontiguousarray(array).tobytes())
+            return {'columns': columns, 'building_mask': building_mask, 'points': h.hexdigest()}
+
+        return self.hour_cache.get(filename, read)
+
+    def plan(self, hour, bounds, width, height):
+        """Interpolation plan of the pixel centres of a width x height view of bounds (only pixels in the area)."""
+        data = self.hour(hour)
+        x_min, y_min, x_max, y_max = bounds
+        pixel_x = (x_max - x_min) / width
+        pixel_y = (y_max - y_min) / height
+        centres = (x_min + pixel_x / 2, y_min + pixel_y / 2, x_max - pixel_x / 2, y_max - pixel_y / 2)
+        key = (data['points'], tuple(float(b) for b in bounds), width, height, self.area_key)
+
+        def build():
+            triangulation = self.triangulation_cache.get(
+                data['points'], lambda: PointTriangulation(data['columns']['x'], data['columns']['y'],
+                                                           data['building_mask']))
+            pixel_mask = None
+            if self.area is not None:
+                pixel_mask = raster_mask(self.area, width, height, bounds, self.cache_dir)
+            return InterpolationPlan.from_triangulation(triangulation, centres, width, height, pixel_mask)
+
+        return self.plan_cache.get(key, build)
+
+    def grid(self, hour, bounds, resolution, variable='temperatur', vmin=10):
+        """Values of a view (row 0 = south): NaN outside the data and the area, vmin - 1 on buildings."""
+        x_min, y_min, x_max, y_max = bounds
+        if not (x_max > x_min and y_max > y_min):
+            raise ValueError(f"Bounds must be (x_min, y_min, x_max, y_max) with x_min < x_max and y_min < y_max, "
+                             f"not {bounds!r}")
+        check_variable(variable)
+        width, height = image_size(bounds, resolution)
+        if width < 1 or height < 1:
+            raise ValueError(f"Resolution {resolution} is too small for bounds {bounds!r}")
+
+        data = self.hour(hour)
+        plan = self.plan(hour, bounds, width, height)
+        grid = plan.linear(variable_values(data['columns'], variable))
+        grid[plan.nearest_neighbour(data['building_mask'], fill_value=False)] = vmin - 1  # Buildings
+        return grid
+
+    def render(self, hour, bounds, resolution, cmap='RdBu_r', vmin=10, vmax=36, variable='temperatur',
+               png_format='palette', compress_level=6):
+        """PNG (bytes) of variable in an hour within bounds (EPSG:3857: x_min, y_min, x_max, y_max).
+
+        resolution is the size of the image as for create_heatmap (see image_size). Colours
+        as in the heatmaps: black buildings, transparent outside the data and the area.
+        Indexed PNGs by default (same pixels as 'rgba', but encoded about three times faster).
+        """
+        grid = self.grid(hour, bounds, resolution, variable, vmin)
+        custom_cmap = heatmap_colormap(cmap)
+        indices = colormap_indices(grid, vmin - 1, vmax, custom_cmap.N)[::-1]
+        return encode(indices, colormap_lut(custom_cmap), png_format, compress_level)
+
+    def district(self, district):
+        """Index of a district of the GeoJSON given by its gid."""
+        if self.geometry_set is None:
+            raise ValueError("No districts, the renderer was created without geojson_path")
+        for index, gid in enumerate(self.geometry_set.column('gid')):
+            if gid == district or str(gid) == str(district):
+                return index
+        raise ValueError(f"Unknown district {district!r}")
+
+    def district_plan(self, hour, district, width, height):
+        """(indices of the points in the district, district mask, plan) for a width x height image of a district.
+
+        The same points, grid and plan as create_heatmap uses for the district.
+        """
+        data = self.hour(hour)
+        index = self.district(district)
+        geometry = self.geometry_set.geometries[index]
+        key = (data['points'], self.geometry_set.key, index, width, height)
+
+        def build():
+            columns = data['columns']
+            pairs = cached_point_districts(columns['x'], columns['y'], self.geometry_set.geometries, self.cache_dir)
+            members = district_members(pairs, index)
+            if not len(members):
+                raise ValueError(f"No points within district {district!r} in hour {hour!r}")
+            triangulation = PointTriangulation(columns['x'][members], columns['y'][members],
+                                               data['building_mask'][members])
+            pixel_mask = raster_mask(geometry, width, height, geometry.bounds, self.cache_dir)
+            return members, pixel_mask, InterpolationPlan.from_triangulation(triangulation, geometry.bounds, width,
+                                                                             height, pixel_mask)
+
+        return self.plan_cache.get(key, build)
+
+    def district_grid(self, hour, district, resolution=5120, variable='temperatur', vmin=10):
+        """Values of a district as create_heatmap interpolates them (row 0 = south), with its bounds."""
+        check_variable(variable)
+        index = self.district(district)
+        bounds = self.geometry_set.geometries[index].bounds
+        width, height = image_size(bounds, resolution)
+        if width < 1 or height < 1:
+            raise ValueError(f"Resolution {resolution} is too small for district {district!r}")
+
+        data = self.hour(hour)
+        members, pixel_mask, plan = self.district_plan(hour, district, width, height)
+        grid = plan.linear(variable_values(data['columns'], variable)[members])
+        grid[~pixel_mask] = np.nan  # Outside the district
+        grid[plan.nearest_neighbour(data['building_mask'][members], fill_value=False) & pixel_mask] = vmin - 1
+        return grid, bounds
+
+    def render_district(self, hour, district, resolution=5120, cmap='RdBu_r', vmin=10, vmax=36,
+                        variable='temperatur', png_format='palette', compress_level=6):
+        """PNG (bytes) of a district (by gid) in an hour, with the pixels of the heatmap generator's file.
+
+        Same image as heatmap_generator_unified.py with --resolution for that district (any
+        renderer); with png_format and compress_level as there even byte for byte
+        (--renderer direct).
+        """
+        grid, (x_min, y_min, x_max, y_max) = self.district_grid(hour, district, resolution, variable, vmin)
+        custom_cmap = heatmap_colormap(cmap)
+        indices = canvas_indices(grid, (x_min, x_max, y_min, y_max), custom_cmap.N, vmin - 1, vmax, self.cache_dir)
+        return encode(indices, canvas_lut(custom_cmap), png_format, compress_level)
+
+    def cache_info(self):
+        """Hits, misses, evictions, entries and bytes of the hour, triangulation and plan caches."""
+        return {'hours': self.hour_cache.info(), 'triangulations': self.triangulation_cache.info(),
+                'plans': self.plan_cache.info()}
+
+    def clear_cache(self):
+        for cache in (self.hour_cache, self.triangulation_cache, self.plan_cache):
+            cache.clear()
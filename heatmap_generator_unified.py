@@ -1,193 +1,1086 @@
 import os
+import sys
+import math
+import json
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
 import logging
 from tqdm import tqdm
 from matplotlib.colors import ListedColormap
-import geopandas as gpd
-from shapely.geometry import Point
-from rasterio import features
-from affine import Affine
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from itertools import product
+from pyproj import Transformer
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from interpolation_plan import (PLAN_CACHE_MB, InterpolationPlan, get_interpolation_plan, get_stored_plan,
+                                set_plan_cache_mb)
+from district_labels import label_points, cached_point_labels, cached_point_districts, district_members
+from png_renderer import (BackgroundWriter, canvas_indices, canvas_lut, colormap_indices, colormap_lut,
+                          save_indexed_png, stream_png)
+from raster_cube import CUBE_SUFFIX, create_cube, is_cube, open_cube, read_manifest, write_hour, write_manifest
+from merge_to_single_csv import parse_file_date
+from tile_pyramid import TILE_SIZE, tile_bounds, tile_range, tile_span, write_tile_pyramid
+from PIL import Image
+from columnar_store import is_store, list_tables, read_table, table_base
+from build_manifest import BuildManifest
+from work_queue import WorkQueue, bounded_map, claim_key, in_shard, parse_shard, partitioned_map, verify_outputs
+from geometry_cache import geometry_hash, image_size, load_geometries, mask_rows, packed_raster_mask, raster_mask
+from aggregate_districts import PET_OFFSET
+from run_metrics import MeteredPool, annotate, configure_metrics, measure_run, metrics_settings, phase, task
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+_colormaps = {}
+
 def create_custom_colormap(cmap_name):
     base_cmap = plt.get_cmap(cmap_name)
     colors = base_cmap(np.linspace(0, 1, 256))
     colors = np.vstack(([0, 0, 0, 1], colors))  # Add black color at the beginning!!
     return ListedColormap(colors)
 
-def create_raster_mask(geometry, width, height, bounds):
-    """Create a raster mask for a geometry."""
-    x_min, y_min, x_max, y_max = bounds
-    transform = Affine.translation(x_min, y_min) * Affine.scale(
-        (x_max - x_min) / width, 
-        (y_max - y_min) / height
-    )
+def save_matplotlib_png(temp_grid, extent, custom_cmap, vmin, vmax, width, height, output_png, compress_level=6):
+    """Render the grid through a matplotlib figure."""
+    # Set up figure with higher DPI
+    dpi = 100  # Increased DPI
+    
+    # Calculate figure size to maintain pixel dimensions
+    fig_width = width / dpi
+    fig_height = height / dpi
     
-    mask = features.rasterize(
-        [(geometry, 1)],
-        out_shape=(height, width),
-        transform=transform,
-        fill=0,
-        all_touched=True,
-        dtype=np.uint8
+    plt.figure(figsize=(fig_width, fig_height), dpi=dpi)
+    
+    # Plot with specific settings to avoid border artifacts
+    plt.imshow(
+        temp_grid,
+        extent=extent,
+        origin='lower',
+        cmap=custom_cmap,
+        vmin=vmin - 1,
+        vmax=vmax,
+        interpolation='none'  # Keep 'none' to prevent interpolation artifacts
     )
-    return mask.astype(bool)
+    
+    plt.axis('off')
+    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    
+    # Save with high quality settings
+    plt.savefig(output_png, 
+               dpi=dpi, 
+               bbox_inches='tight', 
+               pad_inches=0, 
+               transparent=True,
+               format='png',
+               metadata={'Software': 'Python matplotlib'},
+               pil_kwargs={'compress_level': compress_level})
+    plt.close()
 
-def create_heatmap(df, output_png, geometry, area_name, resolution=5120, cmap='RdBu_r', vmin=10, vmax=36):
-    try:
-        # Filter points within geometry first
-        points = gpd.GeoDataFrame(
-            geometry=[Point(x, y) for x, y in zip(df['x'], df['y'])],
-            data={'temp': df['temperatur'], 'ntzg': df['ntzg']}
-        )
-        points_within = points[points.geometry.within(geometry)]
+def heatmap_colormap(cmap):
+    """Colormap of the heatmaps: transparent outside the geometry, black for buildings (built once per process)."""
+    if cmap not in _colormaps:
+        custom_cmap = create_custom_colormap(cmap)
+        custom_cmap.set_bad(color=(0, 0, 0, 0))  # Transparent for NaN values
+        custom_cmap.set_under('black')  # Black for buildings
+        _colormaps[cmap] = custom_cmap
+    return _colormaps[cmap]
+
+def interpolate_layers(x_coords, y_coords, value_columns, ntzg, bounds, width, height, geometry_mask, cache_dir=None):
+    """Value grids (row 0 = y_min, NaN outside geometry_mask) and building grid within the geometry.
+
+    value_columns is a list of point values (one array per layer); all layers share one plan.
+    """
+    # Triangulation and nearest neighbours only depend on the point coordinates,
+    # so the plan is reused for every hour file with the same raster
+    building_mask = np.isin(ntzg, [20, 21, 30, 32])
+    with phase('plan'):
+        plan = get_interpolation_plan(x_coords, y_coords, building_mask, bounds, width, height,
+                                      pixel_mask=geometry_mask, cache_dir=cache_dir)
+    
+    # Building grid (nearest neighbour) and values (linear, non-building points only)
+    with phase('interpolate'):
+        building_grid = plan.nearest_neighbour(building_mask, fill_value=False)
+        value_grids = []
+        for values in value_columns:
+            value_grid = plan.linear(values)
+            value_grid[~geometry_mask] = np.nan  # Outside geometry
+            value_grids.append(value_grid)
+    return value_grids, building_grid & geometry_mask
+
+def interpolate_temperature(x_coords, y_coords, temps, ntzg, bounds, width, height, geometry_mask, vmin,
+                            cache_dir=None):
+    """Temperature grid (row 0 = y_min): NaN outside geometry_mask, vmin - 1 on buildings."""
+    (temp_grid,), building_grid = interpolate_layers(x_coords, y_coords, [temps], ntzg, bounds, width, height,
+                                                     geometry_mask, cache_dir)
+    temp_grid[building_grid] = vmin - 1  # Buildings within geometry
+    return temp_grid
+
+def stream_heatmap(x_coords, y_coords, ntzg, geometry, bounds, width, height, layers, cache_dir=None,
+                   tile_rows=512, png_format='rgba', compress_level=6, writer=None):
+    """Interpolate, colour and encode the heatmap layers tile_rows grid rows at a time (direct renderer).
+
+    layers is a list of (point values, output_png, cmap, vmin, vmax), all rendered with one plan.
+    Neither the value grids nor the images exist as a whole: the plan is built into cache_dir
+    (a temporary folder without one) and read back band by band, like the geometry mask and
+    the pixel map. Produces the same pixels as interpolate_temperature + render_rgba.
+    Returns the futures of the files when a writer is given (see stream_png).
+    """
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory(prefix='heatmap_plan_') as plan_dir:
+            return stream_heatmap(x_coords, y_coords, ntzg, geometry, bounds, width, height, layers, plan_dir,
+                                  tile_rows, png_format, compress_level, writer)
+
+    # The plan only covers the pixels of the geometry mask, so the mask itself is only
+    # rasterized when the plan has to be built
+    building_mask = np.isin(ntzg, [20, 21, 30, 32])
+
+    def mask_band(row0, row1):
+        return mask_rows(packed_raster_mask(geometry, width, height, bounds, cache_dir), width, row0, row1)
+
+    with phase('plan'):
+        plan_path = get_stored_plan(x_coords, y_coords, building_mask, bounds, width, height, cache_dir,
+                                    pixel_mask_rows=mask_band, pixel_mask_key=geometry_hash(geometry),
+                                    band_rows=tile_rows)
+    extent = (bounds[0], bounds[2], bounds[1], bounds[3])
+    
+    futures = []
+    for values, output_png, cmap, vmin, vmax in layers:
+        def grid_rows(row0, row1):
+            # Pixels outside the geometry stay NaN and are never buildings
+            plan = InterpolationPlan.load_rows(plan_path, row0, row1)
+            value_rows = plan.linear_rows(values, row0, row1)
+            value_rows[plan.nearest_rows(building_mask, row0, row1, fill_value=False)] = vmin - 1  # Buildings
+            return value_rows
         
-        if len(points_within) == 0:
-            logging.warning(f"No points found within geometry for {area_name}")
-            return
+        # First pass: value range of the whole grid (imshow rescales with it before colouring)
+        with phase('value_range'):
+            a_min, a_max = np.inf, -np.inf
+            for row0 in range(0, height, tile_rows):
+                value_rows = grid_rows(row0, min(row0 + tile_rows, height))
+                finite = value_rows[np.isfinite(value_rows)]
+                if len(finite):
+                    a_min = min(a_min, finite.min())
+                    a_max = max(a_max, finite.max())
+            data_range = (a_min, a_max) if a_min <= a_max else None
         
-        x_coords = points_within.geometry.x.values
-        y_coords = points_within.geometry.y.values
-        temps = points_within['temp'].values
-        ntzg = points_within['ntzg'].values
+        # Second pass: interpolate, colour and encode band by band (encoding on the writer thread if given)
+        with phase('stream'):
+            future = stream_png(grid_rows, (height, width), extent, heatmap_colormap(cmap), vmin - 1, vmax,
+                                data_range, output_png, cache_dir, tile_rows, png_format, compress_level, writer)
+        if future is not None:
+            futures.append(future)
+    return futures
+
+def encode_png(*save_args):
+    """save_indexed_png(*save_args), measured as phase 'encode' (also on the writer thread)."""
+    with phase('encode'):
+        save_indexed_png(*save_args)
+
+def variable_values(df, name):
+    """Point values of a variable: a column of df or a variable derived from one (see DERIVED_VARIABLES)."""
+    if name in DERIVED_VARIABLES:
+        column, derive = DERIVED_VARIABLES[name]
+        return derive(np.asarray(df[column]))
+    return np.asarray(df[name])
+
+def create_heatmap(df, output_png, geometry, area_name, resolution=5120, cmap='RdBu_r', vmin=10, vmax=36,
+                   **options):
+    """Render the temperatures of df within geometry to output_png (see create_layers).
+
+    Returns the future of the file when it is written by a BackgroundWriter, None otherwise.
+    """
+    futures = create_layers(df, [('temperatur', output_png, cmap, vmin, vmax)], geometry, area_name, resolution,
+                            **options)
+    return futures[0] if futures else None
+
+def create_layers(df, layers, geometry, area_name, resolution=5120, cache_dir=None, point_mask=None,
+                  renderer='matplotlib', tile_rows=None, png_format='rgba', compress_level=6, writer=None):
+    """Render variables of df (DataFrame or dict of column arrays) within geometry, one PNG each.
+
+    layers is a list of (variable, output_png, cmap, vmin, vmax). The point filter, building
+    mask and interpolation plan are set up once and shared by all layers.
+    point_mask can be passed when the points within geometry are already known
+    (e.g. from a label array shared by all districts). renderer 'direct' produces the
+    same pixels as 'matplotlib' without going through a figure; with tile_rows it works
+    on bands of that many rows, so memory does not grow with the resolution. It can write
+    indexed PNGs (png_format 'palette') and hand the encoding to a BackgroundWriter, in
+    which case the futures of the files are returned.
+    """
+    try:
+        # Filter points within geometry first
+        with phase('point_filter'):
+            x_all = np.asarray(df['x'], dtype=np.float64)
+            y_all = np.asarray(df['y'], dtype=np.float64)
+            if point_mask is None:
+                point_mask = label_points(x_all, y_all, [geometry]) == 0
+            
+            if not point_mask.any():
+                logging.warning(f"No points found within geometry for {area_name}")
+                return []
+            
+            x_coords = x_all[point_mask]
+            y_coords = y_all[point_mask]
+            ntzg = np.asarray(df['ntzg'])[point_mask]
+            value_columns = [variable_values(df, variable)[point_mask] for variable, *_ in layers]
         
         # Calculate bounds based on geometry
         bounds = geometry.bounds
         x_min, y_min, x_max, y_max = bounds
         
-        # Calculate grid dimensions with higher resolution
-        data_aspect_ratio = (y_max - y_min) / (x_max - x_min)
-        
-        # Calculate dimensions while maintaining aspect ratio
-        if data_aspect_ratio > 9/16:
-            height = resolution
-            width = int(height / data_aspect_ratio)
-        else:
-            width = resolution
-            height = int(width * data_aspect_ratio)
+        # Calculate grid dimensions while maintaining aspect ratio
+        width, height = image_size(bounds, resolution)
             
         logging.info(f"Creating grid with dimensions: {width}x{height} pixels")
         
-        # Create higher resolution grid
-        x_grid, y_grid = np.meshgrid(
-            np.linspace(x_min, x_max, width),
-            np.linspace(y_min, y_max, height)
-        )
-        
-        # Create geometry mask first
-        geometry_mask = create_raster_mask(geometry, width, height, bounds)
-        
-        # Create building mask using nearest neighbor interpolation
-        building_mask = np.isin(ntzg, [20, 21, 30, 32])
-        building_grid = griddata(
-            (x_coords, y_coords),
-            building_mask,
-            (x_grid, y_grid),
-            method='nearest',
-            fill_value=False
-        )
-        
-        # Ensure building grid is boolean
-        building_grid = building_grid > 0.5
+        if renderer == 'direct' and tile_rows:
+            futures = stream_heatmap(x_coords, y_coords, ntzg, geometry, bounds, width, height,
+                                     [(values, *layer[1:]) for values, layer in zip(value_columns, layers)],
+                                     cache_dir, tile_rows, png_format, compress_level, writer)
+            logging.info(f"Successfully created high-resolution heatmap for {area_name}")
+            return futures
         
-        # Interpolate temperatures only for non-building points
-        non_building_mask = ~building_mask
-        temp_grid = griddata(
-            (x_coords[non_building_mask], y_coords[non_building_mask]),
-            temps[non_building_mask],
-            (x_grid, y_grid),
-            method='linear',
-            fill_value=np.nan
-        )
+        # Create geometry mask first (cached per geometry and grid)
+        with phase('geometry_mask'):
+            geometry_mask = raster_mask(geometry, width, height, bounds, cache_dir)
         
-        # Apply masks in correct order
-        temp_grid[~geometry_mask] = np.nan  # Outside geometry
-        temp_grid[building_grid & geometry_mask] = vmin - 1  # Buildings within geometry
+        value_grids, building_grid = interpolate_layers(x_coords, y_coords, value_columns, ntzg, bounds, width,
+                                                        height, geometry_mask, cache_dir)
         
-        # Set up figure with higher DPI
-        dpi = 100  # Increased DPI
-        
-        # Calculate figure size to maintain pixel dimensions
-        fig_width = width / dpi
-        fig_height = height / dpi
+        extent = (x_min, x_max, y_min, y_max)
+        futures = []
+        for value_grid, (variable, output_png, cmap, vmin, vmax) in zip(value_grids, layers):
+            value_grid[building_grid] = vmin - 1  # Buildings within geometry
+            custom_cmap = heatmap_colormap(cmap)
+            
+            if renderer == 'direct':
+                # Apply the colormap LUT with NumPy and encode the PNG without a figure
+                with phase('colour'):
+                    indices = canvas_indices(value_grid, extent, custom_cmap.N, vmin - 1, vmax, cache_dir)
+                logging.info(f"Output image dimensions: {(indices.shape[1], indices.shape[0])}")
+                save_args = (indices, canvas_lut(custom_cmap), output_png, png_format, compress_level)
+                if writer is not None:
+                    futures.append(writer.submit(encode_png, *save_args))
+                else:
+                    encode_png(*save_args)
+                continue
+            
+            with phase('savefig'):
+                save_matplotlib_png(value_grid, extent, custom_cmap, vmin, vmax, width, height, output_png,
+                                    compress_level)
+            
+            # Log the output image dimensions
+            with Image.open(output_png) as img:
+                logging.info(f"Output image dimensions: {img.size}")
         
-        plt.figure(figsize=(fig_width, fig_height), dpi=dpi)
-        custom_cmap = create_custom_colormap(cmap)
+        logging.info(f"Successfully created high-resolution heatmap for {area_name}")
+        return futures
+            
+    except Exception as e:
+        logging.error(f"Error in create_heatmap for {area_name}: {str(e)}")
+        raise
+
+def create_tiles(df, output_dir, geometry, area_name, zoom_min=10, zoom_max=15, cmap='RdBu_r', vmin=10, vmax=36,
+                 cache_dir=None, point_mask=None):
+    """Render the points of df within geometry (EPSG:3857) once and write an XYZ tile pyramid.
+
+    The grid is aligned to the 256 px tiles of zoom_max; lower zoom levels are downsampled
+    from it. Fully transparent tiles are not written.
+    """
+    try:
+        with phase('point_filter'):
+            x_all = np.asarray(df['x'], dtype=np.float64)
+            y_all = np.asarray(df['y'], dtype=np.float64)
+            if point_mask is None:
+                point_mask = label_points(x_all, y_all, [geometry]) == 0
         
-        # Plot with specific settings to avoid border artifacts
-        im = plt.imshow(
-            temp_grid,
-            extent=(x_min, x_max, y_min, y_max),
-            origin='lower',
-            cmap=custom_cmap,
-            vmin=vmin - 1,
-            vmax=vmax,
-            interpolation='none'  # Keep 'none' to prevent interpolation artifacts
-        )
+        if not point_mask.any():
+            logging.warning(f"No points found within geometry for {area_name}")
+            return
         
-        # Handle transparency and colors
-        im.cmap.set_bad(color=(0, 0, 0, 0))  # Transparent for NaN values
-        custom_cmap.set_under('black')  # Black for buildings
+        # Tiles of the highest zoom level covering the geometry
+        tx0, ty0, tx1, ty1 = tile_range(geometry.bounds, zoom_max)
+        width = (tx1 - tx0 + 1) * TILE_SIZE
+        height = (ty1 - ty0 + 1) * TILE_SIZE
+        x_min, y_min, x_max, y_max = tile_bounds(tx0, ty0, tx1, ty1, zoom_max)
+        logging.info(f"Creating tile grid with dimensions: {width}x{height} pixels (zoom {zoom_max})")
         
-        plt.axis('off')
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+        # The grid is evaluated at the pixel centres of the tiles
+        pixel_size = tile_span(zoom_max) / TILE_SIZE
+        bounds = (x_min + pixel_size / 2, y_min + pixel_size / 2, x_max - pixel_size / 2, y_max - pixel_size / 2)
+        with phase('geometry_mask'):
+            geometry_mask = raster_mask(geometry, width, height, (x_min, y_min, x_max, y_max), cache_dir)
         
-        # Save with high quality settings
-        plt.savefig(output_png, 
-                   dpi=dpi, 
-                   bbox_inches='tight', 
-                   pad_inches=0, 
-                   transparent=True,
-                   format='png',
-                   metadata={'Software': 'Python matplotlib'})
-        plt.close()
+        temp_grid = interpolate_temperature(x_all[point_mask], y_all[point_mask],
+                                            np.asarray(df['temperatur'])[point_mask],
+                                            np.asarray(df['ntzg'])[point_mask],
+                                            bounds, width, height, geometry_mask, vmin, cache_dir)
         
-        logging.info(f"Successfully created high-resolution heatmap for {area_name}")
+        # Same colours as the PNG renderers; tiles start in the north, grid row 0 is the south edge
+        with phase('colour'):
+            custom_cmap = heatmap_colormap(cmap)
+            indices = colormap_indices(temp_grid, vmin - 1, vmax, custom_cmap.N)
+            rgba = colormap_lut(custom_cmap)[indices[::-1]]
         
-        # Log the output image dimensions
-        from PIL import Image
-        with Image.open(output_png) as img:
-            logging.info(f"Output image dimensions: {img.size}")
-            
+        with phase('write_tiles'):
+            written = write_tile_pyramid(rgba, tx0, ty0, zoom_max, zoom_min, output_dir)
+        logging.info(f"Successfully wrote {written} tiles (zoom {zoom_min}-{zoom_max}) for {area_name}")
+    
     except Exception as e:
-        logging.error(f"Error in create_heatmap for {area_name}: {str(e)}")
+        logging.error(f"Error in create_tiles for {area_name}: {str(e)}")
         raise
 
-def process_file_and_district(args):
-    """Process a single CSV file for a single district."""
-    filename, district_info, input_folder, output_folder, resolution, cmap, vmin, vmax = args
+def district_pixel_size(bounds, resolution):
+    """Ground size of a pixel when an area is rendered at resolution by create_heatmap."""
+    x_min, y_min, x_max, y_max = bounds
+    if (y_max - y_min) / (x_max - x_min) > 9/16:
+        return (y_max - y_min) / resolution
+    return (x_max - x_min) / resolution
+
+def city_grid_layout(geometry, pixel_size):
+    """(width, height, edges) of the grid covering geometry, snapped to multiples of pixel_size."""
+    # Snap the grid to the pixel size so every district window starts on a whole pixel
+    x_min, y_min, x_max, y_max = geometry.bounds
+    x_origin = math.floor(x_min / pixel_size) * pixel_size
+    y_origin = math.floor(y_min / pixel_size) * pixel_size
+    width = int(math.ceil((x_max - x_origin) / pixel_size))
+    height = int(math.ceil((y_max - y_origin) / pixel_size))
+    return width, height, (x_origin, y_origin, x_origin + width * pixel_size, y_origin + height * pixel_size)
+
+def interpolate_city(df, geometry, pixel_size, cache_dir=None, point_mask=None, variables=('temperatur',)):
+    """Interpolate the points of df within geometry once on the city grid (see city_grid_layout).
+
+    Returns (value grids of the variables, building_grid, edges) with row 0 at the southern edge,
+    or None without points.
+    """
+    x_all = np.asarray(df['x'], dtype=np.float64)
+    y_all = np.asarray(df['y'], dtype=np.float64)
+    if point_mask is None:
+        point_mask = label_points(x_all, y_all, [geometry]) == 0
+    if not point_mask.any():
+        return None
     
+    width, height, edges = city_grid_layout(geometry, pixel_size)
+    logging.info(f"Creating city grid with dimensions: {width}x{height} pixels ({pixel_size:.2f} m)")
+    
+    # The grid is evaluated at the pixel centres
+    bounds = (edges[0] + pixel_size / 2, edges[1] + pixel_size / 2, edges[2] - pixel_size / 2, edges[3] - pixel_size / 2)
+    with phase('geometry_mask'):
+        geometry_mask = raster_mask(geometry, width, height, edges, cache_dir)
+    
+    value_grids, building_grid = interpolate_layers(x_all[point_mask], y_all[point_mask],
+                                                    [variable_values(df, variable)[point_mask]
+                                                     for variable in variables],
+                                                    np.asarray(df['ntzg'])[point_mask],
+                                                    bounds, width, height, geometry_mask, cache_dir)
+    return value_grids, building_grid, edges
+
+def default_pixel_size(districts, resolution):
+    """City grid pixel size at which the largest district keeps the size it gets at resolution."""
+    return max(district_pixel_size(district['geometry'].bounds, resolution) for district in districts)
+
+def create_city_grids(df, geometry, pixel_size, layers, cache_dir=None, point_mask=None):
+    """City grids of the layers (dicts with name and vmin) ready for colouring (buildings at vmin - 1).
+
+    Returns (value grids, (x_origin, y_origin)) with row 0 at y_origin, or None without points.
+    """
+    city = interpolate_city(df, geometry, pixel_size, cache_dir, point_mask, [layer['name'] for layer in layers])
+    if city is None:
+        return None
+    value_grids, building_grid, edges = city
+    for value_grid, layer in zip(value_grids, layers):
+        value_grid[building_grid] = layer['vmin'] - 1  # Buildings within geometry
+    return value_grids, (edges[0], edges[1])
+
+def crop_district(temp_grid, origin, pixel_size, geometry, cache_dir=None):
+    """Window of a city grid covering geometry, NaN outside the geometry."""
+    x_origin, y_origin = origin
+    x_min, y_min, x_max, y_max = geometry.bounds
+    height, width = temp_grid.shape
+    col0 = max(int(math.floor((x_min - x_origin) / pixel_size)), 0)
+    col1 = min(int(math.ceil((x_max - x_origin) / pixel_size)), width)
+    row0 = max(int(math.floor((y_min - y_origin) / pixel_size)), 0)
+    row1 = min(int(math.ceil((y_max - y_origin) / pixel_size)), height)
+    
+    with phase('crop'):
+        crop = temp_grid[row0:row1, col0:col1].copy()
+        edges = (x_origin + col0 * pixel_size, y_origin + row0 * pixel_size,
+                 x_origin + col1 * pixel_size, y_origin + row1 * pixel_size)
+        crop[~raster_mask(geometry, col1 - col0, row1 - row0, edges, cache_dir)] = np.nan
+    return crop
+
+def save_grid_png(temp_grid, output_png, cmap, vmin, vmax, png_format='rgba', compress_level=6, writer=None):
+    """Colour a grid (row 0 = south) pixel by pixel and write it as PNG.
+
+    With a BackgroundWriter the encoding runs on its thread and the future is returned.
+    """
+    with phase('colour'):
+        custom_cmap = heatmap_colormap(cmap)
+        indices = colormap_indices(temp_grid, vmin - 1, vmax, custom_cmap.N)[::-1]
+    save_args = (indices, colormap_lut(custom_cmap), output_png, png_format, compress_level)
+    if writer is not None:
+        return writer.submit(encode_png, *save_args)
+    encode_png(*save_args)
+
+# Columns needed to render an hour
+HOUR_COLUMNS = ['x', 'y', 'temperatur', 'ntzg']
+
+# Value columns of the hour files that can be rendered (--variables)
+VALUE_COLUMNS = ['temperatur', 'messung', 'genauigkeit']
+
+# Variables derived from a value column: name -> (column, function of its values)
+DERIVED_VARIABLES = {
+    # PET is just a random value for testing (same as build_db.sql)
+    'pet': ('temperatur', lambda temps: temps + PET_OFFSET),
+}
+
+# Number of hour files kept parsed at the same time in file-major mode
+STAGED_FILES = 2
+
+# Tasks kept submitted per worker, so the pool never runs dry but nothing is queued up front
+PENDING_TASKS_PER_WORKER = 2
+
+# Per-process state of the pool workers (see init_worker)
+_worker = {}
+
+def hour_columns(layers):
+    """Columns to read from an hour file to render the layers (dicts with the variable name)."""
+    columns = ['x', 'y', 'ntzg']
+    for layer in layers:
+        column = DERIVED_VARIABLES[layer['name']][0] if layer['name'] in DERIVED_VARIABLES else layer['name']
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+def parse_variable(value, cmap, vmin, vmax):
+    """Layer dict (name, cmap, vmin, vmax) from 'name[:cmap[:vmin[:vmax]]]'; missing parts default to the arguments."""
+    parts = value.split(':')
+    name = parts[0]
+    if name not in VALUE_COLUMNS and name not in DERIVED_VARIABLES:
+        raise ValueError(f"Unknown variable {name!r} (available: {', '.join(VALUE_COLUMNS + list(DERIVED_VARIABLES))})")
+    if len(parts) > 4:
+        raise ValueError(f"Variable must be given as name[:cmap[:vmin[:vmax]]], not {value!r}")
+    parts += [''] * (4 - len(parts))
     try:
-        # Read the CSV file
-        input_file = os.path.join(input_folder, filename)
-        df = pd.read_csv(input_file)
-        
-        # Extract district information
-        district_gid = district_info['gid']
-        district_geometry = district_info['geometry']
-        
-        # Create output filename using CSV name and district GID
-        # Check name!! 
-        csv_base = os.path.splitext(filename)[0]
-        output_png = os.path.join(output_folder, f"{csv_base}_district{district_gid}.png")
-        
-        # Create heatmap
-        create_heatmap(df, output_png, district_geometry, f"{csv_base}_district{district_gid}", 
-                      resolution, cmap, vmin, vmax)
+        return {'name': name, 'cmap': parts[1] or cmap,
+                'vmin': float(parts[2]) if parts[2] else vmin,
+                'vmax': float(parts[3]) if parts[3] else vmax}
+    except ValueError:
+        raise ValueError(f"vmin and vmax of {value!r} must be numbers")
+
+def district_png_path(output_folder, filename, district_gid):
+    # Create output filename using CSV name and district GID
+    # Check name!! 
+    return os.path.join(output_folder, f"{table_base(filename)}_district{district_gid}.png")
+
+def render_district(df, filename, district_info, layers, render_options, point_mask=None, writer=None):
+    """Render the layers of one district of an already loaded hour file.
+
+    layers are dicts with the variable name, cmap, vmin, vmax and output folder; render_options
+    holds the keyword arguments for create_layers (resolution, renderer, ...). Returns the
+    futures of the PNGs that are written by writer.
+    """
+    district_gid = district_info['gid']
+    district_geometry = district_info['geometry']
+    
+    csv_base = table_base(filename)
+    png_layers = [(layer['name'], district_png_path(layer['folder'], filename, district_gid),
+                   layer['cmap'], layer['vmin'], layer['vmax']) for layer in layers]
+    
+    # Create heatmaps
+    return create_layers(df, png_layers, district_geometry, f"{csv_base}_district{district_gid}",
+                         point_mask=point_mask, writer=writer, **render_options)
+
+def district_list(geometry_set):
+    """One dict (index, gid, geometry) per district of a geometry set."""
+    return [{'index': index, 'gid': gid, 'geometry': geometry}
+            for index, (gid, geometry) in enumerate(zip(geometry_set.column('gid'), geometry_set.geometries))]
+
+def init_worker(geojson_path, cache_dir, cmap, metrics=None, plan_cache_mb=PLAN_CACHE_MB):
+    """Load the districts and the colormap once per worker process (see worker_pool).
+
+    Tasks then only carry district indices instead of pickled geometries; interpolation
+    plans (up to plan_cache_mb) and raster masks stay in the caches of the process between
+    tasks. PNGs of the direct renderers are encoded on a writer thread while the next
+    district is interpolated. metrics is the (path, run id) of the metrics file of the run, if any.
+    """
+    if metrics:
+        configure_metrics(*metrics)
+    set_plan_cache_mb(plan_cache_mb)
+    _worker['districts'] = district_list(load_geometries(geojson_path, cache_dir))
+    _worker['writer'] = BackgroundWriter()
+    heatmap_colormap(cmap)
+
+def worker_pool(max_workers, pool_options, name):
+    """Process pool whose workers are set up by init_worker, measured as pool name with --metrics_out.
+
+    pool_options holds geojson_path, cache_dir, cmap, chunk_size, max_tasks_per_child
+    (replace a worker after that many tasks to cap its memory, None = never; needs
+    Python 3.11), metrics (see metrics_settings) and plan_cache_mb.
+    """
+    options = {}
+    if pool_options['max_tasks_per_child'] is not None:
+        # Only known to ProcessPoolExecutor from Python 3.11 on
+        options['max_tasks_per_child'] = pool_options['max_tasks_per_child']
+    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                   initargs=(pool_options['geojson_path'], pool_options['cache_dir'],
+                                             pool_options['cmap'], pool_options['metrics'],
+                                             pool_options['plan_cache_mb']),
+                                   **options)
+    return MeteredPool(executor, name, max_workers)
+
+@contextmanager
+def district_pools(max_workers, pool_options, name):
+    """One single-process worker_pool per worker, so tasks can be sent to a given worker."""
+    with ExitStack() as stack:
+        yield [stack.enter_context(worker_pool(1, pool_options, name))
+               for _ in range(max_workers or os.cpu_count() or 1)]
+
+def partition_districts(districts, resolution, count):
+    """Assign every district to one of count workers, balancing their pixels at resolution.
+
+    A district is always rendered by the same worker, so its interpolation plan and masks
+    are reused from that worker's caches for every hour. The largest districts are assigned
+    first, each to the worker with the fewest pixels so far. Returns {district index: worker}.
+    """
+    pixels = {district['index']: math.prod(image_size(district['geometry'].bounds, resolution))
+              for district in districts}
+    load = [0] * count
+    partition = {}
+    for index in sorted(pixels, key=lambda index: (-pixels[index], index)):
+        worker = load.index(min(load))
+        partition[index] = worker
+        load[worker] += pixels[index]
+    return partition
+
+def partition_jobs(jobs, partition, worker):
+    """The jobs with only the districts partition assigns to worker."""
+    for filename, districts in jobs:
+        districts = [district for district in districts if partition[district['index']] == worker]
+        if districts:
+            yield filename, districts
+
+def pending_limit(max_workers):
+    """Number of tasks kept submitted at the same time."""
+    return PENDING_TASKS_PER_WORKER * (max_workers or os.cpu_count() or 1)
+
+def claimed_jobs(jobs, claim, pbar):
+    """Yield the jobs with only the districts claim(filename, districts) returns, counting the others as done.
+
+    Used lazily, so with a shared work queue an hour is only claimed right before it is rendered.
+    """
+    for filename, districts in jobs:
+        if claim:
+            claimed = claim(filename, districts)
+            pbar.update(len(districts) - len(claimed))
+            districts = claimed
+        if districts:
+            yield filename, districts
+
+def district_batches(jobs, chunk_size):
+    """Split jobs into (filename, district indices) batches of at most chunk_size districts.
+
+    The batches of an hour file follow each other, so the file is only read (or staged)
+    while its batches run and each batch renders several districts from one read.
+    """
+    for filename, districts in jobs:
+        for start in range(0, len(districts), chunk_size):
+            yield filename, [district['index'] for district in districts[start:start + chunk_size]]
+
+def count_batch(filename, indices, written, on_result, pbar):
+    """Report the districts of a finished batch; returns (successful, failed).
+
+    on_result(filename, district index, ok) is called for every district of the batch.
+    """
+    written = written or []
+    if on_result:
+        for index in indices:
+            on_result(filename, index, index in written)
+    pbar.update(len(indices))
+    return len(written), len(indices) - len(written)
+
+def render_batch(df, filename, indices, layers, render_options, pairs=None):
+    """Render the districts with the given indices of an already loaded hour file.
+
+    pairs are the (points, districts) of point_districts (from stage_hour_file), if known.
+    Returns the indices of the districts that were written.
+    """
+    rendered = []
+    for index in indices:
+        district_info = _worker['districts'][index]
+        try:
+            with task('district', district=district_info['gid']):
+                point_mask = None
+                if pairs is not None:
+                    point_mask = np.zeros(len(df['x']), dtype=bool)
+                    point_mask[district_members(pairs, index)] = True
+                futures = render_district(df, filename, district_info, layers, render_options, point_mask,
+                                          _worker.get('writer'))
+            rendered.append((index, futures))
+        except Exception as e:
+            logging.error(f"Error processing {filename} for district {district_info['gid']}: {str(e)}")
+    return finished_districts(filename, rendered)
+
+def finished_districts(filename, rendered):
+    """Indices of the (index, futures) districts whose PNGs were written, waiting for the writer."""
+    written = []
+    for index, futures in rendered:
+        gid = _worker['districts'][index]['gid']
+        try:
+            with phase('wait_writer', district=gid):
+                for future in futures:
+                    future.result()
+            written.append(index)
+            logging.info(f"Successfully processed {filename} for district {gid}")
+        except Exception as e:
+            logging.error(f"Error processing {filename} for district {gid}: {str(e)}")
+    return written
+
+def process_file_batch(args):
+    """Read a single CSV file (or store) and render a batch of its districts."""
+    filename, indices, input_folder, layers, render_options = args
+    annotate(file=filename)
+    
+    try:
+        # Read the CSV file (or columnar store)
+        with phase('read'):
+            df = read_table(os.path.join(input_folder, filename), hour_columns(layers))
+    except Exception as e:
+        logging.error(f"Error reading {filename}: {str(e)}")
+        return []
+    return render_batch(df, filename, indices, layers, render_options)
+
+def stage_hour_file(input_file, staging_folder, cache_dir=None, columns=HOUR_COLUMNS):
+    """Parse an hour file once and store its columns as memory-mappable .npy files.
+
+    Columnar stores are already memory-mappable and are used in place. Also stores the
+    districts of the points (see point_districts), computed only once per coordinate set.
+    Returns (stage_dir, column_dir).
+    """
+    annotate(file=os.path.basename(input_file))
+    stage_dir = os.path.join(staging_folder, table_base(os.path.basename(input_file)))
+    os.makedirs(stage_dir, exist_ok=True)
+    with phase('read'):
+        if is_store(input_file):
+            column_dir = input_file
+            df = read_table(input_file, ['x', 'y'])
+        else:
+            column_dir = stage_dir
+            df = pd.read_csv(input_file, usecols=columns)
+            for column in columns:
+                np.save(os.path.join(stage_dir, f"{column}.npy"), df[column].to_numpy())
+    with phase('point_labels'):
+        geometries = [district['geometry'] for district in _worker['districts']]
+        pairs = cached_point_districts(df['x'].to_numpy(), df['y'].to_numpy(), geometries, cache_dir)
+        np.save(os.path.join(stage_dir, 'districts.npy'), pairs)
+    return stage_dir, column_dir
+
+def load_staged_hour(stage_dir, column_dir, columns=HOUR_COLUMNS):
+    """Memory-map the columns written by stage_hour_file (shared between all workers)."""
+    df = {column: np.load(os.path.join(column_dir, f"{column}.npy"), mmap_mode='r')
+          for column in columns}
+    df['districts'] = np.load(os.path.join(stage_dir, 'districts.npy'), mmap_mode='r')
+    return df
+
+def process_staged_batch(args):
+    """Render a batch of districts against an hour file staged by stage_hour_file."""
+    stage_dir, column_dir, filename, indices, layers, render_options = args
+    annotate(file=filename)
+    
+    try:
+        with phase('read'):
+            df = load_staged_hour(stage_dir, column_dir, hour_columns(layers))
+    except Exception as e:
+        logging.error(f"Error reading staged {filename}: {str(e)}")
+        return []
+    return render_batch(df, filename, indices, layers, render_options, df['districts'])
+
+def process_combinations(jobs, input_folder, layers, render_options, pool_options, max_workers,
+                         on_result=None, claim=None):
+    """Render batches of (file, district) combinations; every batch reads its hour file itself.
+
+    jobs is a list of (filename, districts to render), layers the variables rendered for each
+    district (see render_district). claim(filename, districts) returns the
+    districts this run may render (shard / work queue); on_result is described in count_batch.
+    Every district is always rendered by the same worker (see partition_districts).
+    """
+    total = sum(len(districts) for _, districts in jobs)
+    logging.info(f"Total number of combinations to process: {total}")
+    
+    successful = 0
+    failed = 0
+    with district_pools(max_workers, pool_options, 'combination') as pools, \
+            tqdm(total=total, desc="Processing file-district combinations") as pbar:
+        partition = partition_districts({district['index']: district for _, districts in jobs
+                                         for district in districts}.values(),
+                                        render_options['resolution'], len(pools))
+
+        def batches(worker):
+            # The districts of one worker, claimed right before they are submitted to it
+            return ((filename, indices, input_folder, layers, render_options)
+                    for filename, indices in district_batches(claimed_jobs(partition_jobs(jobs, partition, worker),
+                                                                           claim, pbar),
+                                                              pool_options['chunk_size']))
+
+        for (filename, indices, *_), written in partitioned_map(pools, process_file_batch,
+                                                                [batches(worker) for worker in range(len(pools))],
+                                                                PENDING_TASKS_PER_WORKER):
+            counts = count_batch(filename, indices, written, on_result, pbar)
+            successful += counts[0]
+            failed += counts[1]
+
+    return successful, failed
+
+def process_file_major(jobs, input_folder, layers, render_options, pool_options, max_workers,
+                       on_result=None, claim=None):
+    """Parse every hour file once and fan it out to batches of its districts (see process_combinations).
+
+    Hour files are parsed by the least busy worker, the batches go to the worker of their districts.
+    """
+    total = sum(len(districts) for _, districts in jobs)
+    logging.info(f"Total number of combinations to process: {total}")
+
+    # Prefer shared memory for the staged columns
+    staging_root = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    staging_folder = tempfile.mkdtemp(prefix='heatmap_stage_', dir=staging_root)
+
+    remaining = {}  # filename -> [stage_dir, number of unfinished districts]
+    futures = {}  # future -> (kind, filename, districts or indices, worker)
+    successful = 0
+    failed = 0
+
+    try:
+        with district_pools(max_workers, pool_options, 'file') as pools, \
+                tqdm(total=total, desc="Processing file-district combinations") as pbar:
+            partition = partition_districts({district['index']: district for _, districts in jobs
+                                             for district in districts}.values(),
+                                            render_options['resolution'], len(pools))
+            ready = [deque() for _ in pools]  # render batches of staged files waiting for each worker
+            pending = [0] * len(pools)  # tasks submitted to each worker
+            pending_files = claimed_jobs(jobs, claim, pbar)
+            files_left = True
+            while files_left or any(ready) or futures:
+                # Keep a bounded number of hour files parsed ahead of the renders
+                while files_left and len(remaining) < STAGED_FILES:
+                    job = next(pending_files, None)
+                    if job is None:
+                        files_left = False
+                        break
+                    filename, districts = job
+                    remaining[filename] = [None, len(districts)]
+                    worker = pending.index(min(pending))
+                    future = pools[worker].submit(stage_hour_file, os.path.join(input_folder, filename),
+                                                  staging_folder, render_options['cache_dir'], hour_columns(layers))
+                    futures[future] = ('stage', filename, districts, worker)
+                    pending[worker] += 1
+                
+                # ... and a bounded number of render batches queued for each worker
+                for worker, batches in enumerate(ready):
+                    while batches and pending[worker] < PENDING_TASKS_PER_WORKER:
+                        args = batches.popleft()
+                        futures[pools[worker].submit(process_staged_batch, args)] = ('render', args[2], args[3],
+                                                                                     worker)
+                        pending[worker] += 1
+                
+                if not futures:
+                    continue
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, filename, payload, worker = futures.pop(future)
+                    pending[worker] -= 1
+
+                    if kind == 'stage':
+                        districts = payload
+                        try:
+                            stage_dir, column_dir = future.result()
+                        except Exception as e:
+                            logging.error(f"Error reading {filename}: {str(e)}")
+                            failed += count_batch(filename, [district['index'] for district in districts], [],
+                                                  on_result, pbar)[1]
+                            del remaining[filename]
+                            continue
+
+                        remaining[filename][0] = stage_dir
+                        for worker, batches in enumerate(ready):
+                            for _, indices in district_batches(partition_jobs([(filename, districts)], partition,
+                                                                              worker), pool_options['chunk_size']):
+                                batches.append((stage_dir, column_dir, filename, indices, layers, render_options))
+                        continue
+
+                    indices = payload
+                    try:
+                        written = future.result()
+                    except Exception as e:
+                        logging.error(f"Error in future: {str(e)}")
+                        written = []
+                    counts = count_batch(filename, indices, written, on_result, pbar)
+                    successful += counts[0]
+                    failed += counts[1]
+
+                    # Drop the staged columns once all districts of the hour are done
+                    remaining[filename][1] -= len(indices)
+                    if remaining[filename][1] == 0:
+                        shutil.rmtree(remaining.pop(filename)[0], ignore_errors=True)
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+    return successful, failed
+
+def process_city_file(args):
+    """Interpolate one CSV file (or store) for the whole area and crop the districts with the given indices."""
+    filename, indices, area, input_folder, layers, city_options = args
+    pixel_size = city_options['pixel_size']
+    annotate(file=filename)
+    
+    try:
+        with phase('read'):
+            df = read_table(os.path.join(input_folder, filename), hour_columns(layers))
+        with phase('point_labels'):
+            point_mask = cached_point_labels(df['x'].to_numpy(), df['y'].to_numpy(), [area],
+                                             city_options['cache_dir']) == 0
+        city = create_city_grids(df, area, pixel_size, layers, city_options['cache_dir'], point_mask)
+        if city is None:
+            logging.warning(f"No points found within the area for {filename}")
+            return []
+        value_grids, origin = city
+    except Exception as e:
+        logging.error(f"Error interpolating {filename}: {str(e)}")
+        return []
+    
+    rendered = []
+    for index in indices:
+        district = _worker['districts'][index]
+        try:
+            futures = []
+            with task('district', district=district['gid']):
+                for value_grid, layer in zip(value_grids, layers):
+                    output_png = district_png_path(layer['folder'], filename, district['gid'])
+                    crop = crop_district(value_grid, origin, pixel_size, district['geometry'],
+                                         city_options['cache_dir'])
+                    future = save_grid_png(crop, output_png, layer['cmap'], layer['vmin'], layer['vmax'],
+                                           city_options['png_format'], city_options['compress_level'],
+                                           _worker.get('writer'))
+                    if future is not None:
+                        futures.append(future)
+            rendered.append((index, futures))
+        except Exception as e:
+            logging.error(f"Error processing {filename} for district {district['gid']}: {str(e)}")
+    return finished_districts(filename, rendered)
+
+def process_city(jobs, area, input_folder, layers, city_options, pool_options, max_workers,
+                 on_result=None, claim=None):
+    """Interpolate every hour file once for the whole area and crop its districts from that grid."""
+    total = sum(len(districts) for _, districts in jobs)
+    logging.info(f"Total number of combinations to process: {total}")
+    
+    successful = 0
+    failed = 0
+    with worker_pool(max_workers, pool_options, 'city') as executor, \
+            tqdm(total=total, desc="Processing file-district combinations") as pbar:
+        tasks = ((filename, [district['index'] for district in districts], area, input_folder, layers,
+                  city_options) for filename, districts in claimed_jobs(jobs, claim, pbar))
+        for (filename, indices, *_), written in bounded_map(executor, process_city_file, tasks,
+                                                            pending_limit(max_workers)):
+            counts = count_batch(filename, indices, written, on_result, pbar)
+            successful += counts[0]
+            failed += counts[1]
+    
+    return successful, failed
+
+def process_cube_hour(args):
+    """Interpolate one CSV file (or store) for the whole area into its slice of the cube."""
+    filename, index, cube_path, area, input_folder, cube_options = args
+    annotate(file=filename)
+    
+    try:
+        with phase('read'):
+            df = read_table(os.path.join(input_folder, filename), HOUR_COLUMNS)
+        with phase('point_labels'):
+            point_mask = cached_point_labels(df['x'].to_numpy(), df['y'].to_numpy(), [area],
+                                             cube_options['cache_dir']) == 0
+        city = interpolate_city(df, area, cube_options['pixel_size'], cube_options['cache_dir'], point_mask)
+        if city is None:
+            logging.warning(f"No points found within the area for {filename}")
+            return False
+        (temp_grid,), building_grid, _ = city
+        with phase('write_cube'):
+            write_hour(cube_path, index, temp_grid, building_grid)
+        logging.info(f"Successfully added {filename} to the cube")
+        return True
+    except Exception as e:
+        logging.error(f"Error processing {filename} for the cube: {str(e)}")
+        return False
+
+def cube_hours(csv_files, area, input_folder, pixel_size, manifest):
+    """(time label, filename) of every hour sorted by time and the fingerprint of each hour."""
+    params = {'pixel_size': pixel_size, 'area': geometry_hash(area)}
+    
+    # Sort the time axis by timestamp (file names without a date keep their name)
+    hours = []
+    for filename in csv_files:
+        try:
+            time_label = parse_file_date(filename)
+        except Exception:
+            time_label = table_base(filename)
+        hours.append((time_label, filename))
+    hours.sort()
+    fingerprints = [manifest.fingerprint([os.path.join(input_folder, filename)], params) for _, filename in hours]
+    manifest.save()
+    return hours, fingerprints
+
+def process_cube(csv_files, area, area_name, input_folder, output_folder, cube_options, pool_options, max_workers,
+                 manifest):
+    """Write the temperature grids of all hours into one memory-mapped (hour, y, x) cube per area.
+
+    Hours whose input and settings did not change are copied from the existing cube.
+    """
+    cube_path = os.path.join(output_folder, f"{area_name}{CUBE_SUFFIX}")
+    width, height, edges = city_grid_layout(area, cube_options['pixel_size'])
+    hours, fingerprints = cube_hours(csv_files, area, input_folder, cube_options['pixel_size'], manifest)
+    
+    # Reuse the hours of an existing cube with the same grid
+    previous = {}
+    if not manifest.force and is_cube(cube_path):
+        old = read_manifest(cube_path)
+        if old['width'] == width and old['height'] == height and old['bounds'] == [float(e) for e in edges]:
+            previous = {(time_label, json.dumps(fingerprint, sort_keys=True)): index
+                        for index, (time_label, fingerprint) in enumerate(zip(old['times'], old['fingerprints']))
+                        if fingerprint is not None}
+    
+    tmp_path = f"{cube_path}.tmp-{os.getpid()}"
+    cube_manifest = create_cube(tmp_path, width, height, edges, [t for t, _ in hours], [f for _, f in hours],
+                                attrs={'crs': 'EPSG:3857', 'area': area_name})
+    pending = []
+    if previous:
+        old_temperature, old_buildings, _ = open_cube(cube_path)
+        temperature, buildings, _ = open_cube(tmp_path, mode='r+')
+        buildings[:] = old_buildings
+        for index, (time_label, filename) in enumerate(hours):
+            old_index = previous.get((time_label, json.dumps(fingerprints[index], sort_keys=True)))
+            if old_index is None:
+                pending.append(index)
+                continue
+            temperature[index] = old_temperature[old_index]
+            cube_manifest['fingerprints'][index] = fingerprints[index]
+        temperature.flush()
+        buildings.flush()
+        del old_temperature, old_buildings, temperature, buildings
+    else:
+        pending = list(range(len(hours)))
+    logging.info(f"{len(hours) - len(pending)} hours are already in the cube")
+    
+    successful = 0
+    failed = 0
+    try:
+        with worker_pool(max_workers, pool_options, 'cube') as executor:
+            futures = {executor.submit(process_cube_hour, (hours[index][1], index, tmp_path, area, input_folder,
+                                                           cube_options)): index
+                       for index in pending}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Writing raster cube"):
+                index = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logging.error(f"Error in future: {str(e)}")
+                    ok = False
+                if ok:
+                    cube_manifest['fingerprints'][index] = fingerprints[index]
+                    successful += 1
+                else:
+                    failed += 1
         
-        logging.info(f"Successfully processed {filename} for district {district_gid}")
+        # Hours that failed stay NaN and have no fingerprint, so the next run retries them
+        write_manifest(tmp_path, cube_manifest)
+        if os.path.exists(cube_path):
+            shutil.rmtree(cube_path)
+        os.rename(tmp_path, cube_path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    
+    logging.info(f"Cube written to {cube_path} ({len(hours)} hours, {width}x{height} pixels)")
+    return successful, failed
+
+def process_file_tiles(args):
+    """Render the tile pyramid of a single CSV file (or store)."""
+    filename, input_folder, output_folder, geometry, tile_options = args
+    annotate(file=filename)
+    
+    try:
+        with phase('read'):
+            df = read_table(os.path.join(input_folder, filename), HOUR_COLUMNS)
+        create_tiles(df, os.path.join(output_folder, table_base(filename)), geometry, table_base(filename),
+                     **tile_options)
         return True
     except Exception as e:
-        logging.error(f"Error processing {filename} for district {district_gid}: {str(e)}")
+        logging.error(f"Error processing tiles for {filename}: {str(e)}")
         return False
 
-def process_all_files(input_folder, output_folder, geojson_path, resolution, cmap, vmin, vmax, max_workers=8):
+def process_tiles(csv_files, geometry, input_folder, output_folder, tile_options, pool_options, max_workers,
+                  on_result=None, claim=None):
+    """Render one tile pyramid per hour file for the whole geometry.
+
+    claim(filename) tells whether this run may render an hour; on_result(filename, ok) is
+    called for every rendered hour.
+    """
+    logging.info(f"Total number of tile pyramids to render: {len(csv_files)}")
+    
+    successful = 0
+    failed = 0
+    with worker_pool(max_workers, pool_options, 'tiles') as executor, \
+            tqdm(total=len(csv_files), desc="Rendering tile pyramids") as pbar:
+        def claimed_files():
+            for filename in csv_files:
+                if claim is None or claim(filename):
+                    yield filename, input_folder, output_folder, geometry, tile_options
+                else:
+                    pbar.update(1)
+        
+        for (filename, *_), ok in bounded_map(executor, process_file_tiles, claimed_files(),
+                                              pending_limit(max_workers)):
+            if ok:
+                successful += 1
+            else:
+                failed += 1
+            if on_result:
+                on_result(filename, bool(ok))
+            pbar.update(1)
+    
+    return successful, failed
+
+def write_tile_index(output_folder, geometry, zoom_min, zoom_max):
+    """Write tiles.json with the hours, zoom range and lat/lng bounds for the Leaflet tile layer."""
+    transformer = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    x_min, y_min, x_max, y_max = geometry.bounds
+    west, south = transformer.transform(x_min, y_min)
+    east, north = transformer.transform(x_max, y_max)
+    hours = sorted(name for name in os.listdir(output_folder)
+                   if os.path.isdir(os.path.join(output_folder, name)) and '.tmp-' not in name)
+    index = {
+        'tiles': '{hour}/{z}/{x}/{y}.png',
+        'tile_size': TILE_SIZE,
+        'minzoom': zoom_min,
+        'maxzoom': zoom_max,
+        'bounds': [[south, west], [north, east]],
+        'hours': hours,
+    }
+    with open(os.path.join(output_folder, 'tiles.json'), 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+
+def process_all_files(input_folder, output_folder, geojson_path, resolution, cmap, vmin, vmax, max_workers=8,
+                      cache_dir=None, schedule='file', renderer='matplotlib', force=False, output_mode='districts',
+                      zoom_min=10, zoom_max=15, pixel_size=None, tile_rows=None, chunk_size=4, max_tasks_per_child=None,
+                      shard=None, queue=None, verify=False, png_format='rgba', compress_level=6, variables=None,
+                      plan_cache_mb=PLAN_CACHE_MB):
+    """Render all outputs of output_mode that are not up to date.
+
+    variables is a list of layer dicts (name, cmap, vmin, vmax, see parse_variable) rendered into
+    one subfolder of output_folder each (output_mode 'districts'); by default the temperatures
+    are rendered with cmap, vmin and vmax into output_folder.
+    shard (index, count) and queue (WorkQueue) split the work between several runs sharing
+    output_folder. With verify=True nothing is rendered; the outputs of all runs are checked
+    and the number of missing or failed ones is returned. plan_cache_mb is the memory
+    budget of the interpolation plans each worker keeps.
+    """
     logging.info(f"Starting to process files from {input_folder}")
     logging.info(f"Output will be saved to {output_folder}")
 
@@ -196,56 +1089,195 @@ def process_all_files(input_folder, output_folder, geojson_path, resolution, cma
         os.makedirs(output_folder)
         logging.info(f"Created output folder: {output_folder}")
 
-    # Read all CSV files
-    csv_files = [f for f in os.listdir(input_folder) if f.endswith('.csv')]
-    logging.info(f"Found {len(csv_files)} CSV files")
+    # Read all CSV files and columnar stores
+    csv_files = list_tables(input_folder)
+    logging.info(f"Found {len(csv_files)} CSV files / stores")
 
     if not csv_files:
-        logging.warning("No CSV files found in the input folder!")
-        return
+        logging.warning("No CSV files or stores found in the input folder!")
+        return 0
 
-    # Read GeoJSON file and prepare district information
-    gdf = gpd.read_file(geojson_path)
-    districts = [{'gid': row['gid'], 'geometry': row['geometry']} 
-                for _, row in gdf.iterrows()]
+    # Read GeoJSON file (or its cached geometry set) and prepare district information
+    geometry_set = load_geometries(geojson_path, cache_dir)
+    districts = district_list(geometry_set)
     logging.info(f"Found {len(districts)} districts in GeoJSON")
 
-    # Create all combinations of CSV files and districts
-    combinations = list(product(csv_files, districts))
-    logging.info(f"Total number of combinations to process: {len(combinations)}")
-
-    # Prepare arguments for parallel processing
-    process_args = [
-        (filename, district, input_folder, output_folder, resolution, cmap, vmin, vmax)
-        for filename, district in combinations
-    ]
-
-    # Process files in parallel
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(process_file_and_district, args) for args in process_args]
-
-        # Track progress with tqdm
-        successful = 0
-        failed = 0
-        for future in tqdm(as_completed(futures), total=len(futures), 
-                         desc="Processing file-district combinations"):
-            try:
-                if future.result():
-                    successful += 1
-                else:
-                    failed += 1
-            except Exception as e:
-                logging.error(f"Error in future: {str(e)}")
-                failed += 1
+    # Every worker loads the districts and the colormap once (see init_worker)
+    pool_options = {'geojson_path': geojson_path, 'cache_dir': cache_dir, 'cmap': cmap, 'chunk_size': chunk_size,
+                    'max_tasks_per_child': max_tasks_per_child, 'metrics': metrics_settings(),
+                    'plan_cache_mb': plan_cache_mb}
+    render_options = {'resolution': resolution, 'cache_dir': cache_dir, 'renderer': renderer, 'tile_rows': tile_rows,
+                      'png_format': png_format, 'compress_level': compress_level}
+    if variables is None:
+        layers = [{'name': 'temperatur', 'cmap': cmap, 'vmin': vmin, 'vmax': vmax, 'folder': output_folder}]
+    else:
+        layers = [dict(variable, folder=os.path.join(output_folder, variable['name'])) for variable in variables]
+
+    manifest = BuildManifest(output_folder, force)
+
+    # A unit is the list of (output, fingerprint) rendered together (all layers of a district)
+    def unit_key(unit):
+        return claim_key(manifest.key(unit[0][0]), [fingerprint for _, fingerprint in unit])
+
+    def claim(unit):
+        # Called right before rendering, so runs sharing the queue split the remaining work
+        return queue is None or queue.claim(unit_key(unit), [output for output, _ in unit])
+
+    def report(unit, ok):
+        if ok:
+            for output, fingerprint in unit:
+                manifest.record(output, fingerprint)
+        if queue is not None:
+            key = unit_key(unit)
+            if ok:
+                queue.finish(key)
+            else:
+                queue.fail(key, "rendering failed (see the log of this run)")
+
+    if output_mode == 'cube':
+        # One time series cube for the whole area, on the grid of --schedule city
+        area = geometry_set.area
+        if pixel_size is None:
+            pixel_size = default_pixel_size(districts, resolution)
+        logging.info(f"Cube pixel size: {pixel_size:.2f}")
+        area_name = os.path.splitext(os.path.basename(geojson_path))[0]
+        if verify:
+            cube_path = os.path.join(output_folder, f"{area_name}{CUBE_SUFFIX}")
+            _, fingerprints = cube_hours(csv_files, area, input_folder, pixel_size, manifest)
+            current = is_cube(cube_path) and read_manifest(cube_path)['fingerprints'] == fingerprints
+            return verify_outputs([(cube_path, current, None)])
+        cube_options = {'pixel_size': pixel_size, 'cache_dir': cache_dir}
+        successful, failed = process_cube(csv_files, area, area_name, input_folder, output_folder, cube_options,
+                                          pool_options, max_workers, manifest)
+        logging.info(f"Processing completed. Successful: {successful}, Failed: {failed}")
+        return 0
+
+    if output_mode == 'tiles':
+        # One render of the whole area per hour instead of one per district
+        geometry = geometry_set.area
+        tile_options = {'zoom_min': zoom_min, 'zoom_max': zoom_max, 'cmap': cmap, 'vmin': vmin, 'vmax': vmax,
+                        'cache_dir': cache_dir}
+        params = {'zoom_min': zoom_min, 'zoom_max': zoom_max, 'cmap': cmap, 'vmin': vmin, 'vmax': vmax,
+                  'geometry': geometry_hash(geometry)}
+        outputs = {}
+        for filename in csv_files:
+            fingerprint = manifest.fingerprint([os.path.join(input_folder, filename)], params)
+            outputs[filename] = [(os.path.join(output_folder, table_base(filename)), fingerprint)]
+        
+        if verify:
+            manifest.save()
+            write_tile_index(output_folder, geometry, zoom_min, zoom_max)
+            return verify_outputs([(tile_dir, manifest.is_current(tile_dir, fingerprint), unit_key(unit))
+                                   for unit in outputs.values() for tile_dir, fingerprint in unit], queue)
+        
+        pending = [filename for filename, [(tile_dir, fingerprint)] in outputs.items()
+                   if not manifest.is_current(tile_dir, fingerprint)]
+        logging.info(f"{len(csv_files) - len(pending)} tile pyramids are already up to date")
+        pending = [filename for filename in pending if in_shard(manifest.key(outputs[filename][0][0]), shard)]
+
+        try:
+            successful, failed = process_tiles(pending, geometry, input_folder, output_folder,
+                                               tile_options, pool_options, max_workers,
+                                               lambda filename, ok: report(outputs[filename], ok),
+                                               lambda filename: claim(outputs[filename]))
+        finally:
+            manifest.save()
+        write_tile_index(output_folder, geometry, zoom_min, zoom_max)
+
+        logging.info(f"Processing completed. Successful: {successful}, Failed: {failed}")
+        return 0
+
+    # Only render images whose hour file, district geometry or render settings changed
+    params = {'resolution': resolution, 'renderer': renderer}
+    if schedule == 'city':
+        area = geometry_set.area
+        if pixel_size is None:
+            pixel_size = default_pixel_size(districts, resolution)
+        logging.info(f"City grid pixel size: {pixel_size:.2f}")
+        city_options = {'pixel_size': pixel_size, 'cache_dir': cache_dir, 'png_format': png_format,
+                        'compress_level': compress_level}
+        params = {'schedule': 'city', 'pixel_size': pixel_size, 'area': geometry_hash(area)}
+    # Only part of the fingerprint when not the default, so existing images stay current
+    if png_format != 'rgba':
+        params['png_format'] = png_format
+    if compress_level != 6:
+        params['compress_level'] = compress_level
+    layer_params = []
+    for layer in layers:
+        layer_params.append(dict(params, cmap=layer['cmap'], vmin=layer['vmin'], vmax=layer['vmax']))
+        if variables is not None:
+            layer_params[-1]['variable'] = layer['name']
+    geometry_hashes = [geometry_hash(district['geometry']) for district in districts]
+    outputs = {}
+    with phase('fingerprints'):
+        for filename in csv_files:
+            for district in districts:
+                outputs[(filename, district['index'])] = [
+                    (district_png_path(layer['folder'], filename, district['gid']),
+                     manifest.fingerprint([os.path.join(input_folder, filename)],
+                                          dict(layer_param, geometry=geometry_hashes[district['index']])))
+                    for layer, layer_param in zip(layers, layer_params)]
+    
+    if verify:
+        manifest.save()
+        return verify_outputs([(output_png, manifest.is_current(output_png, fingerprint), unit_key(unit))
+                               for unit in outputs.values() for output_png, fingerprint in unit], queue)
+    
+    for layer in layers:
+        os.makedirs(layer['folder'], exist_ok=True)
+    jobs = []
+    current = 0
+    for filename in csv_files:
+        pending = []
+        for district in districts:
+            unit = outputs[(filename, district['index'])]
+            # A district is rendered again with all of its layers when one of them is not current
+            if all(manifest.is_current(output_png, fingerprint) for output_png, fingerprint in unit):
+                current += 1
+            elif in_shard(manifest.key(unit[0][0]) if schedule == 'combination' else table_base(filename), shard):
+                # Shards split hour files (parsed once for all of their districts) or single combinations
+                pending.append(district)
+        if pending:
+            jobs.append((filename, pending))
+    logging.info(f"{current * len(layers)} images are already up to date")
+
+    def claim_districts(filename, districts):
+        return [district for district in districts if claim(outputs[(filename, district['index'])])]
+
+    def report_district(filename, index, ok):
+        report(outputs[(filename, index)], ok)
+
+    # With tile_rows the plans are built on disk and read band by band (see stream_heatmap),
+    # so without a cache folder they go to one of this run, shared by its workers
+    plan_dir = None
+    if tile_rows and render_options['cache_dir'] is None and schedule != 'city':
+        plan_dir = tempfile.mkdtemp(prefix='heatmap_plans_')
+        render_options['cache_dir'] = plan_dir
+
+    try:
+        if schedule == 'city':
+            successful, failed = process_city(jobs, area, input_folder, layers, city_options, pool_options,
+                                              max_workers, report_district, claim_districts)
+        elif schedule == 'file':
+            successful, failed = process_file_major(jobs, input_folder, layers, render_options, pool_options,
+                                                    max_workers, report_district, claim_districts)
+        else:
+            successful, failed = process_combinations(jobs, input_folder, layers, render_options,
+                                                      pool_options, max_workers, report_district, claim_districts)
+    finally:
+        manifest.save()
+        if plan_dir is not None:
+            shutil.rmtree(plan_dir, ignore_errors=True)
 
     logging.info(f"Processing completed. Successful: {successful}, Failed: {failed}")
+    return 0
 
 #Logging
 if __name__ == "__main__":
     # Parse command line arguments
     import argparse
     parser = argparse.ArgumentParser(description="Generate heatmaps from CSV data with GeoJSON filters")
-    parser.add_argument("input_folder", help="Path to folder containing input CSV files")
+    parser.add_argument("input_folder", help="Path to folder containing input CSV files or .npcols stores")
     parser.add_argument("output_folder", help="Path to folder for output files")
     parser.add_argument("geojson_path", help="Path to GeoJSON file containing district geometries")
     parser.add_argument("--resolution", type=int, default=5120, help="Resolution of the output image")
@@ -253,8 +1285,94 @@ if __name__ == "__main__":
     parser.add_argument("--vmin", type=float, default=10, help="Minimum temperature for color scaling")
     parser.add_argument("--vmax", type=float, default=36, help="Maximum temperature for color scaling")
     parser.add_argument("--max_workers", type=int, default=4, help="Number of parallel workers")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Folder for cached interpolation plans, point labels, geometries and raster masks "
+                             "(reused across hour files and runs)")
+    parser.add_argument("--plan_cache_mb", type=int, default=PLAN_CACHE_MB,
+                        help="Memory each worker may use to keep interpolation plans between hour files (plans "
+                             "memory-mapped from --cache_dir do not count; larger plans are rebuilt every hour)")
+    parser.add_argument("--schedule", choices=["file", "combination", "city"], default="file",
+                        help="'file' parses each hour file once for all districts, "
+                             "'combination' reads the file again for every batch of --chunk_size districts, "
+                             "'city' interpolates the whole area once per hour at --pixel_size and crops "
+                             "every district from it")
+    parser.add_argument("--pixel_size", type=float, default=None,
+                        help="Ground size of a pixel for --schedule city and --output_mode cube (default: the "
+                             "size the largest district gets at --resolution)")
+    parser.add_argument("--renderer", choices=["matplotlib", "direct"], default="matplotlib",
+                        help="'direct' applies the colormap with NumPy and writes the PNG without a "
+                             "matplotlib figure (same pixels)")
+    parser.add_argument("--tile_rows", type=int, default=None,
+                        help="With --renderer direct: interpolate, colour and encode each image in bands of this "
+                             "many rows, so memory per worker does not grow with --resolution (same pixels)")
+    parser.add_argument("--variables", nargs='+', default=None, metavar="NAME[:CMAP[:VMIN[:VMAX]]]",
+                        help="Render several variables from one interpolation setup, each into a subfolder of "
+                             "output_folder: temperatur, messung, genauigkeit or pet (derived as in build_db.sql); "
+                             "cmap, vmin and vmax default to --cmap, --vmin and --vmax "
+                             "(e.g. temperatur pet:RdBu_r:15:41 genauigkeit:viridis:0:1)")
+    parser.add_argument("--png_format", choices=["rgba", "palette"], default="rgba",
+                        help="'palette' writes 8 bit indexed PNGs with the colours of the colormap (same pixels, "
+                             "smaller files; needs --renderer direct or --schedule city)")
+    parser.add_argument("--png_compression", type=int, default=6, choices=range(10), metavar="0-9",
+                        help="zlib compression level of the PNGs (0 = none, 9 = smallest)")
+    parser.add_argument("--chunk_size", type=int, default=4,
+                        help="Districts of one hour file rendered per task (--schedule file and combination)")
+    parser.add_argument("--max_tasks_per_child", type=int, default=None,
+                        help="Replace a worker process after this many tasks to cap its memory (Python 3.11 or newer; "
+                             "default: never)")
+    parser.add_argument("--shard", default=None,
+                        help="Only render shard i/N (0 <= i < N) of the hour files ('combination': of the "
+                             "file-district combinations); several runs with the same N cover everything")
+    parser.add_argument("--queue_dir", default=None,
+                        help="Shared folder for claim files: every output is rendered by the first run (on any "
+                             "machine) that claims it")
+    parser.add_argument("--claim_timeout", type=float, default=None,
+                        help="Take over claims of other runs that are older than this many seconds "
+                             "(default: never, e.g. after a crashed run)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Render nothing, report missing, out of date or failed outputs of all shards / runs "
+                             "(exit code 1 if there are any)")
+    parser.add_argument("--force", action="store_true", help="Render all images, even if they are up to date")
+    parser.add_argument("--output_mode", choices=["districts", "tiles", "cube"], default="districts",
+                        help="'districts' writes one PNG per district, 'tiles' renders the whole area once per "
+                             "hour as XYZ tile pyramid <hour>/{z}/{x}/{y}.png for Leaflet, 'cube' writes the "
+                             "float32 temperature grids of all hours into one memory-mapped <geojson>.cube "
+                             "(grid of --schedule city)")
+    parser.add_argument("--zoom_min", type=int, default=10, help="Lowest zoom level of the tile pyramid")
+    parser.add_argument("--zoom_max", type=int, default=15,
+                        help="Highest zoom level of the tile pyramid (rendered, lower levels are downsampled)")
+    parser.add_argument("--metrics_out", default=None,
+                        help="Append wall time, CPU time and peak RSS of every phase, file-district task, pool task "
+                             "and pool to this JSONL file (report: python run_metrics.py <file>)")
 
     args = parser.parse_args()
+    if args.zoom_min > args.zoom_max:
+        parser.error("--zoom_min must not be larger than --zoom_max")
+    if args.chunk_size < 1 or (args.max_tasks_per_child is not None and args.max_tasks_per_child < 1):
+        parser.error("--chunk_size and --max_tasks_per_child must be positive")
+    if args.max_tasks_per_child is not None and sys.version_info < (3, 11):
+        parser.error("--max_tasks_per_child needs Python 3.11 or newer")
+    if args.plan_cache_mb < 0:
+        parser.error("--plan_cache_mb must not be negative")
+    if args.output_mode == 'cube' and (args.shard or args.queue_dir):
+        parser.error("--shard and --queue_dir are not supported with --output_mode cube (one output)")
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.tile_rows is not None and (args.renderer != 'direct' or args.tile_rows < 1):
+        parser.error("--tile_rows needs --renderer direct and a positive number of rows")
+    if args.variables and args.output_mode != 'districts':
+        parser.error("--variables is only supported with --output_mode districts")
+    try:
+        variables = ([parse_variable(value, args.cmap, args.vmin, args.vmax) for value in args.variables]
+                     if args.variables else None)
+    except ValueError as e:
+        parser.error(str(e))
+    if variables and len({variable['name'] for variable in variables}) < len(variables):
+        parser.error("Every variable can only be given once")
+    if args.png_format == 'palette' and args.renderer != 'direct' and args.schedule != 'city':
+        parser.error("--png_format palette needs --renderer direct or --schedule city")
     
     logging.info("Script started with the following arguments:")
     logging.info(f"Input folder: {args.input_folder}")
@@ -264,9 +1382,39 @@ if __name__ == "__main__":
     logging.info(f"Colormap: {args.cmap}")
     logging.info(f"vmin: {args.vmin}")
     logging.info(f"vmax: {args.vmax}")
+    if variables:
+        logging.info("Variables: " + ", ".join(f"{v['name']} ({v['cmap']}, {v['vmin']}-{v['vmax']})" for v in variables))
     logging.info(f"max_workers: {args.max_workers}")
+    logging.info(f"Cache folder: {args.cache_dir}")
+    logging.info(f"Plan cache: {args.plan_cache_mb} MB")
+    logging.info(f"Schedule: {args.schedule}")
+    if args.schedule == 'city' or args.output_mode == 'cube':
+        logging.info(f"Pixel size: {args.pixel_size}")
+    logging.info(f"Renderer: {args.renderer}")
+    logging.info(f"Tile rows: {args.tile_rows}")
+    logging.info(f"PNG format: {args.png_format} (compression {args.png_compression})")
+    logging.info(f"Chunk size: {args.chunk_size}")
+    logging.info(f"Max tasks per child: {args.max_tasks_per_child}")
+    logging.info(f"Force: {args.force}")
+    logging.info(f"Output mode: {args.output_mode}")
+    if args.output_mode == 'tiles':
+        logging.info(f"Zoom levels: {args.zoom_min}-{args.zoom_max}")
+    logging.info(f"Shard: {args.shard}")
+    logging.info(f"Queue folder: {args.queue_dir}")
+    logging.info(f"Verify: {args.verify}")
+    logging.info(f"Metrics file: {args.metrics_out}")
 
-    process_all_files(args.input_folder, args.output_folder, args.geojson_path, 
-                     args.resolution, args.cmap, args.vmin, args.vmax, args.max_workers)
+    queue = WorkQueue(args.queue_dir, args.claim_timeout) if args.queue_dir else None
+    if args.metrics_out:
+        configure_metrics(args.metrics_out)
+    with measure_run('heatmap_generator_unified', args=vars(args)):
+        problems = process_all_files(args.input_folder, args.output_folder, args.geojson_path, 
+                         args.resolution, args.cmap, args.vmin, args.vmax, args.max_workers,
+                         args.cache_dir, args.schedule, args.renderer, args.force, args.output_mode,
+                         args.zoom_min, args.zoom_max, args.pixel_size, args.tile_rows, args.chunk_size,
+                         args.max_tasks_per_child, shard, queue, args.verify, args.png_format, args.png_compression,
+                         variables, args.plan_cache_mb)
 
-    logging.info("Script execution completed")
\ No newline at end of file
+    logging.info("Script execution completed")
+    if args.verify and problems:
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,268 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import logging
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from transform_to_csv import headers
+from transform_csv_to_epsg3857 import transformer
+from merge_to_single_csv import is_raw_file, parse_file_date
+from columnar_store import STORE_SUFFIX, TableWriter
+from partitioned_dataset import MERGED_FOLDER, PartitionWriter, partition_file
+from build_manifest import BuildManifest
+from work_queue import WorkQueue, bounded_map, claim_key, in_shard, parse_shard, verify_outputs
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Default paths (same as the separate scripts)
+input_folder = './rawdata/Tagesgang/Full'
+output_folder_25832 = './csvdata/multiple_files/epsg25832'
+output_folder_3857 = './csvdata/multiple_files/epsg3857'
+merged_folder = MERGED_FOLDER
+
+def count_rows(path):
+    """Count the lines of a text file without parsing it."""
+    rows = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 24)
+            if not block:
+                break
+            rows += block.count(b'\n')
+            last = block[-1:]
+    return rows + (last != b'\n')
+
+def ingest_file(filename, input_folder, output_folder_25832, output_folder_3857, merged_folder,
+                merged_parts_folder, output_format='csv', chunk_rows=1_000_000):
+    """Stream one raw file once and write every requested output chunk by chunk.
+
+    Memory use is bounded by chunk_rows, independent of the file size.
+    """
+    start_time = time.time()
+    input_path = os.path.join(input_folder, filename)
+    base = filename[:-len('.txt')]
+    date_string_iso = parse_file_date(filename)
+    rows = count_rows(input_path) if output_format == 'npy' else None
+
+    writers = []
+    if output_folder_25832:
+        writer_25832 = TableWriter(os.path.join(output_folder_25832, base), output_format, rows,
+                                   attrs={'crs': 'EPSG:25832', 'source': filename, 'date': date_string_iso})
+        writers.append(writer_25832)
+    if output_folder_3857:
+        writer_3857 = TableWriter(os.path.join(output_folder_3857, base), output_format, rows,
+                                  attrs={'crs': 'EPSG:3857', 'source': filename, 'date': date_string_iso})
+        writers.append(writer_3857)
+    if merged_folder:
+        # Each worker writes its own day/hour partition of the merged dataset
+        partition_writer = PartitionWriter(merged_folder, date_string_iso)
+        writers.append(partition_writer)
+    merged_part = os.path.join(merged_parts_folder, f"{base}.csv") if merged_parts_folder else None
+
+    try:
+        for chunk in pd.read_csv(input_path, sep='\t', header=None, names=headers, chunksize=chunk_rows):
+            if output_folder_25832:
+                writer_25832.write(chunk)
+
+            # Merged dataset keeps EPSG:25832 coordinates plus the date column
+            if merged_folder:
+                partition_writer.write(chunk)
+            if merged_part:
+                chunk.assign(date=date_string_iso).to_csv(merged_part, mode='a', index=False, header=False)
+
+            if output_folder_3857:
+                x, y = transformer.transform(chunk['x'].values, chunk['y'].values)
+                writer_3857.write(chunk.assign(x=x, y=y))
+
+        for writer in writers:
+            writer.close()
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    return filename, time.time() - start_time
+
+def ingest_task(args):
+    return ingest_file(*args)
+
+def planned_outputs(filename, input_folder, manifests, output_format):
+    """(manifest, output path, fingerprint) of every output ingest_file writes for a raw file.
+
+    Uses the same fingerprints as transform_to_csv.py and merge_to_single_csv.py.
+    """
+    base = filename[:-len('.txt')]
+    suffix = STORE_SUFFIX if output_format == 'npy' else '.csv'
+    input_path = os.path.join(input_folder, filename)
+    outputs = []
+    for folder, manifest in manifests.items():
+        if folder == 'merged':
+            continue
+        fingerprint = manifest.fingerprint([input_path], {'format': output_format})
+        outputs.append((manifest, os.path.join(folder, base) + suffix, fingerprint))
+    if 'merged' in manifests:
+        manifest = manifests['merged']
+        outputs.append((manifest, partition_file(manifest.folder, parse_file_date(filename)),
+                        manifest.fingerprint([input_path])))
+    return outputs
+
+def ingest_all(input_folder, output_folder_25832, output_folder_3857, merged_folder, merged_file=None,
+               output_format='csv', max_workers=None, chunk_rows=1_000_000, force=False,
+               shard=None, queue=None, verify=False):
+    """Ingest every raw file whose outputs are not up to date.
+
+    shard (index, count) and queue (WorkQueue) split the raw files between several runs
+    (not together with merged_file). With verify=True nothing is ingested; the outputs of
+    all runs are checked and the number of missing or failed ones is returned.
+    """
+    files = sorted(f for f in os.listdir(input_folder) if is_raw_file(f))
+    logging.info(f"Found {len(files)} raw files in {input_folder}")
+    if not files:
+        return 0
+
+    for folder in (output_folder_25832, output_folder_3857):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    # One manifest per output folder, shared with the separate scripts
+    manifests = {folder: BuildManifest(folder, force)
+                 for folder in (output_folder_25832, output_folder_3857) if folder}
+    if merged_folder:
+        manifests['merged'] = BuildManifest(merged_folder, force)
+
+    merged_manifest = None
+    if merged_file:
+        merged_manifest = BuildManifest(os.path.dirname(merged_file) or '.', force)
+        merged_fingerprint = merged_manifest.fingerprint([os.path.join(input_folder, f) for f in files])
+
+    # The old single merged file needs the parts of every raw file
+    rebuild_all = merged_manifest is not None and not merged_manifest.is_current(merged_file, merged_fingerprint)
+    outputs = {filename: planned_outputs(filename, input_folder, manifests, output_format) for filename in files}
+    # One queue entry per raw file, covering all of its outputs
+    keys = {filename: claim_key(filename, [fingerprint for _, _, fingerprint in outputs[filename]])
+            for filename in files}
+
+    if verify:
+        for manifest in manifests.values():
+            manifest.save()
+        return verify_outputs([(path, manifest.is_current(path, fingerprint), keys[filename])
+                               for filename in files for manifest, path, fingerprint in outputs[filename]], queue)
+
+    pending = [filename for filename in files
+               if rebuild_all or not all(manifest.is_current(path, fingerprint)
+                                         for manifest, path, fingerprint in outputs[filename])]
+    logging.info(f"{len(files) - len(pending)} raw files are already up to date")
+    pending = [filename for filename in pending if in_shard(filename, shard)]
+    if not pending:
+        return 0
+
+    def claimed_files():
+        # Claimed right before submitting, so runs sharing the queue split the remaining files
+        for filename in pending:
+            if queue is None or queue.claim(keys[filename], [path for _, path, _ in outputs[filename]]):
+                yield filename
+
+    merged_parts_folder = None
+    if rebuild_all:
+        os.makedirs(os.path.dirname(merged_file) or '.', exist_ok=True)
+        merged_parts_folder = tempfile.mkdtemp(prefix='merged_parts_', dir=os.path.dirname(merged_file) or '.')
+
+    successful = []
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            tasks = ((filename, input_folder, output_folder_25832, output_folder_3857, merged_folder,
+                      merged_parts_folder, output_format, chunk_rows) for filename in claimed_files())
+            for (filename, *_), result in tqdm(bounded_map(executor, ingest_task, tasks,
+                                                           2 * (max_workers or os.cpu_count() or 1)),
+                                               total=len(pending), desc="Ingesting raw files"):
+                if result is None:
+                    logging.error(f"Error ingesting {filename}")
+                    failed += 1
+                    if queue is not None:
+                        queue.fail(keys[filename], "ingest failed (see the log of this run)")
+                    continue
+                successful.append(filename)
+                for manifest, path, fingerprint in outputs[filename]:
+                    manifest.record(path, fingerprint)
+                if queue is not None:
+                    queue.finish(keys[filename])
+                logging.info(f"Ingested {filename} in {result[1]:.2f} seconds")
+
+        if merged_parts_folder:
+            # Concatenate the per-file parts in file order (plain byte copy, no parsing)
+            tmp_file = f"{merged_file}.tmp"
+            with open(tmp_file, 'wb') as out:
+                out.write((','.join(headers + ['date']) + '\n').encode())
+                for filename in sorted(successful):
+                    part = os.path.join(merged_parts_folder, f"{filename[:-len('.txt')]}.csv")
+                    with open(part, 'rb') as f:
+                        shutil.copyfileobj(f, out, 1 << 24)
+            os.replace(tmp_file, merged_file)
+            if not failed:
+                merged_manifest.record(merged_file, merged_fingerprint)
+            logging.info(f"Merged data written to {merged_file}")
+    finally:
+        if merged_parts_folder:
+            shutil.rmtree(merged_parts_folder, ignore_errors=True)
+        for manifest in list(manifests.values()) + [merged_manifest]:
+            if manifest is not None:
+                manifest.save()
+
+    logging.info(f"Ingest completed. Successful: {len(successful)}, Failed: {failed}")
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Read every raw Tagesgang file once and write the EPSG:25832 and EPSG:3857 "
+                    "per-hour files and the merged dataset in one pass")
+    parser.add_argument("--input_folder", default=input_folder, help="Folder with raw .txt files")
+    parser.add_argument("--output_25832", default=output_folder_25832,
+                        help="Folder for per-hour EPSG:25832 files ('' to skip)")
+    parser.add_argument("--output_3857", default=output_folder_3857,
+                        help="Folder for per-hour EPSG:3857 files ('' to skip)")
+    parser.add_argument("--merged_folder", default=merged_folder,
+                        help="Root of the day/hour partitioned merged dataset ('' to skip)")
+    parser.add_argument("--merged_file", default='', help="Additionally write the old single merged CSV file")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv",
+                        help="Format of the per-hour files ('npy' writes .npcols stores)")
+    parser.add_argument("--max_workers", type=int, default=None, help="Number of parallel workers (default: all cores)")
+    parser.add_argument("--chunk_rows", type=int, default=1_000_000,
+                        help="Rows parsed at once per worker (bounds memory per worker)")
+    parser.add_argument("--shard", default=None,
+                        help="Only ingest shard i/N (0 <= i < N) of the raw files; several runs with the same N "
+                             "cover everything")
+    parser.add_argument("--queue_dir", default=None,
+                        help="Shared folder for claim files: every raw file is ingested by the first run (on any "
+                             "machine) that claims it")
+    parser.add_argument("--claim_timeout", type=float, default=None,
+                        help="Take over claims of other runs that are older than this many seconds (default: never)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Ingest nothing, report missing, out of date or failed outputs of all shards / runs "
+                             "(exit code 1 if there are any)")
+    parser.add_argument("--force", action="store_true", help="Ingest all raw files, even if their outputs are up to date")
+    args = parser.parse_args()
+    if args.merged_file and (args.shard or args.queue_dir):
+        parser.error("--merged_file needs all raw files and cannot be combined with --shard or --queue_dir")
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.info("Script started with the following arguments:")
+    for name, value in vars(args).items():
+        logging.info(f"{name}: {value}")
+
+    queue = WorkQueue(args.queue_dir, args.claim_timeout) if args.queue_dir else None
+    problems = ingest_all(args.input_folder, args.output_25832, args.output_3857, args.merged_folder,
+                          args.merged_file, args.format, args.max_workers, args.chunk_rows, args.force,
+                          shard, queue, args.verify)
+
+    logging.info("Script execution completed")
+    if args.verify and problems:
+        sys.exit(1)
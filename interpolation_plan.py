@@ -0,0 +1,337 @@
+import os
+import shutil
+import hashlib
+import logging
+import numpy as np
+from scipy.spatial import Delaunay, cKDTree
+from lru_cache import LRUCache
+
+# Bump whenever the on-disk layout or the way plans are computed changes
+PLAN_VERSION = 1
+
+# Default memory budget of the plans each process keeps (--plan_cache_mb)
+PLAN_CACHE_MB = 1024
+
+# Number of plans each process keeps at most (plans memory-mapped from cache_dir only count here)
+MEMORY_CACHE_SIZE = 64
+
+# Pixels whose coordinates are generated at once while building a plan
+BUILD_BLOCK_PIXELS = 1 << 20
+
+_plan_cache = LRUCache(PLAN_CACHE_MB << 20, lambda plan: plan.resident_nbytes, MEMORY_CACHE_SIZE)
+
+class PointTriangulation:
+    """Nearest neighbour tree of all points and Delaunay triangulation of the non-building points.
+
+    Only depends on the points, so one triangulation serves the plans of any grid
+    (see InterpolationPlan.from_triangulation).
+    """
+
+    def __init__(self, x_coords, y_coords, building_mask):
+        points = np.column_stack((x_coords, y_coords)).astype(np.float64)
+
+        # Nearest neighbour over all points (used for the building mask)
+        self.tree = cKDTree(points)
+
+        # Linear interpolation only uses the non-building points
+        self.non_building = np.flatnonzero(~np.asarray(building_mask, dtype=bool))
+        self.tri = Delaunay(points[self.non_building])
+
+    def plan_block(self, grid_x, grid_y, width, block):
+        """Plan arrays for a block of flat pixel indices: nearest, linear_pixels, vertices, weights."""
+        rows, cols = np.divmod(block, width)
+        xi = np.column_stack((grid_x[cols], grid_y[rows]))
+
+        _, nearest = self.tree.query(xi)
+
+        simplex = self.tri.find_simplex(xi)
+        inside = simplex >= 0
+        simplex = simplex[inside]
+
+        # Barycentric coordinates, evaluated in the same order as scipy's LinearNDInterpolator
+        transform = self.tri.transform[simplex]
+        delta = xi[inside] - transform[:, 2, :]
+        c0 = transform[:, 0, 0] * delta[:, 0] + transform[:, 0, 1] * delta[:, 1]
+        c1 = transform[:, 1, 0] * delta[:, 0] + transform[:, 1, 1] * delta[:, 1]
+        weights = np.column_stack((c0, c1, 1.0 - c0 - c1))
+        vertices = self.non_building[self.tri.simplices[simplex]].astype(np.int32)
+        return nearest.astype(np.int32), block[inside], vertices, weights
+
+    @property
+    def nbytes(self):
+        """Approximate memory use: points and index of the tree, simplices, neighbours and transforms."""
+        points = len(self.tree.data)
+        simplices = len(self.tri.simplices)
+        return points * 24 + self.non_building.nbytes + self.tri.points.nbytes + simplices * (12 + 12 + 48 + 24)
+
+class InterpolationPlan:
+    """Precomputed interpolation of a fixed point set onto a regular grid.
+
+    Holds the barycentric weights of the Delaunay triangulation (same result as
+    griddata(method='linear')) and the nearest point index (same result as
+    griddata(method='nearest')) for every output pixel, so that interpolating a
+    new value column is just a weighted gather.
+    """
+
+    ARRAYS = ('pixels', 'nearest', 'linear_pixels', 'vertices', 'weights')
+
+    def __init__(self, width, height, pixels, nearest, linear_pixels, vertices, weights):
+        self.width = width
+        self.height = height
+        self.pixels = pixels                # flat indices of the pixels covered by the plan
+        self.nearest = nearest              # nearest point for each of those pixels
+        self.linear_pixels = linear_pixels  # flat indices of the pixels inside the triangulation
+        self.vertices = vertices            # (n, 3) point indices of the enclosing triangle
+        self.weights = weights              # (n, 3) barycentric weights
+
+    @classmethod
+    def build(cls, x_coords, y_coords, building_mask, bounds, width, height, pixel_mask=None,
+              block_pixels=BUILD_BLOCK_PIXELS):
+        """Triangulate the points and compute weights for the grid spanning bounds.
+
+        Pixel coordinates are generated block by block (block_pixels at a time) instead
+        of as a full meshgrid, so building a plan only needs memory for the result.
+        """
+        return cls.from_triangulation(PointTriangulation(x_coords, y_coords, building_mask), bounds, width, height,
+                                      pixel_mask, block_pixels)
+
+    @classmethod
+    def from_triangulation(cls, triangulation, bounds, width, height, pixel_mask=None,
+                           block_pixels=BUILD_BLOCK_PIXELS):
+        """Compute the weights for the grid spanning bounds from an existing PointTriangulation."""
+        x_min, y_min, x_max, y_max = bounds
+        if pixel_mask is None:
+            pixels = np.arange(width * height, dtype=np.int64)
+        else:
+            pixels = np.flatnonzero(pixel_mask).astype(np.int64)
+
+        grid_x = np.linspace(x_min, x_max, width)
+        grid_y = np.linspace(y_min, y_max, height)
+
+        nearest = np.empty(len(pixels), dtype=np.int32)
+        linear_pixels, vertices, weights = [], [], []
+        for start in range(0, len(pixels), block_pixels):
+            block = pixels[start:start + block_pixels]
+            block_nearest, block_linear, block_vertices, block_weights = triangulation.plan_block(grid_x, grid_y,
+                                                                                                 width, block)
+            nearest[start:start + len(block)] = block_nearest
+            linear_pixels.append(block_linear)
+            vertices.append(block_vertices)
+            weights.append(block_weights)
+
+        return cls(
+            width,
+            height,
+            pixels,
+            nearest,
+            np.concatenate(linear_pixels) if linear_pixels else np.empty(0, dtype=np.int64),
+            np.concatenate(vertices) if vertices else np.empty((0, 3), dtype=np.int32),
+            np.concatenate(weights) if weights else np.empty((0, 3), dtype=np.float64)
+        )
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    @property
+    def resident_nbytes(self):
+        """Bytes of the arrays held in memory (memory-mapped arrays are paged in and out by the kernel)."""
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS
+                   if not isinstance(getattr(self, name), np.memmap))
+
+    def row_ranges(self, row0, row1):
+        """Slices of the plan arrays that cover the grid rows row0..row1 (pixels are sorted)."""
+        first, last = row0 * self.width, row1 * self.width
+        p0, p1 = np.searchsorted(self.pixels, [first, last])
+        l0, l1 = np.searchsorted(self.linear_pixels, [first, last])
+        return slice(p0, p1), slice(l0, l1)
+
+    def linear_rows(self, values, row0, row1, fill_value=np.nan):
+        """Interpolate a value column linearly onto the grid rows row0..row1."""
+        values = np.asarray(values, dtype=np.float64)
+        _, linear = self.row_ranges(row0, row1)
+        grid = np.full((row1 - row0) * self.width, fill_value, dtype=np.float64)
+        gathered = values[self.vertices[linear]]
+        weights = self.weights[linear]
+        grid[self.linear_pixels[linear] - row0 * self.width] = (
+            weights[:, 0] * gathered[:, 0]
+            + weights[:, 1] * gathered[:, 1]
+            + weights[:, 2] * gathered[:, 2]
+        )
+        return grid.reshape(row1 - row0, self.width)
+
+    def nearest_rows(self, values, row0, row1, fill_value=0):
+        """Assign the grid rows row0..row1 the value of their nearest point."""
+        values = np.asarray(values)
+        covered, _ = self.row_ranges(row0, row1)
+        grid = np.full((row1 - row0) * self.width, fill_value, dtype=values.dtype)
+        grid[self.pixels[covered] - row0 * self.width] = values[self.nearest[covered]]
+        return grid.reshape(row1 - row0, self.width)
+
+    def linear(self, values, fill_value=np.nan):
+        """Interpolate a value column linearly onto the grid."""
+        return self.linear_rows(values, 0, self.height, fill_value)
+
+    def nearest_neighbour(self, values, fill_value=0):
+        """Assign every grid pixel the value of its nearest point."""
+        return self.nearest_rows(values, 0, self.height, fill_value)
+
+    def save(self, path):
+        """Write the plan as a directory of .npy files (atomically)."""
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(tmp_path, 'shape.npy'), np.array([self.height, self.width]))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same plan first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        height, width = np.load(os.path.join(path, 'shape.npy'))
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in cls.ARRAYS}
+        return cls(int(width), int(height), **arrays)
+
+    @classmethod
+    def load_rows(cls, path, row0, row1):
+        """Read the part of a stored plan that covers the grid rows row0..row1 (see row_ranges).
+
+        The files are only mapped while the rows are copied, so going through a plan band
+        by band keeps no more than one band in memory.
+        """
+        height, width = np.load(os.path.join(path, 'shape.npy'))
+        first, last = row0 * int(width), row1 * int(width)
+        arrays = {}
+        for index, names in (('pixels', ('pixels', 'nearest')),
+                             ('linear_pixels', ('linear_pixels', 'vertices', 'weights'))):
+            start, end = np.searchsorted(np.load(os.path.join(path, f"{index}.npy"), mmap_mode='r'), [first, last])
+            for name in names:
+                arrays[name] = np.array(np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')[start:end])
+        return cls(int(width), int(height), **arrays)
+
+def store_plan(triangulation, bounds, width, height, path, pixel_mask_rows=None, band_rows=512,
+               block_pixels=BUILD_BLOCK_PIXELS):
+    """Build a plan band_rows grid rows at a time straight into path (same files as InterpolationPlan.save).
+
+    pixel_mask_rows(row0, row1) returns the pixel mask of the grid rows row0..row1. The
+    arrays of each band are appended to raw files and only get their .npy headers at the
+    end, so memory does not grow with the size of the grid.
+    """
+    x_min, y_min, x_max, y_max = bounds
+    grid_x = np.linspace(x_min, x_max, width)
+    grid_y = np.linspace(y_min, y_max, height)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        files = {name: open(os.path.join(tmp_path, f"{name}.raw"), 'wb') for name in InterpolationPlan.ARRAYS}
+        counts = dict.fromkeys(InterpolationPlan.ARRAYS, 0)
+        try:
+            for row0 in range(0, height, band_rows):
+                row1 = min(row0 + band_rows, height)
+                if pixel_mask_rows is None:
+                    pixels = np.arange(row0 * width, row1 * width, dtype=np.int64)
+                else:
+                    pixels = row0 * width + np.flatnonzero(pixel_mask_rows(row0, row1)).astype(np.int64)
+                for start in range(0, len(pixels), block_pixels):
+                    block = pixels[start:start + block_pixels]
+                    nearest, linear_pixels, vertices, weights = triangulation.plan_block(grid_x, grid_y, width, block)
+                    for name, part in zip(InterpolationPlan.ARRAYS, (block, nearest, linear_pixels, vertices, weights)):
+                        files[name].write(part.tobytes())
+                        counts[name] += len(part)
+        finally:
+            for f in files.values():
+                f.close()
+
+        dtypes = {'pixels': np.int64, 'nearest': np.int32, 'linear_pixels': np.int64,
+                  'vertices': np.int32, 'weights': np.float64}
+        for name in InterpolationPlan.ARRAYS:
+            shape = (counts[name], 3) if name in ('vertices', 'weights') else (counts[name],)
+            raw_path = os.path.join(tmp_path, f"{name}.raw")
+            with open(os.path.join(tmp_path, f"{name}.npy"), 'wb') as f, open(raw_path, 'rb') as raw:
+                np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtypes[name])),
+                                                        'fortran_order': False, 'shape': shape})
+                shutil.copyfileobj(raw, f, 1 << 20)
+            os.remove(raw_path)
+        np.save(os.path.join(tmp_path, 'shape.npy'), np.array([height, width]))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same plan first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def plan_key(x_coords, y_coords, building_mask, bounds, width, height, pixel_mask=None, pixel_mask_key=None):
+    """Hash everything the plan depends on (pixel_mask_key identifies the mask instead of its bits)."""
+    h = hashlib.sha1()
+    h.update(repr((PLAN_VERSION, tuple(float(b) for b in bounds), int(width), int(height))).encode())
+    h.update(np.ascontiguousarray(x_coords, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(y_coords, dtype=np.float64).tobytes())
+    h.update(np.packbits(np.asarray(building_mask, dtype=bool)).tobytes())
+    if pixel_mask_key is not None:
+        h.update(f"mask:{pixel_mask_key}".encode())
+    elif pixel_mask is not None:
+        h.update(np.packbits(np.asarray(pixel_mask, dtype=bool)).tobytes())
+    return h.hexdigest()
+
+def set_plan_cache_mb(max_mb):
+    """Change the memory budget of the plans kept by this process (see get_interpolation_plan)."""
+    _plan_cache.resize(max_mb << 20)
+
+def get_interpolation_plan(x_coords, y_coords, building_mask, bounds, width, height,
+                           pixel_mask=None, cache_dir=None, pixel_mask_key=None):
+    """Return a plan from the in-process cache, the disk cache or build a new one.
+
+    Plans stored in cache_dir are memory-mapped instead of read, so only the parts that
+    are used stay in memory. The in-process cache is bounded by PLAN_CACHE_MB (see
+    set_plan_cache_mb) of plans held in memory; a plan larger than that is built (or
+    mapped) again whenever it is needed. pixel_mask can also be a function returning the
+    mask together with a pixel_mask_key identifying it; the mask is then only created
+    when the plan has to be built.
+    """
+    key = plan_key(x_coords, y_coords, building_mask, bounds, width, height,
+                   None if callable(pixel_mask) else pixel_mask, pixel_mask_key)
+
+    def load_or_build():
+        plan_path = os.path.join(cache_dir, key) if cache_dir else None
+        if plan_path and os.path.isdir(plan_path):
+            try:
+                plan = InterpolationPlan.load(plan_path, mmap_mode='r')
+                logging.info(f"Loaded interpolation plan {key} from {cache_dir}")
+                return plan
+            except Exception as e:
+                logging.warning(f"Could not load interpolation plan {plan_path}: {str(e)}")
+
+        logging.info(f"Building interpolation plan for {width}x{height} grid")
+        plan = InterpolationPlan.build(x_coords, y_coords, building_mask, bounds, width, height,
+                                       pixel_mask() if callable(pixel_mask) else pixel_mask)
+        if plan_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            plan.save(plan_path)
+            # Drop the freshly built arrays in favour of the stored ones
+            plan = InterpolationPlan.load(plan_path, mmap_mode='r')
+        return plan
+
+    return _plan_cache.get(key, load_or_build)
+
+def get_stored_plan(x_coords, y_coords, building_mask, bounds, width, height, cache_dir,
+                    pixel_mask_rows=None, pixel_mask_key=None, band_rows=512):
+    """Return the path of the plan in cache_dir, building it band by band when it is not stored yet.
+
+    Read it with InterpolationPlan.load_rows. pixel_mask_rows(row0, row1) returns the pixel
+    mask of some grid rows, identified by pixel_mask_key (see store_plan); the plan is
+    the same as the one get_interpolation_plan builds for that mask.
+    """
+    key = plan_key(x_coords, y_coords, building_mask, bounds, width, height, pixel_mask_key=pixel_mask_key)
+    plan_path = os.path.join(cache_dir, key)
+    if not os.path.isdir(plan_path):
+        logging.info(f"Building interpolation plan for {width}x{height} grid in bands of {band_rows} rows")
+        os.makedirs(cache_dir, exist_ok=True)
+        store_plan(PointTriangulation(x_coords, y_coords, building_mask), bounds, width, height, plan_path,
+                   pixel_mask_rows, band_rows)
+    return plan_path
@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'entries', 'bytes', 'max_bytes'])
+
+class LRUCache:
+    """Least recently used cache bounded by the size of its values in bytes.
+
+    size(value) returns the bytes of a value; a value larger than max_bytes is returned
+    but not kept. max_entries optionally also bounds the number of values (for values
+    whose size is not counted, e.g. memory-mapped arrays). Safe to use from several
+    threads (a value missing in two threads at once is built twice).
+    """
+
+    def __init__(self, max_bytes, size, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = size
+        self.entries = OrderedDict()  # key -> (value, bytes), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        """The value of key, built with build() and stored when it is not cached."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = build()
+        nbytes = self.size(value)
+        with self.lock:
+            if key not in self.entries and nbytes <= self.max_bytes:
+                self.entries[key] = (value, nbytes)
+                self.bytes += nbytes
+                self.evict()
+        return value
+
+    def evict(self):
+        """Drop the least recently used values until the cache is within its limits (lock held)."""
+        while self.entries and (self.bytes > self.max_bytes
+                                or (self.max_entries is not None and len(self.entries) > self.max_entries)):
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Change the memory budget, evicting values that no longer fit."""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, len(self.entries), self.bytes, self.max_bytes)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
@@ -1,34 +1,59 @@
 import os
+import argparse
 import pandas as pd
+from partitioned_dataset import MERGED_FOLDER, partition_file, write_partition
+from build_manifest import BuildManifest
 
 # Define paths
 input_folder = './rawdata/Tagesgang/Full'
 output_file = './csvdata/merged_data.csv'
+output_folder = MERGED_FOLDER
 
-# Create output directory if it doesn't exist
-os.makedirs(os.path.dirname(output_file), exist_ok=True)
+# Prefix of the raw Tagesgang files
+FILE_PREFIX = 'Tagesgang_TefmoNN_P1P2_rndm_E190-200_P0_Testdaten_'
 
-# Initialize CSV file
-if os.path.exists(output_file):
-    os.remove(output_file)
-
-# Iterate over each file in the input folder
-for filename in os.listdir(input_folder):
+def is_raw_file(filename):
     # Only process files that match the pattern
     #Avoid .gitkeep file
-    if filename.startswith('Tagesgang_TefmoNN_P1P2_rndm_E190-200_P0_Testdaten_') and filename.endswith('.txt'):
+    return filename.startswith(FILE_PREFIX) and filename.endswith('.txt')
+
+def parse_file_date(filename):
+    """Extract the date and hour from the filename as ISO string (e.g. 2023-08-20T22:00:00)."""
+    # Split based on underscores and parse the date and hour part
+    parts = filename.split('_')
+    date_string = f"{parts[7]}-{parts[8]}-{parts[9]}"  # YYYY-MM-DD
+    hour_part = parts[10]  # "22uhr" in the example
+
+    # Extract hour by removing 'uhr' and converting to an integer
+    hour = int(hour_part.replace('uhr', ''))
+
+    # Create a datetime string including the hour
+    return pd.to_datetime(f"{date_string} {hour}:00:00", format="%Y-%m-%d %H:%M:%S").isoformat()
+
+def merge_all(input_folder, output_file, force=False):
+    # Create output directory if it doesn't exist
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    # The merged file only has to be rewritten when a raw file was added or changed
+    manifest = BuildManifest(os.path.dirname(output_file), force)
+    raw_files = sorted(os.path.join(input_folder, f) for f in os.listdir(input_folder) if is_raw_file(f))
+    fingerprint = manifest.fingerprint(raw_files)
+    if manifest.is_current(output_file, fingerprint):
+        print(f"{output_file} is up to date.")
+        return
+
+    # Initialize CSV file
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    # Iterate over each file in the input folder
+    for filename in os.listdir(input_folder):
+        if not is_raw_file(filename):
+            continue
+
         # Extract the date and hour from the filename
         try:
-            # Split based on underscores and parse the date and hour part
-            parts = filename.split('_')
-            date_string = f"{parts[7]}-{parts[8]}-{parts[9]}"  # YYYY-MM-DD
-            hour_part = parts[10]  # "22uhr" in the example
-            
-            # Extract hour by removing 'uhr' and converting to an integer
-            hour = int(hour_part.replace('uhr', ''))
-            
-            # Create a datetime string including the hour
-            date_string_iso = pd.to_datetime(f"{date_string} {hour}:00:00", format="%Y-%m-%d %H:%M:%S").isoformat()
+            date_string_iso = parse_file_date(filename)
         except Exception as e:
             print(f"Skipping file {filename} due to parsing error: {e}")
             continue
@@ -42,18 +67,76 @@ for filename in os.listdir(input_folder):
         except Exception as e:
             print(f"Skipping file {filename} due to read error: {e}")
             continue
-        
+
         # Add date column to the DataFrame
         df['date'] = date_string_iso
 
         # Append the dataframe to the output CSV
         # Write headers only for the first file
         write_header = not os.path.exists(output_file)
-        
+
         try:
             df.to_csv(output_file, mode='a', index=False, header=write_header)
             print(f"Appended file: {filename} with date: {date_string_iso}")
         except Exception as e:
             print(f"Failed to write data for file {filename}: {e}")
 
-print(f"Data merging completed. Output written to {output_file}")
+    manifest.record(output_file, fingerprint)
+    manifest.save()
+    print(f"Data merging completed. Output written to {output_file}")
+
+def merge_partitioned(input_folder, output_folder, force=False):
+    """Write every raw file as its own day/hour partition, skipping partitions that are up to date."""
+    manifest = BuildManifest(output_folder, force)
+    added = 0
+
+    try:
+        for filename in sorted(os.listdir(input_folder)):
+            if not is_raw_file(filename):
+                continue
+
+            try:
+                date_string_iso = parse_file_date(filename)
+            except Exception as e:
+                print(f"Skipping file {filename} due to parsing error: {e}")
+                continue
+
+            # New data only adds partitions, current ones are left untouched
+            file_path = os.path.join(input_folder, filename)
+            fingerprint = manifest.fingerprint([file_path])
+            if manifest.is_current(partition_file(output_folder, date_string_iso), fingerprint):
+                continue
+
+            try:
+                df = pd.read_csv(file_path, sep='\t', header=None, names=['x', 'y', 'temperatur', 'messung', 'genauigkeit', 'ntzg'])
+            except Exception as e:
+                print(f"Skipping file {filename} due to read error: {e}")
+                continue
+
+            try:
+                partition = write_partition(output_folder, df, date_string_iso)
+                manifest.record(partition, fingerprint)
+                added += 1
+                print(f"Added partition {partition} from file: {filename}")
+            except Exception as e:
+                print(f"Failed to write data for file {filename}: {e}")
+    finally:
+        manifest.save()
+
+    print(f"Data merging completed. Added {added} partitions to {output_folder}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the raw Tagesgang files into one dataset")
+    parser.add_argument("--input_folder", default=input_folder, help="Folder with raw .txt files")
+    parser.add_argument("--format", choices=["partitioned", "csv"], default="partitioned",
+                        help="'partitioned' appends day/hour Parquet partitions to --output_folder, "
+                             "'csv' rewrites the single --output_file")
+    parser.add_argument("--output_folder", default=output_folder, help="Root of the partitioned dataset")
+    parser.add_argument("--output_file", default=output_file, help="Merged CSV file")
+    parser.add_argument("--force", action="store_true", help="Rewrite all outputs, even if they are up to date")
+    args = parser.parse_args()
+
+    if args.format == 'csv':
+        merge_all(args.input_folder, args.output_file, args.force)
+    else:
+        merge_partitioned(args.input_folder, args.output_folder, args.force)
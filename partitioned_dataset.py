@@ -0,0 +1,100 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Root of the date/hour partitioned merged dataset (hive layout, readable by DuckDB)
+MERGED_FOLDER = './csvdata/merged'
+
+# Same column types as the temperature table in build_db.sql
+SCHEMA = pa.schema([
+    ('x', pa.int32()),
+    ('y', pa.int32()),
+    ('temperatur', pa.float32()),
+    ('messung', pa.float32()),
+    ('genauigkeit', pa.float32()),
+    ('ntzg', pa.int16()),
+    ('date', pa.timestamp('us')),
+])
+
+PARTITION_PATTERN = re.compile(r'day=(\d{4}-\d{2}-\d{2})/hour=(\d{2})$')
+
+def partition_dir(root, date_string_iso):
+    """Folder of the partition for an ISO timestamp, e.g. root/day=2023-08-20/hour=22."""
+    timestamp = pd.Timestamp(date_string_iso)
+    return os.path.join(root, f"day={timestamp:%Y-%m-%d}", f"hour={timestamp:%H}")
+
+def partition_file(root, date_string_iso):
+    return os.path.join(partition_dir(root, date_string_iso), 'data.parquet')
+
+def existing_partitions(root):
+    """ISO timestamps of all complete partitions below root."""
+    timestamps = set()
+    if not os.path.isdir(root):
+        return timestamps
+    for day in os.listdir(root):
+        day_dir = os.path.join(root, day)
+        if not os.path.isdir(day_dir):
+            continue
+        for hour in os.listdir(day_dir):
+            match = PARTITION_PATTERN.search(f"{day}/{hour}")
+            if match and os.path.exists(os.path.join(day_dir, hour, 'data.parquet')):
+                timestamps.add(pd.Timestamp(f"{match.group(1)} {match.group(2)}:00:00").isoformat())
+    return timestamps
+
+def to_table(df, date_string_iso):
+    """Convert a chunk of raw columns to an Arrow table with the merged schema."""
+    columns = {}
+    for field in SCHEMA:
+        if field.name == 'date':
+            continue
+        values = np.asarray(df[field.name])
+        converted = values.astype(field.type.to_pandas_dtype())
+        if pa.types.is_integer(field.type) and not np.array_equal(converted, values):
+            raise ValueError(f"Column {field.name} does not fit into {field.type}")
+        columns[field.name] = converted
+    columns['date'] = np.full(len(df), np.datetime64(pd.Timestamp(date_string_iso).to_datetime64(), 'us'))
+    return pa.table(columns, schema=SCHEMA)
+
+class PartitionWriter:
+    """Write one hour partition chunk by chunk (one row group per chunk).
+
+    The partition only becomes visible under its final name on close().
+    """
+
+    def __init__(self, root, date_string_iso):
+        self.date_string_iso = date_string_iso
+        self.path = partition_file(root, date_string_iso)
+        self.tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        self.writer = None
+
+    def write(self, df):
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, SCHEMA, compression='zstd')
+        self.writer.write_table(to_table(df, self.date_string_iso))
+
+    def close(self):
+        if self.writer is None:
+            self.write(pd.DataFrame({field.name: [] for field in SCHEMA}))
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+def write_partition(root, df, date_string_iso):
+    """Write a complete hour as its own partition, replacing an existing one."""
+    writer = PartitionWriter(root, date_string_iso)
+    try:
+        writer.write(df)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
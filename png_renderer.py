@@ -0,0 +1,487 @@
+import os
+import math
+import zlib
+import struct
+import hashlib
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.colors import ListedColormap
+from matplotlib.transforms import Bbox
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib import _tight_bbox
+from PIL import Image
+from lru_cache import LRUCache
+
+# Bump whenever the way pixel maps are derived changes
+PIXEL_MAP_VERSION = 2
+
+# Memory budget of the pixel maps each process keeps (width + height entries each)
+PIXEL_MAP_CACHE_MB = 64
+
+_pixel_map_cache = LRUCache(PIXEL_MAP_CACHE_MB << 20, lambda pixel_map: pixel_map[0].nbytes + pixel_map[1].nbytes)
+
+def colormap_lut(custom_cmap):
+    """Return the colormap as uint8 RGBA lookup table: N colours, then under, over and bad."""
+    lut = np.vstack((
+        custom_cmap(np.arange(custom_cmap.N)),
+        custom_cmap.get_under(),
+        custom_cmap.get_over(),
+        custom_cmap.get_bad()
+    ))
+    # Same truncation as Colormap.__call__(..., bytes=True)
+    return (lut * 255).astype(np.uint8)
+
+def colormap_indices(grid, vmin, vmax, n_colors, data_range=None):
+    """Map a value grid to LUT indices exactly the way imshow does.
+
+    imshow rescales the data to [0.1, 0.9] before resampling and back afterwards, then
+    normalizes and truncates to a colormap index. The same float operations are repeated
+    here so that values on a colour boundary land in the same bin. When only a part of
+    the image is passed, data_range must be the (min, max) of the finite values of the
+    whole image.
+    Returns indices into the table from colormap_lut (n_colors = under, +1 = over, +2 = bad).
+    """
+    data = np.array(grid, dtype=np.float64)
+    bad = ~np.isfinite(data)
+    indices = np.full(data.shape, n_colors + 2, dtype=np.int32)
+    if bad.all():
+        return indices
+
+    if data_range is None:
+        data_range = (np.min(data[~bad]), np.max(data[~bad]))
+    a_min = np.float64(data_range[0])
+    a_max = np.float64(data_range[1])
+
+    # Clip around the norm (only matters for extreme outliers)
+    dv = np.float64(vmax) - np.float64(vmin)
+    vmid = np.float64(vmin) + dv / 2
+    newmin = vmid - dv * 1e7
+    if newmin < a_min:
+        newmin = None
+    else:
+        a_min = np.float64(newmin)
+    newmax = vmid + dv * 1e7
+    if newmax > a_max:
+        newmax = None
+    else:
+        a_max = np.float64(newmax)
+    if newmax is not None or newmin is not None:
+        np.clip(data, newmin, newmax, out=data)
+
+    offset = .1
+    frac = .8
+    vrange = np.array([vmin, vmax], dtype=np.float64)
+    data -= a_min
+    vrange -= a_min
+    if a_min != a_max:
+        data /= ((a_max - a_min) / frac)
+        vrange /= ((a_max - a_min) / frac)
+    data += offset
+    vrange += offset
+    data -= offset
+    vrange -= offset
+    if a_min != a_max:
+        data *= ((a_max - a_min) / frac)
+        vrange *= ((a_max - a_min) / frac)
+    data += a_min
+    vrange += a_min
+
+    # Normalize and Colormap.__call__
+    s_vmin, s_vmax = vrange
+    data -= s_vmin
+    data /= (s_vmax - s_vmin)
+    data *= n_colors
+    data[data == n_colors] = n_colors - 1
+    under = data < 0
+    over = data >= n_colors
+    with np.errstate(invalid='ignore'):
+        indices = data.astype(np.int32)
+    indices[under] = n_colors
+    indices[over] = n_colors + 1
+    indices[bad] = n_colors + 2
+    return indices
+
+def probe_colormap():
+    """Colormap of the probe images: index k is shown as red k % 256 and green k // 256."""
+    k = np.arange(65536)
+    # Channel values chosen so that the uint8 truncation gives back exactly k % 256 and k // 256
+    return ListedColormap(np.column_stack((
+        np.minimum((k % 256 + 0.5) / 255, 1.0),
+        np.minimum((k // 256 + 0.5) / 255, 1.0),
+        np.zeros(65536),
+        np.ones(65536)
+    )))
+
+def probe_line(width, height, extent, axis, dpi=100):
+    """Grid rows (axis 0) or columns (axis 1) shown along the saved figure, modulo 256.
+
+    Sets up the figure like the matplotlib renderer and lays it out like
+    savefig(bbox_inches='tight', pad_inches=0), but only resamples a one pixel wide strip
+    of the image (make_image) and places it the way Agg's draw_image does, so no canvas of
+    the full size is drawn. The image is scaled separately along each axis, so a
+    (height, 1) grid gives the rows and a (1, width) grid the columns of the full image.
+    Returns (codes, covered) per output row (top first) or column.
+    """
+    if axis == 0:
+        codes = (np.arange(height)[:, None] % 256) * 256 + 0.5
+    else:
+        codes = np.arange(width)[None, :] % 256 + 0.5
+
+    fig = plt.figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    try:
+        image = plt.imshow(codes, extent=extent, origin='lower', cmap=probe_colormap(), vmin=0, vmax=65536,
+                           interpolation='none')
+        plt.axis('off')
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+        renderer = RendererAgg(1, 1, dpi)
+        _tight_bbox.adjust_bbox(fig, fig.get_tightbbox(renderer).padded(0), None)
+        canvas_width, canvas_height = (int(size) for size in fig.bbox.size)
+
+        # Resample only a strip through the middle of the image (the clip box of the image is the Axes box)
+        clip = image.get_clip_box()
+        if axis == 0:
+            middle = (clip.x0 + clip.x1) / 2
+            image.set_clip_box(Bbox([[middle, clip.y0], [middle + 1, clip.y1]]))
+        else:
+            middle = (clip.y0 + clip.y1) / 2
+            image.set_clip_box(Bbox([[clip.x0, middle], [clip.x1, middle + 1]]))
+        strip, left, bottom, _ = image.make_image(renderer, renderer.get_image_magnification())
+    finally:
+        plt.close(fig)
+
+    # Agg draws the image at truncated integer offsets (rows bottom-up) within the rounded clip box
+    if axis == 0:
+        line = strip[::-1, 0]
+        length = canvas_height
+        start = int(canvas_height - (bottom + strip.shape[0]))
+        lo = int(math.floor(canvas_height - clip.y1 + 0.5))
+        hi = int(math.floor(canvas_height - clip.y0 + 0.5))
+        channel = 1
+    else:
+        line = strip[0]
+        length = canvas_width
+        start = int(left)
+        lo = int(math.floor(clip.x0 + 0.5))
+        hi = int(math.floor(clip.x1 + 0.5))
+        channel = 0
+    positions = start + np.arange(len(line))
+    drawn = (positions >= max(lo, 0)) & (positions < min(hi, length))
+    codes = np.zeros(length, dtype=np.int64)
+    covered = np.zeros(length, dtype=bool)
+    codes[positions[drawn]] = line[drawn, channel]
+    covered[positions[drawn]] = line[drawn, 3] == 255
+    return codes, covered
+
+def probe_pixel_map(width, height, extent, dpi=100):
+    """Find where matplotlib places each grid cell in the saved figure.
+
+    Probes the rows and the columns separately (see probe_line), so memory only grows
+    with width + height. Returns (row_map, col_map): the grid row/column shown by each
+    output row/column (top row first), -1 where the output pixel is not covered by the image.
+    """
+    row_codes, covered_rows = probe_line(width, height, extent, 0, dpi)
+    col_codes, covered_cols = probe_line(width, height, extent, 1, dpi)
+    rows = np.flatnonzero(covered_rows)
+    cols = np.flatnonzero(covered_cols)
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError("Probe image is empty")
+
+    def unwrap(codes, start):
+        steps = (np.diff(codes) + 128) % 256 - 128
+        return start + np.concatenate(([0], np.cumsum(steps)))
+
+    # Columns start near 0, rows (origin='lower') start near the top of the grid
+    col_index = unwrap(col_codes[cols], col_codes[cols[0]])
+    row_start = (height - 1) - ((height - 1 - row_codes[rows[0]]) % 256)
+    row_index = unwrap(row_codes[rows], row_start)
+
+    row_map = np.full(len(row_codes), -1, dtype=np.int64)
+    col_map = np.full(len(col_codes), -1, dtype=np.int64)
+    row_map[rows] = row_index
+    col_map[cols] = col_index
+    if row_map.max() >= height or col_map.max() >= width or row_index.min() < 0 or col_index.min() < 0:
+        raise ValueError("Could not decode probe image")
+    return row_map, col_map
+
+def get_pixel_map(width, height, extent, cache_dir=None):
+    """probe_pixel_map, cached in memory (up to PIXEL_MAP_CACHE_MB) and optionally on disk."""
+    key = hashlib.sha1(repr((PIXEL_MAP_VERSION, matplotlib.__version__, int(width), int(height),
+                             tuple(float(e) for e in extent))).encode()).hexdigest()
+
+    def load_or_probe():
+        map_path = os.path.join(cache_dir, f"pixelmap_{key}.npz") if cache_dir else None
+        if map_path and os.path.exists(map_path):
+            try:
+                with np.load(map_path) as stored:
+                    return stored['row_map'], stored['col_map']
+            except Exception as e:
+                logging.warning(f"Could not load pixel map {map_path}: {str(e)}")
+
+        pixel_map = probe_pixel_map(width, height, extent)
+        if map_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{map_path}.tmp-{os.getpid()}.npz"
+            np.savez(tmp_path, row_map=pixel_map[0], col_map=pixel_map[1])
+            os.replace(tmp_path, map_path)
+        return pixel_map
+
+    return _pixel_map_cache.get(key, load_or_probe)
+
+def canvas_lut(custom_cmap):
+    """colormap_lut plus a transparent entry for output pixels not covered by the image."""
+    lut = np.vstack((colormap_lut(custom_cmap), [0, 0, 0, 0])).astype(np.uint8)
+    # Transparent pixels keep the (255, 255, 255, 0) background of the Agg canvas
+    lut[lut[:, 3] == 0] = (255, 255, 255, 0)
+    return lut
+
+def canvas_indices(grid, extent, n_colors, vmin, vmax, cache_dir=None):
+    """canvas_lut indices of the image the matplotlib renderer would save for a grid (row 0 = bottom)."""
+    height, width = grid.shape
+    indices = colormap_indices(grid, vmin, vmax, n_colors)
+
+    row_map, col_map = get_pixel_map(width, height, extent, cache_dir)
+    # Uncovered output pixels (map index -1) pick the padded, fully transparent entry
+    indices = np.pad(indices, ((0, 1), (0, 1)), constant_values=n_colors + 3)
+    return indices[np.ix_(row_map, col_map)]
+
+def render_rgba(grid, extent, custom_cmap, vmin, vmax, cache_dir=None):
+    """Colour a grid (row 0 = bottom) to the RGBA image the matplotlib renderer would save."""
+    return canvas_lut(custom_cmap)[canvas_indices(grid, extent, custom_cmap.N, vmin, vmax, cache_dir)]
+
+def reachable_entries(vmin, vmax, n_colors, data_range):
+    """canvas_lut entries an image whose finite values lie within data_range can show.
+
+    colormap_indices is monotonic, so these are the colours between the indices of the two
+    ends of the range (under / over included where reached) plus the transparent ones.
+    """
+    entries = [n_colors + 2, n_colors + 3]
+    if data_range is None:
+        return np.array(entries)
+    # Rank in value order: under, colours 0..n_colors - 1, over
+    ranks = [{n_colors: -1, n_colors + 1: n_colors}.get(int(i), int(i))
+             for i in colormap_indices(np.array(data_range, dtype=np.float64), vmin, vmax, n_colors, data_range)]
+    entries += range(max(ranks[0], 0), min(ranks[1], n_colors - 1) + 1)
+    if ranks[0] < 0:
+        entries.append(n_colors)
+    if ranks[1] >= n_colors:
+        entries.append(n_colors + 1)
+    return np.array(sorted(entries))
+
+def image_palette(lut, entries):
+    """(palette, remap) for an indexed PNG showing the given lut entries; None above 256 colours.
+
+    palette holds the distinct RGBA colours, remap[lut index] their position in it. The
+    palette follows the LUT order, so neighbouring temperatures get neighbouring indices
+    (which keeps the filtered rows small), with the translucent colours first so that the
+    tRNS chunk only has to cover those.
+    """
+    colors = lut[entries]
+    _, first, inverse = np.unique(colors, axis=0, return_index=True, return_inverse=True)
+    if len(first) > 256:
+        return None
+    order = np.lexsort((first, colors[first, 3] == 255))
+    position = np.empty(len(order), dtype=np.uint8)
+    position[order] = np.arange(len(order))
+    remap = np.zeros(len(lut), dtype=np.uint8)
+    remap[entries] = position[inverse.ravel()]
+    return colors[first[order]], remap
+
+def save_indexed_png(indices, lut, output_png, png_format='rgba', compress_level=6):
+    """Write the image lut[indices] as PNG.
+
+    png_format 'palette' writes an 8 bit indexed PNG (PLTE + tRNS) with the colours the
+    image uses, or RGBA when there are more than 256. output_png is a path or a binary
+    file object.
+    """
+    if png_format == 'palette':
+        entries = np.flatnonzero(np.bincount(indices.ravel(), minlength=len(lut)))
+        palette = image_palette(lut, entries)
+        if palette is not None:
+            colors, remap = palette
+            writer = PngWriter(output_png, indices.shape[1], indices.shape[0], compress_level, colors)
+            try:
+                writer.write_rows(remap[indices])
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+            return
+        logging.info(f"More than 256 colours in {output_png}, writing RGBA")
+    save_rgba_png(lut[indices], output_png, compress_level)
+
+def stream_png(grid_rows, shape, extent, custom_cmap, vmin, vmax, data_range, output_png,
+               cache_dir=None, block_rows=512, png_format='rgba', compress_level=6, writer=None):
+    """render_rgba + save_indexed_png without holding the grid or the image as a whole.
+
+    grid_rows(row0, row1) returns the grid rows row0..row1 (row 0 = bottom) of a grid with
+    the given (height, width) shape; data_range is the (min, max) of its finite values.
+    The image is produced block_rows output rows at a time. With a BackgroundWriter the
+    blocks are encoded on its thread while the next ones are computed; the future of the
+    finished file is returned then (None otherwise).
+    """
+    height, width = shape
+    lut = canvas_lut(custom_cmap)
+    row_map, col_map = get_pixel_map(width, height, extent, cache_dir)
+
+    palette = None
+    if png_format == 'palette':
+        # The palette has to be written first, so it covers every colour data_range can reach
+        palette = image_palette(lut, reachable_entries(vmin, vmax, custom_cmap.N, data_range))
+        if palette is None:
+            logging.info(f"More than 256 colours in {output_png}, writing RGBA")
+    if palette is not None:
+        colors, remap = palette
+        png = PngWriter(output_png, len(col_map), len(row_map), compress_level, colors)
+    else:
+        remap = lut
+        png = PngWriter(output_png, len(col_map), len(row_map), compress_level)
+
+    blocks = []
+    try:
+        for start in range(0, len(row_map), block_rows):
+            band = row_map[start:start + block_rows]
+            covered = band[band >= 0]
+            if len(covered):
+                row0, row1 = int(covered.min()), int(covered.max()) + 1
+                indices = colormap_indices(grid_rows(row0, row1), vmin, vmax, custom_cmap.N, data_range)
+                local_rows = np.where(band >= 0, band - row0, -1)
+            else:
+                indices = np.empty((0, width), dtype=np.int32)
+                local_rows = band
+            # Uncovered output pixels (map index -1) pick the padded, fully transparent entry
+            indices = np.pad(indices, ((0, 1), (0, 1)), constant_values=len(lut) - 1)
+            rows = remap[indices[np.ix_(local_rows, col_map)]]
+            if writer is None:
+                png.write_rows(rows)
+            else:
+                blocks.append(writer.submit(png.write_rows, rows))
+    except Exception:
+        if writer is None:
+            png.abort()
+        else:
+            writer.submit(png.abort)
+        raise
+
+    if writer is None:
+        try:
+            png.close()
+        except Exception:
+            png.abort()
+            raise
+        return None
+
+    def finish():
+        # Runs after all blocks (the writer thread works in order)
+        try:
+            for block in blocks:
+                block.result()
+            png.close()
+        except Exception:
+            png.abort()
+            raise
+    return writer.submit(finish)
+
+class BackgroundWriter:
+    """Encode and write images on a separate thread while the caller computes the next one.
+
+    zlib releases the GIL while compressing, so encoding runs in parallel to the NumPy
+    work of the interpolation. At most max_pending jobs are queued; submit() waits for a
+    free slot, which bounds the memory held by images waiting to be written. Jobs run in
+    the order they were submitted.
+    """
+
+    def __init__(self, max_pending=4):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='png-writer')
+        self.pending = []
+
+    def submit(self, function, *args):
+        """Run function(*args) on the writer thread; returns its future."""
+        self.pending = [future for future in self.pending if not future.done()]
+        while len(self.pending) >= self.max_pending:
+            wait(self.pending, return_when=FIRST_COMPLETED)
+            self.pending = [future for future in self.pending if not future.done()]
+        # In the context of the caller, so context variables (e.g. the metrics of the task) carry over
+        future = self.executor.submit(contextvars.copy_context().run, function, *args)
+        self.pending.append(future)
+        return future
+
+class PngWriter:
+    """Encode a PNG band by band, so the image never has to be in memory as a whole.
+
+    Writes 8 bit RGBA, or 8 bit indexed colour when an (n, 4) RGBA palette is given (rows
+    then hold palette indices). Every row uses the PNG 'Up' filter (difference to the row
+    above), which compresses the smooth heatmaps well and is cheap to compute with NumPy.
+    path can also be a binary file object, which is written directly instead of through a
+    temporary file.
+    """
+
+    def __init__(self, path, width, height, compress_level=6, palette=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = 4 if palette is None else 1
+        self.rows = 0
+        self.previous = np.zeros(width * self.channels, dtype=np.uint8)
+        self.compressor = zlib.compressobj(compress_level)
+        if hasattr(path, 'write'):
+            self.tmp_path = None
+            self.file = path
+        else:
+            self.tmp_path = f"{path}.tmp-{os.getpid()}"
+            self.file = open(self.tmp_path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        if palette is None:
+            # 8 bit RGBA, no interlacing
+            self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        else:
+            # 8 bit palette, alpha of the palette entries up to the last translucent one
+            palette = np.asarray(palette, dtype=np.uint8)
+            self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+            self.chunk(b'PLTE', palette[:, :3].tobytes())
+            translucent = np.flatnonzero(palette[:, 3] != 255)
+            if len(translucent):
+                self.chunk(b'tRNS', palette[:translucent[-1] + 1, 3].tobytes())
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def write_rows(self, pixels):
+        rows = np.ascontiguousarray(pixels, dtype=np.uint8).reshape(len(pixels), self.width * self.channels)
+        if not len(rows):
+            return
+        filtered = np.empty((len(rows), self.width * self.channels + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up filter
+        filtered[0, 1:] = rows[0] - self.previous
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self.previous = rows[-1].copy()
+        self.rows += len(rows)
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.chunk(b'IDAT', data)
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f"Expected {self.height} rows for {self.path}, got {self.rows}")
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        if self.tmp_path:
+            self.file.close()
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.tmp_path:
+            self.file.close()
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+def save_rgba_png(rgba, output_png, compress_level=6):
+    """Encode an RGBA array as PNG."""
+    Image.fromarray(rgba, 'RGBA').save(output_png, format='png', compress_level=compress_level)
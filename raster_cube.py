@@ -0,0 +1,72 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# A cube is a directory <area>.cube with temperature.npy (hour, y, x), buildings.npy (y, x)
+# and a manifest.json with the grid and time coordinates
+CUBE_SUFFIX = '.cube'
+MANIFEST = 'manifest.json'
+
+def is_cube(path):
+    return path.endswith(CUBE_SUFFIX) and os.path.isfile(os.path.join(path, MANIFEST))
+
+def create_cube(path, width, height, edges, times, sources, attrs=None):
+    """Preallocate an empty cube (all NaN) for the given hours, replacing an existing directory.
+
+    edges is the (x_min, y_min, x_max, y_max) extent of the grid; row 0 is the y_min edge.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    temperature = np.lib.format.open_memmap(os.path.join(path, 'temperature.npy'), mode='w+',
+                                            dtype=np.float32, shape=(len(times), height, width))
+    temperature[:] = np.nan
+    temperature.flush()
+    buildings = np.lib.format.open_memmap(os.path.join(path, 'buildings.npy'), mode='w+',
+                                          dtype=np.bool_, shape=(height, width))
+    buildings.flush()
+
+    manifest = {
+        'width': int(width),
+        'height': int(height),
+        'bounds': [float(e) for e in edges],
+        'pixel_size': [(edges[2] - edges[0]) / width, (edges[3] - edges[1]) / height],
+        'row_order': 'south_to_north',
+        'times': list(times),
+        'sources': list(sources),
+        'fingerprints': [None] * len(times),
+        'attrs': attrs or {},
+    }
+    write_manifest(path, manifest)
+    return manifest
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST), encoding='utf-8') as f:
+        return json.load(f)
+
+def write_manifest(path, manifest):
+    tmp_path = os.path.join(path, f"{MANIFEST}.tmp-{os.getpid()}")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+def open_cube(path, mode='r'):
+    """Return (temperature, buildings, manifest); the arrays are memory-mapped."""
+    temperature = np.load(os.path.join(path, 'temperature.npy'), mmap_mode=mode)
+    buildings = np.load(os.path.join(path, 'buildings.npy'), mmap_mode=mode)
+    return temperature, buildings, read_manifest(path)
+
+def write_hour(path, index, temp_grid, building_grid):
+    """Store the grid of one hour; different hours can be written by different processes.
+
+    The building mask is shared by all hours (buildings of any hour are marked).
+    """
+    temperature, buildings, _ = open_cube(path, mode='r+')
+    temperature[index] = temp_grid
+    buildings[building_grid] = True
+    temperature.flush()
+    buildings.flush()
+
+def hour_index(manifest, time):
+    """Index of an ISO timestamp on the time axis."""
+    return manifest['times'].index(time)
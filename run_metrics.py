@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import contextvars
+from contextlib import contextmanager, nullcontext
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Metrics file and run id of this process (see configure_metrics); nothing is recorded while unset
+_recorder = {}
+
+# Fields of the current task (file, district) added to all records within it. Copied to
+# the background writer thread with every job, so encoding phases keep their district.
+_task_fields = contextvars.ContextVar('task_fields', default=None)
+
+def configure_metrics(path, run=None):
+    """Append the metrics of this process to path (JSON lines); returns the run id.
+
+    The main process creates the run id, pool workers get it passed (see metrics_settings).
+    """
+    if run is None:
+        run = f"{socket.gethostname()}:{os.getpid()}:{int(time.time())}"
+    _recorder.update(path=path, run=run, pid=None, fd=None)
+    return run
+
+def metrics_settings():
+    """(path, run id) for configure_metrics() in pool workers, None while nothing is recorded."""
+    return (_recorder['path'], _recorder['run']) if _recorder.get('path') else None
+
+def enabled():
+    return bool(_recorder.get('path'))
+
+def record(kind, **fields):
+    """Append one record to the metrics file.
+
+    Each record is a single write to a file opened with O_APPEND, so the lines of
+    all workers of a run end up whole in the same file.
+    """
+    if not enabled():
+        return
+    if _recorder['pid'] != os.getpid():
+        # Reopen after a fork instead of sharing the descriptor of the parent
+        _recorder['fd'] = os.open(_recorder['path'], os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        _recorder['pid'] = os.getpid()
+    line = json.dumps({'kind': kind, 'run': _recorder['run'], 'pid': os.getpid(), 'time': round(time.time(), 3),
+                       **fields}, default=str)
+    os.write(_recorder['fd'], (line + '\n').encode())
+
+def memory_mb():
+    """(current, peak) resident set size of this process in MB (current is None where unknown)."""
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        if resource is None:
+            return None, None
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return None, peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def reset_peak():
+    """Set the peak RSS of the process back to its current RSS (Linux only); False where not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class Measurement:
+    """Context manager recording wall time, CPU time (of cpu_clock) and peak RSS of a block.
+
+    The peak is reset when the block starts where the OS allows it (peak_reset), otherwise
+    it is the peak of the process so far. Blocks running at the same time on other threads
+    of the process (the background writer) share the peak.
+    """
+
+    def __init__(self, kind, name, fields, cpu_clock):
+        self.kind = kind
+        self.name = name
+        self.fields = fields
+        self.cpu_clock = cpu_clock
+
+    def __enter__(self):
+        self.peak_reset = reset_peak()
+        self.cpu = self.cpu_clock()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self.start
+        cpu = self.cpu_clock() - self.cpu
+        rss, peak = memory_mb()
+        record(self.kind, name=self.name, **(_task_fields.get() or {}), **self.fields, wall_s=round(wall, 6),
+               cpu_s=round(cpu, 6), rss_mb=rss and round(rss, 1), peak_rss_mb=peak and round(peak, 1),
+               peak_reset=self.peak_reset, ok=exc_type is None)
+        return False
+
+def phase(name, **fields):
+    """Measure a phase of the current task (CPU time of the calling thread only)."""
+    if not enabled():
+        return nullcontext()
+    return Measurement('phase', name, fields, time.thread_time)
+
+@contextmanager
+def task(kind, name=None, queue_wait=None, **fields):
+    """Measure a unit of work; fields (file, district) are also added to every record within it."""
+    if not enabled():
+        yield
+        return
+    token = _task_fields.set({**(_task_fields.get() or {}), **fields})
+    extra = {} if queue_wait is None else {'queue_wait_s': round(queue_wait, 6)}
+    try:
+        # The CPU time of a district is its own thread, the one of a pool task the whole process
+        with Measurement(kind, name, extra, time.thread_time if kind == 'district' else time.process_time):
+            yield
+    finally:
+        _task_fields.reset(token)
+
+def annotate(**fields):
+    """Add fields to the current task record and the records that follow within it."""
+    current = _task_fields.get()
+    if current is not None:
+        current.update(fields)
+
+def run_task(function, pool, submitted, *args):
+    """Run a pool task in a worker, recording how long it waited in the queue (see MeteredPool)."""
+    with task('task', function.__name__, queue_wait=time.time() - submitted, pool=pool):
+        return function(*args)
+
+class MeteredPool:
+    """Executor wrapper that measures every task in its worker and the throughput of the pool.
+
+    Only wraps submit() while metrics are recorded; the returned futures are the ones of
+    the executor, so wait() and as_completed() work as before.
+    """
+
+    # Pools started by this process, for the pool ids
+    count = 0
+
+    def __init__(self, executor, name, max_workers):
+        MeteredPool.count += 1
+        self.executor = executor
+        self.name = name
+        self.id = f"{name}-{MeteredPool.count}"
+        self.max_workers = max_workers
+        self.submitted = 0
+        self.failed = 0
+        self.start = None
+        self.end = None
+
+    def submit(self, function, *args):
+        if not enabled():
+            return self.executor.submit(function, *args)
+        if self.start is None:
+            self.start = time.perf_counter()
+        future = self.executor.submit(run_task, function, self.id, time.time(), *args)
+        self.submitted += 1
+        future.add_done_callback(self.task_done)
+        return future
+
+    def task_done(self, future):
+        if future.cancelled() or future.exception() is not None:
+            self.failed += 1
+        self.end = time.perf_counter()
+
+    def __enter__(self):
+        self.executor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        result = self.executor.__exit__(exc_type, exc, traceback)
+        if enabled() and self.start is not None:
+            wall = (self.end or time.perf_counter()) - self.start
+            record('pool', name=self.name, pool=self.id, workers=self.max_workers or os.cpu_count(),
+                   tasks=self.submitted, failed=self.failed, wall_s=round(wall, 6),
+                   tasks_per_s=round(self.submitted / wall, 3) if wall > 0 else None)
+        return result
+
+@contextmanager
+def measure_run(name, **fields):
+    """Measure a whole run (CPU time and peak RSS including the finished worker processes)."""
+    if not enabled():
+        yield
+        return
+    record('run_start', name=name, **fields)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    start = time.perf_counter()
+    cpu = time.process_time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        result = {'wall_s': round(time.perf_counter() - start, 6), 'cpu_s': round(time.process_time() - cpu, 6)}
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            result['children_cpu_s'] = round(usage.ru_utime + usage.ru_stime - children.ru_utime - children.ru_stime, 6)
+            result['children_peak_rss_mb'] = round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin'
+                                                                      else 1024), 1)
+        result['peak_rss_mb'] = memory_mb()[1]
+        record('run', name=name, ok=ok, **result)
+
+def read_metrics(paths):
+    """All records of the metrics files as one DataFrame."""
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records)
+
+def hotspot_report(metrics, top=10):
+    """Text report: runs, time per phase, pools with queue waits and the slowest districts."""
+    def column(df, name):
+        return df[name] if name in df else pd.Series(index=df.index, dtype=float)
+
+    def records(kind):
+        # Columns of other kinds dropped, so integer fields (district gid, counts) stay integers
+        return metrics[metrics['kind'] == kind].dropna(axis=1, how='all').convert_dtypes()
+
+    sections = []
+    runs = records('run')
+    if len(runs):
+        table = runs[['run', 'name', 'ok', 'wall_s', 'cpu_s']].copy()
+        table['children_cpu_s'] = column(runs, 'children_cpu_s')
+        table['peak_rss_mb'] = column(runs, 'peak_rss_mb')
+        table['children_peak_rss_mb'] = column(runs, 'children_peak_rss_mb')
+        sections.append(("Runs", table.to_string(index=False)))
+
+    phases = records('phase')
+    if len(phases):
+        grouped = phases.groupby('name')
+        table = pd.DataFrame({
+            'count': grouped.size(),
+            'wall_s': grouped['wall_s'].sum(),
+            'mean_s': grouped['wall_s'].mean(),
+            'p95_s': grouped['wall_s'].quantile(0.95),
+            'max_s': grouped['wall_s'].max(),
+            'cpu_s': grouped['cpu_s'].sum(),
+            'peak_rss_mb': grouped['peak_rss_mb'].max(),
+        })
+        table.insert(2, 'share', table['wall_s'] / table['wall_s'].sum())
+        # Much less CPU than wall time: waiting for disk, locks or the writer thread
+        table['cpu_ratio'] = table['cpu_s'] / table['wall_s']
+        table = table.sort_values('wall_s', ascending=False)
+        sections.append(("Phases (all workers, sorted by total wall time)",
+                         table.to_string(float_format=lambda value: f"{value:.3f}")))
+
+    tasks = records('task')
+    districts = records('district')
+    pools = records('pool')
+    if len(pools):
+        rows = []
+        for _, pool in pools.iterrows():
+            pool_tasks = tasks[(tasks['run'] == pool['run']) & (tasks['pool'] == pool['pool'])]
+            pool_districts = districts[(districts['run'] == pool['run']) & (column(districts, 'pool') == pool['pool'])]
+            waits = pool_tasks['queue_wait_s']
+            wall = pool['wall_s']
+            rows.append({'run': pool['run'], 'pool': pool['pool'], 'workers': pool['workers'], 'tasks': pool['tasks'],
+                         'failed': pool['failed'], 'wall_s': wall, 'tasks_per_s': pool['tasks_per_s'],
+                         'districts_per_s': len(pool_districts) / wall if wall else None,
+                         'utilization': pool_tasks['wall_s'].sum() / (wall * pool['workers']) if wall else None,
+                         'wait_mean_s': waits.mean(), 'wait_p50_s': waits.median(),
+                         'wait_p95_s': waits.quantile(0.95), 'wait_max_s': waits.max()})
+        table = pd.DataFrame(rows)
+        if table['run'].nunique() == 1:
+            table = table.drop(columns='run')
+        sections.append(("Pools (utilization = task time / (wall time x workers), wait = time in the queue)",
+                         table.to_string(index=False, float_format=lambda value: f"{value:.3f}")))
+
+    if len(tasks):
+        grouped = tasks.groupby('name')
+        table = pd.DataFrame({'count': grouped.size(), 'wall_s': grouped['wall_s'].sum(),
+                              'mean_s': grouped['wall_s'].mean(), 'cpu_s': grouped['cpu_s'].sum(),
+                              'queue_wait_mean_s': grouped['queue_wait_s'].mean(),
+                              'peak_rss_mb': grouped['peak_rss_mb'].max()})
+        sections.append(("Tasks", table.to_string(float_format=lambda value: f"{value:.3f}")))
+
+    if len(districts):
+        slowest = districts.sort_values('wall_s', ascending=False).head(top)
+        sections.append((f"Slowest {len(slowest)} file-district tasks",
+                         slowest[['file', 'district', 'wall_s', 'cpu_s', 'peak_rss_mb', 'ok']].to_string(
+                             index=False, float_format=lambda value: f"{value:.3f}")))
+        grouped = districts.groupby('district')
+        table = pd.DataFrame({'hours': grouped.size(), 'mean_s': grouped['wall_s'].mean(),
+                              'max_s': grouped['wall_s'].max(), 'peak_rss_mb': grouped['peak_rss_mb'].max()})
+        table = table.sort_values('mean_s', ascending=False).head(top)
+        sections.append((f"Slowest {len(table)} districts (mean over hours)",
+                         table.to_string(float_format=lambda value: f"{value:.3f}")))
+
+    return '\n\n'.join(f"{title}\n{'-' * len(title)}\n{text}" for title, text in sections)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hotspot report of the metrics written with --metrics_out")
+    parser.add_argument("metrics_files", nargs='+', help="JSONL files written with --metrics_out")
+    parser.add_argument("--run", default=None,
+                        help="Only this run id ('all' for every run in the files; default: the last run)")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest districts to list")
+    args = parser.parse_args()
+
+    try:
+        metrics = read_metrics(args.metrics_files)
+    except (OSError, ValueError) as e:
+        parser.error(f"Could not read the metrics: {e}")
+    if metrics.empty:
+        parser.error("No metrics found")
+    if args.run is None:
+        metrics = metrics[metrics['run'] == metrics.loc[metrics['time'].idxmax(), 'run']]
+    elif args.run != 'all':
+        metrics = metrics[metrics['run'] == args.run]
+        if metrics.empty:
+            parser.error(f"Run {args.run!r} not found")
+    print(hotspot_report(metrics, args.top))
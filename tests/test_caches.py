@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import district_labels
+import png_renderer
+from district_labels import cached_array
+from png_renderer import get_pixel_map
+
+@pytest.fixture
+def caches():
+    """The label and pixel map caches of this process, emptied and restored around the test."""
+    cache_list = [district_labels._label_cache, png_renderer._pixel_map_cache]
+    budgets = [cache.max_bytes for cache in cache_list]
+    for cache in cache_list:
+        cache.clear()
+    yield cache_list
+    for cache, budget in zip(cache_list, budgets):
+        cache.clear()
+        cache.resize(budget)
+
+def test_label_cache_is_bounded_by_bytes(caches):
+    label_cache, _ = caches
+    label_cache.resize(3 * 8000)
+    for key in range(5):
+        assert cached_array('labels', key, lambda: np.full(1000, key, dtype=np.int64))[0] == key
+    info = label_cache.info()
+    assert info.entries == 3 and info.bytes == 3 * 8000
+    assert list(label_cache.entries) == [('labels', 2), ('labels', 3), ('labels', 4)]
+
+def test_pixel_map_cache_is_bounded_by_bytes(caches):
+    _, pixel_map_cache = caches
+    row_map, col_map = get_pixel_map(40, 30, (0.0, 40.0, 0.0, 30.0))
+    assert get_pixel_map(40, 30, (0.0, 40.0, 0.0, 30.0))[0] is row_map
+    assert pixel_map_cache.info().bytes == row_map.nbytes + col_map.nbytes
+
+    pixel_map_cache.resize(row_map.nbytes + col_map.nbytes)
+    get_pixel_map(40, 30, (0.0, 40.0, 1.0, 31.0))
+    info = pixel_map_cache.info()
+    assert info.entries == 1 and info.evictions == 1
@@ -0,0 +1,14 @@
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+from calc_bounding_box_leaflet_full import filter_points_with_geojson
+
+def test_points_on_a_shared_border_are_kept(tmp_path):
+    geojson_path = tmp_path / 'districts.geojson'
+    gpd.GeoDataFrame({'gid': [1, 2]}, geometry=[box(0, 0, 10, 10), box(10, 0, 20, 10)],
+                     crs='EPSG:3857').to_file(geojson_path, driver='GeoJSON')
+    df = pd.DataFrame({'x': [5.0, 10.0, 10.0, 15.0, 20.0, 25.0], 'y': [5.0, 5.0, 0.0, 5.0, 5.0, 5.0]})
+
+    filtered = filter_points_with_geojson(df, str(geojson_path))
+    # Inside either district or on their shared border; the outer boundary and beyond are dropped
+    assert filtered['x'].tolist() == [5.0, 10.0, 15.0]
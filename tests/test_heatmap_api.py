@@ -0,0 +1,192 @@
+import os
+import sys
+import subprocess
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from PIL import Image
+from benchmarks.synthetic_data import district_polygons, hour_values, land_use, point_grid, raw_filename
+from columnar_store import read_table
+from geometry_cache import load_geometries
+from heatmap_api import HeatmapRenderer, LRUCache
+from heatmap_generator_unified import HOUR_COLUMNS, create_heatmap
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESOLUTION = 64
+HOURS = ['2023-08-20 22:00', '2023-08-21 03:00', '2023-08-21 04:00']
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    """Three EPSG:3857 hour CSVs with the same 1600 points and a 2x2 district GeoJSON."""
+    folder = tmp_path_factory.mktemp('data')
+    input_folder = folder / 'epsg3857'
+    input_folder.mkdir()
+    x, y, bounds = point_grid(1600)
+    ntzg = land_use(x, y)
+    for timestamp in pd.to_datetime(HOURS):
+        temperatur, messung, genauigkeit = hour_values(x, y, ntzg, timestamp)
+        pd.DataFrame({'x': x.astype(float), 'y': y.astype(float), 'temperatur': temperatur, 'messung': messung,
+                      'genauigkeit': genauigkeit, 'ntzg': ntzg}).to_csv(
+            input_folder / raw_filename(timestamp).replace('.txt', '.csv'), index=False)
+
+    polygons = district_polygons(bounds, 2, 2)
+    geojson_path = folder / 'districts.geojson'
+    gpd.GeoDataFrame({'gid': [11, 12, 13, 14], 'name': ['A', 'B', 'C', 'D']}, geometry=polygons,
+                     crs='EPSG:3857').to_file(geojson_path, driver='GeoJSON')
+    return str(input_folder), str(geojson_path), bounds
+
+@pytest.fixture
+def renderer(data):
+    input_folder, geojson_path, _ = data
+    return HeatmapRenderer(input_folder, geojson_path)
+
+def pixels(png):
+    """RGBA pixels of a PNG given as bytes or path."""
+    with Image.open(BytesIO(png) if isinstance(png, bytes) else png) as image:
+        return np.asarray(image.convert('RGBA'))
+
+@pytest.mark.parametrize('renderer_name', ['matplotlib', 'direct'])
+def test_render_district_equals_create_heatmap(data, renderer, tmp_path, renderer_name):
+    input_folder, geojson_path, _ = data
+    districts = load_geometries(geojson_path)
+    hour = renderer.hours()[1]
+    df = read_table(os.path.join(input_folder, renderer.filename(hour)), HOUR_COLUMNS)
+    for gid, geometry in zip(districts.column('gid'), districts.geometries):
+        output_png = str(tmp_path / f"{gid}.png")
+        create_heatmap(df, output_png, geometry, str(gid), RESOLUTION, 'RdBu_r', 10, 36, renderer=renderer_name)
+        png = renderer.render_district(hour, gid, RESOLUTION, 'RdBu_r', 10, 36, png_format='rgba')
+        expected = pixels(output_png)
+        assert pixels(png).shape == expected.shape
+        assert np.array_equal(pixels(png), expected)
+
+def test_render_district_equals_cli_output(data, renderer, tmp_path):
+    input_folder, geojson_path, _ = data
+    output_folder = tmp_path / 'heatmaps'
+    subprocess.run([sys.executable, os.path.join(REPO, 'heatmap_generator_unified.py'), input_folder,
+                    str(output_folder), geojson_path, '--resolution', str(RESOLUTION), '--renderer', 'direct',
+                    '--png_format', 'palette', '--max_workers', '1'],
+                   check=True, cwd=REPO, capture_output=True)
+
+    for hour in renderer.hours():
+        base = os.path.splitext(renderer.filename(hour))[0]
+        for gid in (11, 14):
+            with open(output_folder / f"{base}_district{gid}.png", 'rb') as f:
+                assert renderer.render_district(hour, gid, RESOLUTION, png_format='palette') == f.read()
+
+def test_cache_hits_and_misses(renderer, data):
+    _, _, bounds = data
+    hours = renderer.hours()
+    renderer.render(hours[0], bounds, 48)
+    info = renderer.cache_info()
+    assert (info['hours'].misses, info['triangulations'].misses, info['plans'].misses) == (1, 1, 1)
+    assert info['plans'].hits == 0
+
+    # Same view again: everything is cached
+    renderer.render(hours[0], bounds, 48, cmap='viridis', variable='pet')
+    info = renderer.cache_info()
+    assert (info['hours'].misses, info['triangulations'].misses, info['plans'].misses) == (1, 1, 1)
+    assert info['plans'].hits == 1
+
+    # Another hour with the same points only parses the hour, plan and triangulation are shared
+    renderer.render(hours[1], bounds, 48)
+    info = renderer.cache_info()
+    assert (info['hours'].misses, info['triangulations'].misses, info['plans'].misses) == (2, 1, 1)
+    assert info['plans'].hits == 2
+
+    # A new view of known points reuses the triangulation
+    x_min, y_min, x_max, y_max = bounds
+    renderer.render(hours[1], (x_min, y_min, (x_min + x_max) / 2, (y_min + y_max) / 2), 48)
+    info = renderer.cache_info()
+    assert (info['triangulations'].misses, info['triangulations'].hits, info['plans'].misses) == (1, 1, 2)
+    assert info['plans'].entries == 2
+
+    renderer.clear_cache()
+    assert renderer.cache_info()['plans'].entries == 0
+    assert renderer.cache_info()['plans'].bytes == 0
+
+def test_plan_cache_evicts_least_recently_used_view(renderer, data):
+    _, _, bounds = data
+    hour = renderer.hours()[0]
+    x_min, y_min, x_max, y_max = bounds
+    views = [bounds, (x_min, y_min, (x_min + x_max) / 2, y_max), (x_min, y_min, x_max, (y_min + y_max) / 2)]
+
+    renderer.render(hour, views[0], 48)
+    plan_bytes = renderer.cache_info()['plans'].bytes
+    # Room for the two smaller views, but not for all three
+    renderer.plan_cache.max_bytes = int(plan_bytes * 1.2)
+    renderer.render(hour, views[1], 48)
+    info = renderer.cache_info()['plans']
+    assert info.evictions == 1 and info.entries == 1
+
+    renderer.render(hour, views[2], 48)
+    renderer.render(hour, views[1], 48)
+    info = renderer.cache_info()['plans']
+    assert info.entries == 2 and info.bytes <= info.max_bytes
+    assert info.hits == 1
+
+def test_lru_cache_order_and_oversized_values():
+    built = []
+    cache = LRUCache(3, len)
+
+    def get(key, size=1):
+        return cache.get(key, lambda: built.append(key) or 'x' * size)
+
+    for key in 'abc':
+        get(key)
+    get('a')  # a is now the most recently used
+    get('d')  # evicts b
+    assert list(cache.entries) == ['c', 'a', 'd']
+    get('b')
+    assert built == ['a', 'b', 'c', 'd', 'b']
+    assert cache.info().evictions == 2
+
+    # Values larger than the whole cache are returned but not kept
+    assert get('big', 10) == 'x' * 10
+    assert 'big' not in cache.entries and cache.info().bytes <= 3
+
+def test_unknown_district(renderer):
+    with pytest.raises(ValueError, match='Unknown district'):
+        renderer.render_district(renderer.hours()[0], 99, RESOLUTION)
+
+def test_district_needs_geojson(data):
+    input_folder, _, _ = data
+    with pytest.raises(ValueError, match='without geojson_path'):
+        HeatmapRenderer(input_folder).render_district(0, 11, RESOLUTION)
+
+@pytest.mark.parametrize('variable', ['temperature', 'ntzg', ''])
+def test_unknown_variable(renderer, data, variable):
+    _, _, bounds = data
+    with pytest.raises(ValueError, match='Unknown variable'):
+        renderer.render(renderer.hours()[0], bounds, 48, variable=variable)
+    with pytest.raises(ValueError, match='Unknown variable'):
+        renderer.render_district(renderer.hours()[0], 11, RESOLUTION, variable=variable)
+
+@pytest.mark.parametrize('hour', [3, -1, 100])
+def test_hour_index_out_of_range(renderer, data, hour):
+    _, _, bounds = data
+    with pytest.raises(ValueError, match='out of range'):
+        renderer.render(hour, bounds, 48)
+
+@pytest.mark.parametrize('hour', ['2023-08-19T22:00:00', '2030-01-01T00:00:00', 'no_such_file.csv'])
+def test_unknown_hour(renderer, data, hour):
+    _, _, bounds = data
+    with pytest.raises(ValueError, match='Unknown hour'):
+        renderer.render(hour, bounds, 48)
+    with pytest.raises(ValueError, match='Unknown hour'):
+        renderer.render_district(hour, 11, RESOLUTION)
+
+def test_hours_by_name_index_and_file(renderer):
+    hours = renderer.hours()
+    assert hours == ['2023-08-20T22:00:00', '2023-08-21T03:00:00', '2023-08-21T04:00:00']
+    filename = renderer.filename(hours[2])
+    assert renderer.filename(2) == filename
+    assert renderer.filename(filename) == filename
+    assert renderer.filename(os.path.splitext(filename)[0]) == filename
+
+def test_invalid_bounds(renderer, data):
+    _, _, (x_min, y_min, x_max, y_max) = data
+    with pytest.raises(ValueError, match='Bounds'):
+        renderer.render(0, (x_max, y_min, x_min, y_max), 48)
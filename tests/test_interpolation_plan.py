@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import interpolation_plan
+from benchmarks.synthetic_data import land_use, point_grid
+from interpolation_plan import InterpolationPlan, get_interpolation_plan, set_plan_cache_mb
+from lru_cache import LRUCache
+
+@pytest.fixture(scope='module')
+def points():
+    x, y, bounds = point_grid(900)
+    return x.astype(float), y.astype(float), np.isin(land_use(x, y), [20, 21, 30, 32]), bounds
+
+@pytest.fixture
+def plan_cache():
+    """The plan cache of this process, emptied before and after the test."""
+    cache = interpolation_plan._plan_cache
+    cache.clear()
+    yield cache
+    cache.clear()
+    set_plan_cache_mb(interpolation_plan.PLAN_CACHE_MB)
+
+def test_plan_cache_is_bounded_by_bytes(points, plan_cache):
+    x, y, building_mask, bounds = points
+    plan = get_interpolation_plan(x, y, building_mask, bounds, 64, 64)
+    assert get_interpolation_plan(x, y, building_mask, bounds, 64, 64) is plan
+    assert plan_cache.info().bytes == plan.nbytes
+
+    # A budget of less than two plans keeps only the most recent one
+    plan_cache.resize(int(plan.nbytes * 1.5))
+    for size in (65, 66, 67):
+        get_interpolation_plan(x, y, building_mask, bounds, size, 64)
+    info = plan_cache.info()
+    assert info.entries == 1 and info.bytes <= info.max_bytes
+
+    # Plans larger than the budget are returned but not kept
+    set_plan_cache_mb(0)
+    assert plan_cache.info().entries == 0
+    get_interpolation_plan(x, y, building_mask, bounds, 64, 64)
+    assert plan_cache.info().entries == 0
+
+def test_memory_mapped_plans_do_not_count(points, plan_cache, tmp_path):
+    x, y, building_mask, bounds = points
+    set_plan_cache_mb(0)
+    plan = get_interpolation_plan(x, y, building_mask, bounds, 64, 64, cache_dir=str(tmp_path))
+    assert isinstance(plan.weights, np.memmap)
+    assert plan.resident_nbytes == 0
+    assert get_interpolation_plan(x, y, building_mask, bounds, 64, 64, cache_dir=str(tmp_path)) is plan
+
+    built = InterpolationPlan.build(x, y, building_mask, bounds, 64, 64)
+    for name in InterpolationPlan.ARRAYS:
+        assert np.array_equal(getattr(plan, name), getattr(built, name))
+
+def test_lru_cache_limits_the_number_of_entries():
+    cache = LRUCache(1 << 20, lambda value: 0, max_entries=2)
+    for key in 'abc':
+        cache.get(key, lambda: key)
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.info().evictions == 1
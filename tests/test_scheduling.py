@@ -0,0 +1,84 @@
+import os
+import sys
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+import heatmap_generator_unified
+from benchmarks.synthetic_data import district_polygons, hour_values, land_use, point_grid, raw_filename
+from heatmap_generator_unified import partition_districts, worker_pool
+from run_metrics import metrics_settings
+from work_queue import partitioned_map
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    """Three EPSG:3857 hour CSVs with the same 900 points and a 2x2 district GeoJSON."""
+    folder = tmp_path_factory.mktemp('data')
+    input_folder = folder / 'epsg3857'
+    input_folder.mkdir()
+    x, y, bounds = point_grid(900)
+    ntzg = land_use(x, y)
+    for timestamp in pd.to_datetime(['2023-08-20 22:00', '2023-08-21 03:00', '2023-08-21 04:00']):
+        temperatur, messung, genauigkeit = hour_values(x, y, ntzg, timestamp)
+        pd.DataFrame({'x': x.astype(float), 'y': y.astype(float), 'temperatur': temperatur, 'messung': messung,
+                      'genauigkeit': genauigkeit, 'ntzg': ntzg}).to_csv(
+            input_folder / raw_filename(timestamp).replace('.txt', '.csv'), index=False)
+
+    geojson_path = folder / 'districts.geojson'
+    gpd.GeoDataFrame({'gid': [11, 12, 13, 14]}, geometry=district_polygons(bounds, 2, 2),
+                     crs='EPSG:3857').to_file(geojson_path, driver='GeoJSON')
+    return str(input_folder), str(geojson_path)
+
+@pytest.fixture
+def executors(monkeypatch):
+    """Keyword arguments of the process pools worker_pool creates (no processes are started)."""
+    created = []
+
+    class Executor:
+        def __init__(self, **kwargs):
+            created.append(kwargs)
+
+    monkeypatch.setattr(heatmap_generator_unified, 'ProcessPoolExecutor', Executor)
+    return created
+
+def pool_options(max_tasks_per_child):
+    return {'geojson_path': 'districts.geojson', 'cache_dir': None, 'cmap': 'RdBu_r', 'chunk_size': 4,
+            'max_tasks_per_child': max_tasks_per_child, 'metrics': metrics_settings(), 'plan_cache_mb': 64}
+
+def test_max_tasks_per_child_is_only_passed_when_set(executors):
+    worker_pool(2, pool_options(None), 'render')
+    worker_pool(2, pool_options(10), 'render')
+    assert 'max_tasks_per_child' not in executors[0]
+    assert executors[1]['max_tasks_per_child'] == 10
+
+def test_partition_balances_pixels():
+    sizes = [(0, 0, 100, 100), (0, 0, 100, 50), (0, 0, 100, 40), (0, 0, 100, 30), (0, 0, 100, 20)]
+    districts = [{'index': index, 'geometry': box(*bounds)} for index, bounds in enumerate(sizes)]
+    partition = partition_districts(districts, 100, 2)
+    assert partition == {0: 0, 1: 1, 2: 1, 3: 1, 4: 0}
+    assert partition_districts(districts, 100, 1) == dict.fromkeys(range(5), 0)
+
+def test_partitioned_map_keeps_tasks_on_their_executor():
+    def executor_name(args):
+        if args == 'fail':
+            raise ValueError(args)
+        return threading.current_thread().name.split('_')[0]
+
+    with ThreadPoolExecutor(1, 'first') as first, ThreadPoolExecutor(1, 'second') as second:
+        results = dict(partitioned_map([first, second], executor_name, [[1, 2, 3], ['a', 'fail']], 1))
+    assert results == {1: 'first', 2: 'first', 3: 'first', 'a': 'second', 'fail': None}
+
+@pytest.mark.parametrize('schedule', ['file', 'combination'])
+def test_every_plan_is_built_once(data, schedule, tmp_path):
+    input_folder, geojson_path = data
+    result = subprocess.run([sys.executable, os.path.join(REPO, 'heatmap_generator_unified.py'), input_folder,
+                             str(tmp_path / 'heatmaps'), geojson_path, '--resolution', '64', '--renderer', 'direct',
+                             '--schedule', schedule, '--max_workers', '2', '--chunk_size', '1'],
+                            check=True, cwd=REPO, capture_output=True, text=True)
+    # Each district stays on one worker, whose plan cache serves all three hours
+    assert result.stderr.count("Building interpolation plan") == 4
@@ -0,0 +1,93 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+from PIL import Image
+from shapely.geometry import Point, box
+from benchmarks.synthetic_data import land_use, point_grid
+from geometry_cache import mask_rows, packed_raster_mask, raster_mask
+from heatmap_generator_unified import create_heatmap, heatmap_colormap, save_matplotlib_png
+from interpolation_plan import InterpolationPlan, PointTriangulation, store_plan
+from png_renderer import render_rgba
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Renders a heatmap with --tile_rows and prints the peak RSS of the process in kB
+RSS_SCRIPT = '''
+import sys, resource
+sys.path.insert(0, sys.argv[1])
+import numpy as np
+from shapely.geometry import box
+from benchmarks.synthetic_data import land_use, point_grid
+from heatmap_generator_unified import create_heatmap
+x, y, bounds = point_grid(2500)
+x, y = x.astype(float), y.astype(float)
+df = {'x': x, 'y': y, 'ntzg': land_use(x, y), 'temperatur': 20 + np.sin(x / 50) + np.cos(y / 70)}
+create_heatmap(df, sys.argv[2], box(*bounds), 'rss', resolution=int(sys.argv[3]), renderer='direct', tile_rows=16)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+@pytest.fixture(scope='module')
+def points():
+    x, y, bounds = point_grid(900)
+    x, y = x.astype(float), y.astype(float)
+    return {'x': x, 'y': y, 'ntzg': land_use(x, y), 'temperatur': 20 + np.sin(x / 50) + np.cos(y / 70)}, bounds
+
+@pytest.mark.parametrize('width, height, extent', [
+    (64, 48, (0.0, 640.0, 0.0, 480.0)),
+    (173, 311, (3.5, 177.25, -20.0, 291.0)),
+    (400, 97, (1000.0, 1400.0, 50.0, 147.0)),
+])
+def test_pixel_map_matches_saved_figure(width, height, extent, tmp_path):
+    grid = np.random.default_rng(width).uniform(8, 38, (height, width))
+    grid[::7, ::5] = np.nan
+    cmap = heatmap_colormap('RdBu_r')
+    output_png = str(tmp_path / 'figure.png')
+    save_matplotlib_png(grid, extent, cmap, 10, 36, width, height, output_png)
+    with Image.open(output_png) as img:
+        expected = np.asarray(img.convert('RGBA'))
+    assert np.array_equal(render_rgba(grid, extent, cmap, 9, 36), expected)
+
+def test_stored_plan_equals_built_plan(points, tmp_path):
+    df, bounds = points
+    x_min, y_min, x_max, y_max = bounds
+    geometry = Point((x_min + x_max) / 2, (y_min + y_max) / 2).buffer((x_max - x_min) / 3)
+    width, height = 90, 70
+    building_mask = np.isin(df['ntzg'], [20, 21, 30, 32])
+    pixel_mask = raster_mask(geometry, width, height, bounds)
+
+    path = str(tmp_path / 'plan')
+    packed = packed_raster_mask(geometry, width, height, bounds)
+    store_plan(PointTriangulation(df['x'], df['y'], building_mask), bounds, width, height, path,
+               lambda row0, row1: mask_rows(packed, width, row0, row1), band_rows=9, block_pixels=100)
+    built = InterpolationPlan.build(df['x'], df['y'], building_mask, bounds, width, height, pixel_mask)
+    stored = InterpolationPlan.load(path)
+    for name in InterpolationPlan.ARRAYS:
+        assert np.array_equal(getattr(stored, name), getattr(built, name))
+        assert getattr(stored, name).dtype == getattr(built, name).dtype
+
+    values = df['temperatur']
+    band = InterpolationPlan.load_rows(path, 20, 33)
+    assert np.array_equal(band.linear_rows(values, 20, 33), built.linear_rows(values, 20, 33), equal_nan=True)
+    assert np.array_equal(band.nearest_rows(building_mask, 20, 33), built.nearest_rows(building_mask, 20, 33))
+
+@pytest.mark.parametrize('tile_rows', [1, 7, 1000])
+def test_tile_rows_equals_full_image(points, tile_rows, tmp_path):
+    df, bounds = points
+    geometry = box(*bounds).buffer(-30)
+    create_heatmap(df, str(tmp_path / 'full.png'), geometry, 'full', resolution=150, renderer='direct')
+    create_heatmap(df, str(tmp_path / 'tiled.png'), geometry, 'tiled', resolution=150, renderer='direct',
+                   tile_rows=tile_rows)
+    with Image.open(tmp_path / 'full.png') as full, Image.open(tmp_path / 'tiled.png') as tiled:
+        assert np.array_equal(np.asarray(full), np.asarray(tiled))
+
+def test_peak_memory_does_not_grow_with_resolution(tmp_path):
+    def peak_rss_kb(resolution):
+        result = subprocess.run([sys.executable, '-c', RSS_SCRIPT, REPO, str(tmp_path / f'{resolution}.png'),
+                                 str(resolution)], capture_output=True, text=True, check=True)
+        return int(result.stdout.split()[-1])
+
+    # 16 times the pixels; a plan held in memory alone would take about 46 bytes per pixel (> 100 MB)
+    growth_mb = (peak_rss_kb(2048) - peak_rss_kb(512)) / 1024
+    assert growth_mb < 40
@@ -0,0 +1,158 @@
+import os
+import time
+import logging
+import multiprocessing
+import pytest
+from work_queue import WorkQueue, claim_key, in_shard, parse_shard, verify_outputs
+
+# A complete (1x1, transparent) PNG
+TINY_PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                         '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+
+@pytest.mark.parametrize('value, shard', [('0/1', (0, 1)), ('2/3', (2, 3)), (' 1 / 4 ', (1, 4))])
+def test_parse_shard(value, shard):
+    assert parse_shard(value) == shard
+
+@pytest.mark.parametrize('value', ['', '1', '3/3', '0/0', '-1/2', 'a/b', '1/2/3'])
+def test_parse_shard_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        parse_shard(value)
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7])
+def test_every_key_lands_in_exactly_one_shard(count):
+    keys = [f"Tagesgang_2023_08_{day:02d}_{hour:02d}uhr_district{gid}"
+            for day in range(1, 31) for hour in range(24) for gid in range(1, 4)]
+    shards = [[key for key in keys if in_shard(key, (index, count))] for index in range(count)]
+    assert sorted(key for shard in shards for key in shard) == sorted(keys)
+    assert all(shards)
+    assert all(in_shard(key, None) for key in keys)
+
+def test_claim_key_changes_with_the_fingerprint():
+    assert claim_key('a.png', {'inputs': 1}) == claim_key('a.png', {'inputs': 1})
+    assert claim_key('a.png', {'inputs': 1}) != claim_key('a.png', {'inputs': 2})
+
+def claim_all(folder, keys, start, results):
+    """Claim as many of keys as possible once start is set (runs in its own process)."""
+    queue = WorkQueue(folder)
+    start.wait()
+    results.put((os.getpid(), [key for key in keys if queue.claim(key)]))
+
+def test_claims_are_exclusive_across_processes(tmp_path):
+    keys = [f"unit{i}" for i in range(200)]
+    context = multiprocessing.get_context()
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=claim_all, args=(str(tmp_path), keys, start, results)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    start.set()
+    claimed = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert len({pid for pid, _ in claimed}) == 2
+    all_claims = [key for _, keys_of_process in claimed for key in keys_of_process]
+    assert sorted(all_claims) == sorted(keys)
+
+def test_finished_units_are_not_claimed_again(tmp_path):
+    output = tmp_path / 'out.png'
+    output.write_bytes(TINY_PNG)
+    queue = WorkQueue(str(tmp_path / 'queue'))
+    assert queue.claim('unit', str(output))
+    queue.finish('unit')
+    assert not WorkQueue(str(tmp_path / 'queue')).claim('unit', str(output))
+
+    # A deleted output makes the unit unfinished again
+    output.unlink()
+    assert WorkQueue(str(tmp_path / 'queue')).claim('unit', str(output))
+
+def test_failed_units_are_retried(tmp_path):
+    queue = WorkQueue(str(tmp_path))
+    assert queue.claim('unit')
+    queue.fail('unit', 'boom')
+    assert queue.failure('unit')['error'] == 'boom'
+    assert WorkQueue(str(tmp_path)).claim('unit')
+
+def age_claim(queue, key, seconds):
+    claim_path = queue.path(key, 'claim')
+    old = time.time() - seconds
+    os.utime(claim_path, (old, old))
+
+def test_stale_claims_are_only_taken_over_with_a_timeout(tmp_path):
+    crashed = WorkQueue(str(tmp_path))
+    assert crashed.claim('unit')
+    age_claim(crashed, 'unit', 3600)
+
+    # Without claim_timeout a claim is never taken over
+    assert not WorkQueue(str(tmp_path)).claim('unit')
+    # A claim younger than the timeout is still valid
+    assert not WorkQueue(str(tmp_path), claim_timeout=7200).claim('unit')
+
+    assert WorkQueue(str(tmp_path), claim_timeout=60).claim('unit')
+    # The new claim is fresh again, so a second run does not take it over as well
+    assert not WorkQueue(str(tmp_path), claim_timeout=60).claim('unit')
+    assert os.listdir(tmp_path) == ['unit.claim']
+
+def take_over_all(folder, keys, start, results):
+    queue = WorkQueue(folder, claim_timeout=60)
+    start.wait()
+    results.put((os.getpid(), [key for key in keys if queue.claim(key)]))
+
+def test_stale_claim_is_taken_over_by_one_of_two_processes(tmp_path):
+    crashed = WorkQueue(str(tmp_path))
+    assert crashed.claim('unit')
+    age_claim(crashed, 'unit', 3600)
+
+    context = multiprocessing.get_context()
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=take_over_all, args=(str(tmp_path), ['unit'], start, results))
+                 for _ in range(2)]
+    for process in processes:
+        process.start()
+    start.set()
+    claimed = [results.get(timeout=60)[1] for _ in processes]
+    for process in processes:
+        process.join(timeout=60)
+    assert sorted(len(keys) for keys in claimed) == [0, 1]
+
+def test_verify_outputs_reports_missing_corrupt_failed_and_out_of_date(tmp_path, caplog):
+    complete = tmp_path / 'complete.png'
+    complete.write_bytes(TINY_PNG)
+    truncated = tmp_path / 'truncated.png'
+    truncated.write_bytes(TINY_PNG[:-12])
+    garbage = tmp_path / 'garbage.png'
+    garbage.write_bytes(b'not a png at all')
+    stale = tmp_path / 'stale.png'
+    stale.write_bytes(TINY_PNG)
+    tiles = tmp_path / 'tiles' / '12' / '2100'
+    tiles.mkdir(parents=True)
+    (tiles / '1300.png').write_bytes(TINY_PNG)
+    (tiles / '1301.png').write_bytes(TINY_PNG[:40])
+    failed = tmp_path / 'failed.png'
+    failed.write_bytes(TINY_PNG)
+
+    queue = WorkQueue(str(tmp_path / 'queue'))
+    queue.claim('failed')
+    queue.fail('failed', 'boom')
+
+    with caplog.at_level(logging.INFO):
+        assert verify_outputs([(str(complete), True, 'complete')], queue) == 0
+        problems = verify_outputs([
+            (str(complete), True, 'complete'),
+            (str(tmp_path / 'missing.png'), False, 'missing'),
+            (str(truncated), True, 'truncated'),
+            (str(garbage), True, 'garbage'),
+            (str(stale), False, 'stale'),
+            (str(tmp_path / 'tiles'), True, 'tiles'),
+            (str(failed), True, 'failed'),
+        ], queue)
+    assert problems == 6
+    messages = caplog.text
+    assert f"Missing: {tmp_path / 'missing.png'}" in messages
+    assert f"Corrupt: {truncated}" in messages
+    assert f"Corrupt: {garbage}" in messages
+    assert f"Corrupt: {tmp_path / 'tiles'} (1 incomplete PNG files)" in messages
+    assert f"Out of date: {stale}" in messages
+    assert f"Failed: {failed}" in messages and 'boom' in messages
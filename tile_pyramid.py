@@ -0,0 +1,89 @@
+import os
+import math
+import shutil
+import numpy as np
+from png_renderer import save_rgba_png
+
+# Web Mercator (EPSG:3857) extent and XYZ tile size
+ORIGIN_SHIFT = 20037508.342789244
+TILE_SIZE = 256
+
+def tile_span(zoom):
+    """Width of one tile in EPSG:3857 metres at a zoom level."""
+    return 2 * ORIGIN_SHIFT / (1 << zoom)
+
+def tile_range(bounds, zoom):
+    """(x_min, y_min, x_max, y_max) XYZ tile indices covering bounds (inclusive, y = 0 at the top)."""
+    x_min, y_min, x_max, y_max = bounds
+    span = tile_span(zoom)
+    last = (1 << zoom) - 1
+    tx0 = min(max(int(math.floor((x_min + ORIGIN_SHIFT) / span)), 0), last)
+    tx1 = min(max(int(math.floor((x_max + ORIGIN_SHIFT) / span)), 0), last)
+    ty0 = min(max(int(math.floor((ORIGIN_SHIFT - y_max) / span)), 0), last)
+    ty1 = min(max(int(math.floor((ORIGIN_SHIFT - y_min) / span)), 0), last)
+    return tx0, ty0, tx1, ty1
+
+def tile_bounds(tx0, ty0, tx1, ty1, zoom):
+    """EPSG:3857 extent (x_min, y_min, x_max, y_max) of an inclusive tile range."""
+    span = tile_span(zoom)
+    return (tx0 * span - ORIGIN_SHIFT, ORIGIN_SHIFT - (ty1 + 1) * span,
+            (tx1 + 1) * span - ORIGIN_SHIFT, ORIGIN_SHIFT - ty0 * span)
+
+def downsample_rgba(rgba):
+    """Halve an RGBA image (even size) by averaging 2x2 blocks with premultiplied alpha."""
+    height, width = rgba.shape[:2]
+    blocks = rgba.astype(np.uint32).reshape(height // 2, 2, width // 2, 2, 4)
+    alpha = blocks[..., 3]
+    alpha_sum = alpha.sum(axis=(1, 3))
+    color_sum = (blocks[..., :3] * alpha[..., None]).sum(axis=(1, 3))
+
+    out = np.zeros((height // 2, width // 2, 4), dtype=np.uint8)
+    covered = alpha_sum > 0
+    out[covered, :3] = (color_sum[covered] + alpha_sum[covered, None] // 2) // alpha_sum[covered, None]
+    out[..., 3] = (alpha_sum + 2) // 4
+    return out
+
+def write_tiles(rgba, tx0, ty0, zoom, output_dir):
+    """Cut an image whose top left corner is tile (tx0, ty0) into tiles, skipping transparent ones."""
+    written = 0
+    rows, cols = rgba.shape[0] // TILE_SIZE, rgba.shape[1] // TILE_SIZE
+    for col in range(cols):
+        column_dir = os.path.join(output_dir, str(zoom), str(tx0 + col))
+        for row in range(rows):
+            tile = rgba[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE]
+            if not tile[:, :, 3].any():
+                continue
+            os.makedirs(column_dir, exist_ok=True)
+            save_rgba_png(np.ascontiguousarray(tile), os.path.join(column_dir, f"{ty0 + row}.png"))
+            written += 1
+    return written
+
+def write_tile_pyramid(rgba, tx0, ty0, zoom_max, zoom_min, output_dir):
+    """Write rgba (tile aligned at zoom_max, top row north) as {z}/{x}/{y}.png for zoom_max..zoom_min.
+
+    Lower zoom levels are built by downsampling the level above, not by rendering again.
+    The pyramid is written next to output_dir and moved into place at the end, so tiles
+    of an older run do not survive. Returns the number of tiles written.
+    """
+    tmp_dir = f"{output_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    written = 0
+    for zoom in range(zoom_max, zoom_min - 1, -1):
+        written += write_tiles(rgba, tx0, ty0, zoom, tmp_dir)
+        if zoom == zoom_min:
+            break
+
+        # Pad to whole tiles of the next level (2x2 tiles each), then halve
+        rows, cols = rgba.shape[0] // TILE_SIZE, rgba.shape[1] // TILE_SIZE
+        top, left = ty0 % 2, tx0 % 2
+        bottom, right = (top + rows) % 2, (left + cols) % 2
+        rgba = np.pad(rgba, ((top * TILE_SIZE, bottom * TILE_SIZE), (left * TILE_SIZE, right * TILE_SIZE), (0, 0)))
+        rgba = downsample_rgba(rgba)
+        tx0, ty0 = tx0 // 2, ty0 // 2
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.rename(tmp_dir, output_dir)
+    return written
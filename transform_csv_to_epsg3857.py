@@ -1,8 +1,10 @@
 import os
-import pandas as pd
+import argparse
 from pyproj import Transformer
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from columnar_store import STORE_SUFFIX, list_tables, read_table, table_base, write_table
+from build_manifest import BuildManifest
 
 # Define input and output folders
 input_folder = './csvdata/multiple_files/epsg25832'
@@ -11,21 +13,17 @@ output_folder = './csvdata/multiple_files/epsg3857'
 # Create transformer object to convert EPSG:25832 to EPSG:3857
 transformer = Transformer.from_crs("epsg:25832", "epsg:3857", always_xy=True)
 
-# Ensure output folder exists
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
-
-# Function to process a single CSV file without chunking
-def transform_file(filename):
+# Function to process a single CSV file (or store) without chunking
+def transform_file(filename, input_folder=input_folder, output_folder=output_folder, output_format='csv'):
     input_file_path = os.path.join(input_folder, filename)
-    output_file_path = os.path.join(output_folder, filename)
+    output_file_base = os.path.join(output_folder, table_base(filename))
 
     # Start timing the transformation
     start_time = time.time()
     print(f"Starting transformation for {filename}...")
 
-    # Read the entire CSV file at once
-    df = pd.read_csv(input_file_path)
+    # Read the entire file at once
+    df = read_table(input_file_path)
 
     # Transform the coordinates
     transformed_coords = transformer.transform(df['x'].values, df['y'].values)
@@ -33,8 +31,8 @@ def transform_file(filename):
     # Replace the x and y columns with the transformed coordinates
     df['x'], df['y'] = transformed_coords
 
-    # Save the transformed data to a new CSV file in the output folder
-    df.to_csv(output_file_path, index=False)
+    # Save the transformed data to a new file in the output folder
+    write_table(output_file_base, df, output_format, attrs={'crs': 'EPSG:3857', 'source': filename})
 
     # End timing the transformation
     end_time = time.time()
@@ -44,19 +42,46 @@ def transform_file(filename):
 
 # Main entry point for the script
 if __name__ == '__main__':
-    # Collect all CSV files
-    csv_files = [f for f in os.listdir(input_folder) if f.endswith(".csv")]
+    parser = argparse.ArgumentParser(description="Transform CSV files or stores from EPSG:25832 to EPSG:3857")
+    parser.add_argument("--input_folder", default=input_folder, help="Folder with EPSG:25832 files")
+    parser.add_argument("--output_folder", default=output_folder, help="Folder for EPSG:3857 files")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv",
+                        help="'npy' writes a directory of memory-mappable .npy columns per file")
+    parser.add_argument("--force", action="store_true", help="Transform all files, even if they are up to date")
+    args = parser.parse_args()
+
+    # Ensure output folder exists
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    # Collect all CSV files and stores
+    csv_files = list_tables(args.input_folder)
+
+    # Only transform files whose output is missing or was built from different input
+    manifest = BuildManifest(args.output_folder, args.force)
+    pending = {}
+    for filename in csv_files:
+        output_path = os.path.join(args.output_folder, table_base(filename)) + \
+            (STORE_SUFFIX if args.format == 'npy' else '.csv')
+        fingerprint = manifest.fingerprint([os.path.join(args.input_folder, filename)], {'format': args.format})
+        if not manifest.is_current(output_path, fingerprint):
+            pending[filename] = (output_path, fingerprint)
+    print(f"{len(csv_files) - len(pending)} of {len(csv_files)} files are already up to date.")
 
     # Define the number of processes you want to run in parallel
-    MAX_PROCESSES = min(10, len(csv_files))  # Use 10 processes (for 10 cores), or less if there are fewer files
+    MAX_PROCESSES = max(1, min(10, len(pending)))  # Use 10 processes (for 10 cores), or less if there are fewer files
 
     # Use ProcessPoolExecutor to transform files in parallel with a limited number of processes
-    with ProcessPoolExecutor(max_workers=MAX_PROCESSES) as executor:
-        futures = [executor.submit(transform_file, filename) for filename in csv_files]
+    try:
+        with ProcessPoolExecutor(max_workers=MAX_PROCESSES) as executor:
+            futures = [executor.submit(transform_file, filename, args.input_folder, args.output_folder, args.format)
+                       for filename in pending]
 
-        # As each file finishes, print its result
-        for future in as_completed(futures):
-            filename, elapsed_time = future.result()
-            print(f"{filename} completed in {elapsed_time:.2f} seconds.")
+            # As each file finishes, print its result
+            for future in as_completed(futures):
+                filename, elapsed_time = future.result()
+                manifest.record(*pending[filename])
+                print(f"{filename} completed in {elapsed_time:.2f} seconds.")
+    finally:
+        manifest.save()
 
     print("Coordinate transformation completed for all files.")
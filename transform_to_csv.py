@@ -1,37 +1,70 @@
 import os
+import argparse
 import pandas as pd
+from columnar_store import STORE_SUFFIX, write_table
+from build_manifest import BuildManifest
 
 # Define input and output folders
 input_folder = './rawdata/Tagesgang/Full'
 output_folder = './csvdata/multiple_files/epsg25832/'
 
-# Ensure output folder exists
-os.makedirs(output_folder, exist_ok=True)
-
 # Column headers
 headers = ['x', 'y', 'temperatur', 'messung', 'genauigkeit', 'ntzg']
 
-index = 0
-
-# Loop through all files in the input folder
-for filename in os.listdir(input_folder):
-    if filename.endswith('.txt') and 'Testdaten' in filename:
-        # Construct full input file path
-        input_filepath = os.path.join(input_folder, filename)
-        
-        # Read the input data
-        data = pd.read_csv(input_filepath, sep='\t', header=None)
-        data.columns = headers
-        
-        # Construct output filename by replacing .txt with .csv
-        output_filename = filename.replace('.txt', '.csv')
-        output_filepath = os.path.join(output_folder, output_filename)
-        
-        # Save the data to the output CSV file
-        data.to_csv(output_filepath, index=False)
-        
-        print(f"{index} Converted {filename} to {output_filename}")
-
-        index += 1
-
-print("All files converted successfully!")
+def read_raw_file(input_filepath):
+    """Read a raw tab-separated Tagesgang file."""
+    data = pd.read_csv(input_filepath, sep='\t', header=None)
+    data.columns = headers
+    return data
+
+def convert_all(input_folder, output_folder, output_format='csv', force=False):
+    # Ensure output folder exists
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Remembers which raw file every output was converted from
+    manifest = BuildManifest(output_folder, force)
+
+    index = 0
+    skipped = 0
+
+    try:
+        # Loop through all files in the input folder
+        for filename in os.listdir(input_folder):
+            if filename.endswith('.txt') and 'Testdaten' in filename:
+                # Construct full input file path
+                input_filepath = os.path.join(input_folder, filename)
+
+                # Skip outputs that are still current for this raw file
+                output_base = os.path.join(output_folder, filename.replace('.txt', ''))
+                output_path = output_base + (STORE_SUFFIX if output_format == 'npy' else '.csv')
+                fingerprint = manifest.fingerprint([input_filepath], {'format': output_format})
+                if manifest.is_current(output_path, fingerprint):
+                    skipped += 1
+                    continue
+
+                # Read the input data
+                data = read_raw_file(input_filepath)
+
+                # Construct output filename by replacing .txt with .csv (or .npcols)
+                output_filepath = write_table(output_base, data, output_format,
+                                              attrs={'crs': 'EPSG:25832', 'source': filename})
+                manifest.record(output_filepath, fingerprint)
+
+                print(f"{index} Converted {filename} to {os.path.basename(output_filepath)}")
+
+                index += 1
+    finally:
+        manifest.save()
+
+    print(f"All files converted successfully! ({skipped} already up to date)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert raw Tagesgang files to CSV or columnar stores")
+    parser.add_argument("--input_folder", default=input_folder, help="Folder with raw .txt files")
+    parser.add_argument("--output_folder", default=output_folder, help="Folder for converted files")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv",
+                        help="'npy' writes a directory of memory-mappable .npy columns per file")
+    parser.add_argument("--force", action="store_true", help="Convert all files, even if they are up to date")
+    args = parser.parse_args()
+
+    convert_all(args.input_folder, args.output_folder, args.format, args.force)
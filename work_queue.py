@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import time
+import socket
+import hashlib
+import logging
+from concurrent.futures import wait, FIRST_COMPLETED
+from build_manifest import iter_files
+
+# Every complete PNG starts with the signature and ends with an empty IEND chunk
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+def parse_shard(value):
+    """(index, count) of a shard given as 'i/N' with 0 <= i < N."""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value or '')
+    if not match:
+        raise ValueError(f"Shard must be given as i/N, not {value!r}")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}, not {index}")
+    return index, count
+
+def in_shard(key, shard):
+    """Whether a unit of work belongs to shard (index, count); None means everything.
+
+    Uses a hash of the key (not Python's hash()), so every machine splits the same way.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) % count == index
+
+def claim_key(output_key, fingerprint):
+    """Queue key of an output: its name plus a short hash of what it is built from.
+
+    Changed inputs or settings give a new key, so a later run does not see old claims.
+    """
+    digest = hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:12]
+    return f"{output_key}@{digest}"
+
+class WorkQueue:
+    """Units of work claimed through lock files in a directory shared by several runs.
+
+    claim() creates <key>.claim with O_CREAT | O_EXCL, which succeeds for exactly one
+    run, also across machines on a shared file system. Finished units get <key>.done,
+    failed ones <key>.failed (their claim is dropped, so a later run retries them).
+    Claims older than claim_timeout seconds without a result are taken over.
+    """
+
+    def __init__(self, folder, claim_timeout=None):
+        self.folder = folder
+        self.claim_timeout = claim_timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key, state):
+        return os.path.join(self.folder, f"{re.sub(r'[^A-Za-z0-9._@-]', '_', key)}.{state}")
+
+    def claim(self, key, outputs=()):
+        """Try to take a unit of work; False when another run has it or has finished it.
+
+        A unit counts as unfinished again when one of its outputs (path or list of paths)
+        was deleted since.
+        """
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        done_path = self.path(key, 'done')
+        if os.path.exists(done_path):
+            if all(os.path.exists(output) for output in outputs):
+                return False
+            try:
+                stale_path = f"{done_path}.stale-{self.owner.replace(':', '-')}"
+                os.rename(done_path, stale_path)
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+        claim_path = self.path(key, 'claim')
+        for _ in range(2):
+            try:
+                fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.take_over(claim_path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'owner': self.owner, 'time': time.time()}, f)
+            return True
+        return False
+
+    def take_over(self, claim_path):
+        """Remove a stale claim, so the caller can try to claim the unit again.
+
+        Only one run at a time may remove a claim (a marker file named after the claim's
+        modification time, created with O_EXCL), and only if the claim is still the stale
+        one it looked at; a fresh claim created in the meantime is left alone.
+        """
+        if self.claim_timeout is None:
+            return False
+        try:
+            mtime_ns = os.stat(claim_path).st_mtime_ns
+            if time.time() - mtime_ns / 1e9 < self.claim_timeout:
+                return False
+            marker_path = f"{claim_path}.takeover-{mtime_ns}"
+            try:
+                os.close(os.open(marker_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                return False
+            try:
+                if os.stat(claim_path).st_mtime_ns != mtime_ns:
+                    return True
+                os.remove(claim_path)
+            finally:
+                os.remove(marker_path)
+        except FileNotFoundError:
+            # Released or taken over by another run in the meantime
+            return True
+        logging.warning(f"Taking over stale claim {claim_path}")
+        return True
+
+    def finish(self, key):
+        with open(self.path(key, 'done'), 'w', encoding='utf-8') as f:
+            json.dump({'owner': self.owner, 'time': time.time()}, f)
+        for state in ('failed', 'claim'):
+            try:
+                os.remove(self.path(key, state))
+            except FileNotFoundError:
+                pass
+
+    def fail(self, key, message=''):
+        with open(self.path(key, 'failed'), 'w', encoding='utf-8') as f:
+            json.dump({'owner': self.owner, 'time': time.time(), 'error': message}, f)
+        try:
+            os.remove(self.path(key, 'claim'))
+        except FileNotFoundError:
+            pass
+
+    def failure(self, key):
+        """Recorded failure of a unit (dict with owner, time, error) or None."""
+        try:
+            with open(self.path(key, 'failed'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+def bounded_map(executor, function, tasks, max_pending):
+    """Yield (args, result) of function(args) for all tasks, with at most max_pending submitted at once.
+
+    tasks is consumed lazily, so a generator that claims work only claims what is about
+    to run. result is None when the task raised.
+    """
+    tasks = iter(tasks)
+    futures = {}
+    exhausted = False
+    while not exhausted or futures:
+        while not exhausted and len(futures) < max_pending:
+            args = next(tasks, None)
+            if args is None:
+                exhausted = True
+                break
+            futures[executor.submit(function, args)] = args
+        if not futures:
+            break
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            args = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Error in future: {str(e)}")
+                result = None
+            yield args, result
+
+def partitioned_map(executors, function, partitions, max_pending):
+    """bounded_map over several executors: the tasks of partitions[i] all go to executors[i].
+
+    Every executor has at most max_pending tasks submitted at once and takes the next
+    task of its partition as soon as it has room, independent of the others.
+    """
+    partitions = [iter(tasks) for tasks in partitions]
+    pending = [0] * len(executors)
+    active = set(range(len(executors)))
+    futures = {}  # future -> (executor number, args)
+    while active or futures:
+        for number in sorted(active):
+            while pending[number] < max_pending:
+                args = next(partitions[number], None)
+                if args is None:
+                    active.discard(number)
+                    break
+                futures[executors[number].submit(function, args)] = (number, args)
+                pending[number] += 1
+        if not futures:
+            break
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            number, args = futures.pop(future)
+            pending[number] -= 1
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Error in future: {str(e)}")
+                result = None
+            yield args, result
+
+def is_complete_png(path):
+    """Whether a PNG file has the PNG signature and ends with the IEND chunk (e.g. not truncated)."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return False
+            f.seek(0, os.SEEK_END)
+            if f.tell() < len(PNG_SIGNATURE) + len(PNG_END):
+                return False
+            f.seek(-len(PNG_END), os.SEEK_END)
+            return f.read() == PNG_END
+    except OSError:
+        return False
+
+def corrupt_pngs(path):
+    """PNG files of an output (file or folder, e.g. a tile pyramid) that are not complete."""
+    return [file_path for file_path in iter_files(path)
+            if file_path.lower().endswith('.png') and not is_complete_png(file_path)]
+
+def verify_outputs(outputs, queue=None):
+    """Report outputs that are missing, corrupt, out of date or failed; returns the number of problems.
+
+    outputs is a list of (output path, is current, claim key); failures are looked up in
+    queue when one is given. PNGs only count as complete with signature and IEND chunk.
+    """
+    problems = 0
+    for path, current, key in outputs:
+        failure = queue.failure(key) if queue else None
+        corrupt = [] if failure or not os.path.exists(path) else corrupt_pngs(path)
+        if failure:
+            logging.error(f"Failed: {path} ({failure['owner']}: {failure['error']})")
+        elif not os.path.exists(path):
+            logging.error(f"Missing: {path}")
+        elif corrupt:
+            logging.error(f"Corrupt: {path} ({len(corrupt)} incomplete PNG files)" if os.path.isdir(path)
+                          else f"Corrupt: {path}")
+        elif not current:
+            logging.warning(f"Out of date: {path}")
+        else:
+            continue
+        problems += 1
+    logging.info(f"Verified {len(outputs)} outputs: {len(outputs) - problems} complete, {problems} missing, corrupt or failed")
+    return problems